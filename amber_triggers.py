@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+#
+# Incremental reading of the AMBER trigger files of all steps
+# Each step file is tailed by byte offset and parsed into a typed array. The steps are merged into
+# arrival time order and candidates found by two steps at their DM boundary are removed
+# Author: L.C. Oostrum
+
+import os
+import glob
+import argparse
+
+import numpy as np
+import yaml
+
+CONFIG = "config.yaml"
+# AMBER trigger files of each step
+STEP_FILES = "{prefix}_step*.trigger"
+# columns of AMBER trigger files
+COLUMNS = ['beam', 'batch', 'sample', 'integration_step', 'compacted_integration_steps', 'time', 'DM',
+           'compacted_DMs', 'SNR']
+TRIGGER_DTYPE = np.dtype([('beam', 'i4'), ('batch', 'i4'), ('sample', 'i4'), ('integration_step', 'i4'),
+                          ('compacted_integration_steps', 'i4'), ('time', 'f8'), ('DM', 'f8'),
+                          ('compacted_DMs', 'i4'), ('SNR', 'f8'), ('step', 'i2')])
+HEADER = "# {}\n".format(' '.join(COLUMNS))
+
+
+def parse_lines(lines, step):
+    """
+    Parse AMBER trigger lines
+    lines: list of complete trigger lines, without comments
+    step: AMBER step the lines come from
+    returns: array of TRIGGER_DTYPE
+    """
+    ncol = len(COLUMNS)
+    values = np.fromstring(' '.join(lines), sep=' ')
+    if not len(values) == ncol * len(lines):
+        # some lines are malformed, only keep those with the right nr of columns
+        rows = [line.split() for line in lines]
+        values = np.array([float(value) for row in rows if len(row) == ncol for value in row])
+    values = values.reshape(-1, ncol)
+    triggers = np.zeros(len(values), dtype=TRIGGER_DTYPE)
+    for ind, column in enumerate(COLUMNS):
+        triggers[column] = values[:, ind]
+    triggers['step'] = step
+    return triggers
+
+
+def format_triggers(triggers):
+    """
+    Convert triggers to AMBER trigger file lines
+    triggers: array of TRIGGER_DTYPE
+    returns: list of lines
+    """
+    return ["{beam} {batch} {sample} {integration_step} {compacted_integration_steps} {time!r} {DM!r} "
+            "{compacted_DMs} {SNR!r}\n".format(**dict(zip(TRIGGER_DTYPE.names, trigger))) for trigger in triggers]
+
+
+def write_triggers(fname, triggers):
+    """
+    Write triggers to a file in AMBER format
+    fname: output file
+    triggers: array of TRIGGER_DTYPE
+    """
+    with open(fname, 'w') as f:
+        f.write(HEADER)
+        f.writelines(format_triggers(triggers))
+
+
+def dedupe(triggers, time_tolerance, dm_tolerance):
+    """
+    Remove candidates found by more than one step, keeping the brightest
+    triggers: array of TRIGGER_DTYPE, sorted by time
+    time_tolerance: maximum arrival time difference of duplicates (s)
+    dm_tolerance: maximum DM difference of duplicates (pc/cc)
+    returns: triggers without duplicates
+    """
+    keep = np.ones(len(triggers), dtype=bool)
+    # compare each trigger to the next ones, as long as any of them is within the time tolerance
+    for shift in range(1, len(triggers)):
+        first = triggers[:-shift]
+        second = triggers[shift:]
+        close = second['time'] - first['time'] <= time_tolerance
+        if not close.any():
+            break
+        duplicate = close & (first['step'] != second['step']) & \
+            (np.abs(second['DM'] - first['DM']) <= dm_tolerance)
+        # drop the fainter of each pair
+        fainter_first = duplicate & (first['SNR'] < second['SNR'])
+        keep[:-shift][fainter_first] = False
+        keep[shift:][duplicate & ~fainter_first] = False
+    return triggers[keep]
+
+
+class StepTail(object):
+    """
+    Read the new complete lines of one AMBER step file
+    """
+
+    def __init__(self, fname, step):
+        """
+        fname: AMBER trigger file
+        step: step index
+        """
+        self.fname = fname
+        self.step = step
+        self.offset = 0
+        # modification time of the file at the last read
+        self.mtime = None
+
+    def read(self):
+        """
+        Read the triggers appended since the previous call
+        returns: array of TRIGGER_DTYPE
+        """
+        try:
+            with open(self.fname, 'rb') as f:
+                self.mtime = os.fstat(f.fileno()).st_mtime
+                f.seek(self.offset)
+                data = f.read()
+        except IOError:
+            return np.zeros(0, dtype=TRIGGER_DTYPE)
+        # a line without newline is still being written
+        end = data.rfind('\n') + 1
+        self.offset += end
+        lines = [line for line in data[:end].split('\n') if line.strip() and not line.startswith('#')]
+        return parse_lines(lines, self.step)
+
+
+class TriggerStream(object):
+    """
+    Merge the triggers of all AMBER steps into one stream, sorted by arrival time and without duplicates
+    """
+
+    def __init__(self, prefix, time_tolerance=0.05, dm_tolerance=10.):
+        """
+        prefix: AMBER output prefix
+        time_tolerance: maximum arrival time difference of duplicates (s)
+        dm_tolerance: maximum DM difference of duplicates (pc/cc)
+        """
+        self.prefix = prefix
+        self.time_tolerance = time_tolerance
+        self.dm_tolerance = dm_tolerance
+        self.tails = {}
+        # triggers read but not yet returned, per step
+        self.pending = {}
+
+    def poll(self):
+        """
+        Read new triggers of all steps, including step files that did not exist before
+        returns: nr of new triggers
+        """
+        for fname in glob.glob(STEP_FILES.format(prefix=self.prefix)):
+            if fname not in self.tails:
+                step = int(fname[len(self.prefix) + len('_step'):-len('.trigger')])
+                self.tails[fname] = StepTail(fname, step)
+                self.pending[step] = np.zeros(0, dtype=TRIGGER_DTYPE)
+        nnew = 0
+        for tail in self.tails.values():
+            triggers = tail.read()
+            nnew += len(triggers)
+            if len(triggers):
+                # AMBER writes each step in time order, keep it that way in case of out-of-order output
+                triggers = np.concatenate([self.pending[tail.step], triggers])
+                self.pending[tail.step] = triggers[np.argsort(triggers['time'], kind='mergesort')]
+        return nnew
+
+    def pop(self, until=None):
+        """
+        Get the merged triggers that arrived before a given time and remove them from the stream.
+        The caller should have polled all data up to that time. Triggers within the time tolerance
+        of the end stay in the stream, because their duplicates may not have been read yet
+        until: arrival time (s since start of observation), None for all triggers
+        returns: array of TRIGGER_DTYPE, sorted by time
+        """
+        runs = []
+        for step in sorted(self.pending):
+            triggers = self.pending[step]
+            if until is None:
+                nuse = len(triggers)
+            else:
+                nuse = np.searchsorted(triggers['time'], until)
+            runs.append(triggers[:nuse])
+            self.pending[step] = triggers[nuse:]
+        if not runs:
+            return np.zeros(0, dtype=TRIGGER_DTYPE)
+        # k-way merge of the sorted runs of each step: a stable merge sort of the concatenated runs
+        merged = np.concatenate(runs)
+        merged = merged[np.argsort(merged['time'], kind='mergesort')]
+        merged = dedupe(merged, self.time_tolerance, self.dm_tolerance)
+        if until is None:
+            return merged
+        # put back the triggers close to the end
+        nout = np.searchsorted(merged['time'], until - self.time_tolerance)
+        for step in self.pending:
+            keep = merged[nout:][merged[nout:]['step'] == step]
+            self.pending[step] = np.concatenate([keep, self.pending[step]])
+        return merged[:nout]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Merge the AMBER trigger files of all steps into one file, "
+                                                 "sorted by arrival time and without duplicates")
+    parser.add_argument("--prefix", type=str, help="AMBER output prefix, e.g. /path/CB00", required=True)
+    parser.add_argument("--output", type=str, help="Output file (Default: <prefix>.trigger)")
+
+    args = parser.parse_args()
+
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), CONFIG), 'r') as f:
+        conf = yaml.load(f)['amber_triggers']
+    stream = TriggerStream(args.prefix, conf['time_tolerance'], conf['dm_tolerance'])
+    stream.poll()
+    write_triggers(args.output or "{}.trigger".format(args.prefix), stream.pop())
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#
+# Compound beam layouts of the Apertif phased array feed (PAF)
+# The lookup tables are built once at import
+# Author: L.C. Oostrum
+
+import numpy as np
+
+# PAF layout is based on generic elements (gels):
+# generic element (gel) layout:
+#
+#  0-----55------110
+#  |      |      |
+#  |      |      |
+#  5-----60------115
+#  |      |      |
+#  |      |      |
+#  10----65------120
+#
+# +DEC = North = down, +HA is West = right
+# +RA = east = left
+
+# 11*11 grid of elements
+NROWS = 11
+NCOLS = 11
+# gel offsets
+# Found in calc_beam_dirs.py in Apertif software:
+# From Marc Verheijen:
+#  Vivaldi elements are separated by 10cm in the PAF.
+#  The horizontal and vertical seperation of the Vivaldi's is thus
+#  10/sqrt(2)=7.071 cm, which corresponds to a geometric angle of
+#  atan(7.071/875) = 0.4630 degrees for a F/0.35 dish.
+#
+#  Because of the fast focal ratio, the focal plane is strongly curved.
+#  This leads to a Beam Deviation Factor of 0.7845. Therefore, the
+#  effective horizontal and vertical separation of the elements is
+#  actually dA = 0.7845*0.4630 = 0.3632 deg on the sky.
+#  Note that a SKA White Paper (SD-FPA_system_tradeoffs_V2.doc)
+#  describes how to calculate the BFD.
+#
+#  The planar PAF can be considered as a plane that is tangential to
+#  the celestial sphere, so the sky maps with a TAN projection onto the
+#  PAF.
+#
+OFFSET_TO_RADEC = 0.7845*0.4630  # degrees
+# total nr of CBs
+NCB = 40
+# polarisations, index in lookup tables
+POLS = {'X': 0, 'Y': 1}
+DEFAULT_LAYOUT = 'iab32'
+
+# gel for each CB, -1 means gel is not used
+# because gels use fortran ordering, this looks like the transpose of the beam layout on-sky
+# shift: extra shift (degrees) needed for some rows/cols to match Apertif layout
+LAYOUTS = {}
+
+# 32-beam IAB layout
+LAYOUTS['iab32'] = {'shift': 0.0,  # 0.075 was used previously
+                    'gel_to_CB': [-1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,
+                                  -1,  -1,   0,  -1,  12,  -1,  26,  -1,  23,  -1,  -1,
+                                  -1,   3,   0,   6,  12,  20,  26,  32,  23,  -1,  -1,
+                                  -1,   3,   1,   6,  15,  20,  27,  32,  28,  -1,  -1,
+                                  -1,   8,   1,   7,  15,  21,  27,  35,  28,  -1,  -1,
+                                  -1,   8,   2,   7,  16,  21,  30,  35,  33,  -1,  -1,
+                                  -1,  13,   2,  10,  16,  22,  30,  36,  33,  -1,  -1,
+                                  -1,  13,   5,  10,  17,  22,  31,  36,  38,  -1,  -1,
+                                  -1,  18,   5,  11,  17,  25,  31,  37,  38,  -1,  -1,
+                                  -1,  18,  -1,  11,  -1,  25,  -1,  37,  -1,  -1,  -1,
+                                  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1]}
+
+# 37-beam apertif hex (so no CB37,CB38)
+# only the central beam has been filled in so far
+LAYOUTS['apertif37'] = {'shift': 0.0,
+                        'gel_to_CB': [-1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,
+                                      -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,
+                                      -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,
+                                      -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,
+                                      -1,  -1,  -1,  -1,  -1,   0,  -1,  -1,  -1,  -1,  -1,
+                                      -1,  -1,  -1,  -1,  -1,   0,  -1,  -1,  -1,  -1,  -1,
+                                      -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,
+                                      -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,
+                                      -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,
+                                      -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,
+                                      -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1]}
+
+
+def gel_to_offset(gel, shift=0.0):
+    """
+    Calculate offset in RA, DEC from the central element (60)
+    gel: gel number or array of gel numbers
+    shift: extra shift for some rows/cols (degrees)
+    returns: dRA, dDEC in degrees, same shape as gel
+    """
+    gel = np.asarray(gel)
+    # Negative offsets are up and left with respect to central element.
+    # That corresponds to a negative offset in DEC and a positive offset in RA
+    # gels use fortran ordering: row = RA, col = DEC
+    # rows: negative offset = left = positive RA: multiply by -1
+    # cols: negative ofset = up = negative DEC: correct
+    row = -1 * (np.floor(gel / NCOLS) - NROWS//2)
+    col = (gel % NROWS - NROWS//2)
+
+    dRA = row * OFFSET_TO_RADEC
+    dDEC = col * OFFSET_TO_RADEC
+    # apply shifts (do not understand yet why these are needed to match Apertif layout)
+    # RA (only row 3 and -3 from center, maybe more?)
+    dRA = np.where(row % 3 == 0, dRA - shift * np.sign(dRA), dRA)
+    # DEC (every odd row from center)
+    dDEC = np.where(col % 2 == 1, dDEC - shift * np.sign(dDEC), dDEC)
+    return dRA, dDEC
+
+
+def _build_tables(layout):
+    """
+    Build the lookup tables of a layout
+    layout: dict with gel_to_CB and shift
+    returns: CB -> gel array of shape (NCB, 2), CB -> offset array of shape (NCB, 2, 2)
+    """
+    gel_to_CB = np.array(layout['gel_to_CB'])
+    gels = np.arange(len(gel_to_CB))
+    # CB -> (gelX, gelY), -1 means CB is not in the layout
+    # when a CB occurs more than once for one pol, the last gel is used
+    CB_to_gel = -np.ones((NCB, 2), dtype=int)
+    used = gel_to_CB >= 0
+    odd = gels % 2 == 1
+    CB_to_gel[gel_to_CB[used & ~odd], POLS['X']] = gels[used & ~odd]
+    CB_to_gel[gel_to_CB[used & odd], POLS['Y']] = gels[used & odd]
+
+    # CB -> pol -> (dRA, dDEC), NaN means CB is not in the layout
+    dRA, dDEC = gel_to_offset(CB_to_gel, layout['shift'])
+    CB_to_offset = np.stack([dRA, dDEC], axis=-1)
+    CB_to_offset[CB_to_gel < 0] = np.nan
+    return CB_to_gel, CB_to_offset
+
+
+# lookup tables for each layout
+CB_TO_GEL = {}
+CB_TO_OFFSET = {}
+for _name, _layout in LAYOUTS.items():
+    CB_TO_GEL[_name], CB_TO_OFFSET[_name] = _build_tables(_layout)
+
+
+def _get_table(tables, layout):
+    """
+    Get lookup table of a layout
+    tables: dict of tables
+    layout: name of layout
+    """
+    try:
+        return tables[layout]
+    except KeyError:
+        raise ValueError("Unknown beam layout: {}. Valid layouts are: {}".format(layout,
+                                                                               ', '.join(sorted(LAYOUTS))))
+
+
+def CB_to_gel(CB, layout=DEFAULT_LAYOUT):
+    """
+    Convert CB number(s) to gel numbers
+    CB: CB number or list of CB numbers
+    layout: name of beam layout
+    returns: array of (gelX, gelY), -1 if CB is not in the layout
+    """
+    return _get_table(CB_TO_GEL, layout)[np.asarray(CB, dtype=int)]
+
+
+def CB_to_offset(CB, pol='X', layout=DEFAULT_LAYOUT, unit='deg'):
+    """
+    Get offset in RA, DEC of CB(s) with respect to the central element
+    CB: CB number or list of CB numbers
+    pol: polarization to use: X, Y, or average. Default: X
+    layout: name of beam layout
+    unit: deg for degrees, gel for units of element spacing
+    returns: dRA, dDEC, NaN if CB is not in the layout
+    """
+    offsets = _get_table(CB_TO_OFFSET, layout)[np.asarray(CB, dtype=int)]
+    if pol.upper() in POLS:
+        offsets = offsets[..., POLS[pol.upper()], :]
+    else:
+        offsets = offsets.mean(axis=-2)
+    if unit == 'gel':
+        offsets = offsets / OFFSET_TO_RADEC
+    return offsets[..., 0], offsets[..., 1]
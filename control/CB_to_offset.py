@@ -4,85 +4,36 @@
 # 
 # Author: L. Oostrum
 
+import os
 import sys
 
 import numpy as np
 
-# generic element (gel) layout:
-#
-#  0-----55------110
-#  |      |      |
-#  |      |      |
-#  5-----60------115
-#  |      |      |
-#  |      |      |
-#  10----65------120
-#
-# +DEC = North = up, +HA is West = left
-# +RA = east = right
+# layout of the CBs is defined in beam_layout.py in the root of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import beam_layout  # noqa: E402
 
-# PAF is 11*11 grid of elements
-nrows = 11
-ncols = 11
 # IAB uses 32 beams, every 5th starting at 4 is missing. every 5th starting at 3 is 200 MHz instead of 300 MHz
 CBs = [0,1,2,3,5,6,7,8,10,11,12,13,15,16,17,18,20,21,22,23,25,26,27,28,30,31,32,33,35,36,37,38]
 
 
-def CB_to_gel(CB):
+def CB_to_gel(CB, layout=beam_layout.DEFAULT_LAYOUT):
     """
     Convert CB number to gel number
     See output of "python $UPE/base/unb_apertif.py"
     """
-    
-    gel_to_CB = [ -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,   0,  -1,  12,  -1,  26,  -1,  23,  -1,  -1,  -1,   3,   0,   6,  12,  20,  26,  32,  23,  -1,  -1,  -1,   3,   1,   6,  15,  20,  27,  32,  28,  -1,  -1,  -1,   8,   1,   7,  15,  21,  27,  35, 28, -1, -1, -1,  8,  2,  7, 16, 21, 30, 35, 33, -1, -1, -1, 13,  2, 10, 16, 22, 30, 36, 33, -1, -1, -1, 13,  5, 10, 17, 22, 31, 36, 38, -1, -1, -1, 18,  5, 11, 17, 25, 31, 37, 38, -1, -1, -1, 18, -1, 11, -1, 25, -1, 37, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1]
-
-    CB_to_gel_X = {}
-    CB_to_gel_Y = {}
-    for gel, cb in enumerate(gel_to_CB):
-        if gel % 2:
-            CB_to_gel_Y[cb] = gel
-        else:
-            CB_to_gel_X[cb] = gel
-
-    try:
-        gel = [CB_to_gel_X[CB], CB_to_gel_Y[CB]]
-    except KeyError:
+    gel = beam_layout.CB_to_gel(CB, layout)
+    if np.any(gel < 0):
         print "CB {} not currently present in IAB beam selection".format(CB)
-        raise
-    return gel
+        raise KeyError(CB)
+    return list(gel)
 
 
-def gel_to_offset(gel):
+def gel_to_offset(gel, layout=beam_layout.DEFAULT_LAYOUT):
     """
     Calculate offset in RA, DEC from the central element (60)
     """
-    nrows = 11
-    ncols = 11
-    #offset_to_RADEC = 0.375  # degrees
-    offset_to_RADEC = 0.7845*0.4630  # degrees
-    #shift = 0.075  # degrees
-    shift = 0
-
-    # Negative offsets are up and left with respect to central element. 
-    # That corresponds to a positive offset in DEC and a negative offset in RA
-    # gels use fortran ordering: row = RA, col = DEC
-    # rows: negative offset = left = negative RA: correct
-    # cols: negative ofset = up = postive DEC: multiply by -1
-    row = -1 * (np.floor(gel/ncols) - nrows//2)
-    col = (gel % nrows - nrows//2)
-
-    dRA = row * offset_to_RADEC 
-    dDEC = col * offset_to_RADEC
-    # apply shifts
-    # RA (only row 3 and -3 from center, maybe more?)
-    if row % 3 == 0:
-        dRA -= shift * np.sign(dRA)
-    # DEC (every odd row from center)
-    if col % 2 == 1:
-        # odd row, shift DEC
-        dDEC -= shift * np.sign(dDEC)
-
-    return dRA, dDEC
+    return beam_layout.gel_to_offset(gel, beam_layout.LAYOUTS[layout]['shift'])
 
 
 def hms_to_decimal(RA, DEC):
@@ -149,8 +100,10 @@ def decimal_to_hms(RA, DEC):
 if __name__ == '__main__':
 
     if len(sys.argv) < 4:
-        print "Usage: ./CB_to_offset.py CB RA DEC [pol]"
+        print "Usage: ./CB_to_offset.py CB RA DEC [pol] [layout]"
         print "Pol can by X (default), Y or avg"
+        print "Layout can be {} (default: {})".format(', '.join(sorted(beam_layout.LAYOUTS)),
+                                                      beam_layout.DEFAULT_LAYOUT)
         sys.exit(1)
 
     # Parse arguments
@@ -160,13 +113,17 @@ if __name__ == '__main__':
         pol = sys.argv[4]
     except IndexError:
         pol = 'X'
+    try:
+        layout = sys.argv[5]
+    except IndexError:
+        layout = beam_layout.DEFAULT_LAYOUT
 
     RA, DEC = hms_to_decimal(RA, DEC)
 
     # get offsets
-    gelX, gelY = CB_to_gel(CB)
-    offsetX = gel_to_offset(gelX)
-    offsetY = gel_to_offset(gelY)
+    gelX, gelY = CB_to_gel(CB, layout)
+    offsetX = beam_layout.CB_to_offset(CB, 'X', layout)
+    offsetY = beam_layout.CB_to_offset(CB, 'Y', layout)
 
     # fix offset in RA
     offsetX = (offsetX[0] / np.cos(DEC * np.pi/180), offsetX[1])
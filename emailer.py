@@ -4,11 +4,12 @@
 # Author: L.C. Oostrum
 
 import os
+import re
 import sys
 import ast
 import socket
 import smtplib
-from time import sleep
+from time import sleep, time
 from datetime import datetime
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
@@ -17,7 +18,40 @@ from email.mime.text import MIMEText
 import numpy as np
 import yaml
 
+import result_collector
+import trigger_windows
+
 CONFIG = "config.yaml"
+# result files of the time windows, sent by the nodes during the observation
+WINDOW_TRIGGERS = re.compile(r"CB(\d\d)_window\d{3}_triggers\.txt$")
+# maximum time between checks for new window results (s)
+WINDOW_POLL = 10
+# columns of the trigger files of the nodes, plus the CB
+TRIGGER_DTYPE = np.dtype([('SNR', 'f8'), ('DM', 'f8'), ('Width', 'f8'), ('T0', 'f8'), ('p', 'f8'), ('beam', 'i4')])
+# html row of a trigger, with the precision of the trigger files
+# order in email: p SNR DM T0 Width beam
+TRIGGER_ROW = "<tr><td>{4:.2f}</td><td>{0:.2f}</td><td>{1:.2f}</td><td>{3:.3f}</td><td>{2:.4f}</td><td>{5:02d}</td></tr>"
+
+# short alert for the candidates of one beam
+ALERT = """<html>
+    <head><title>FRB Alert System</title></head>
+    <body>
+    <p>Candidates in CB{beam:02d} of {source} (UTC start {utc_start}).
+    The full overview follows when the observation is done and all beams are in.</p>
+    <table style="width:50%">
+    <tr style="text-align:left">
+        <th>Probability</th>
+        <th>S/N</th>
+        <th>DM (pc/cc)</th>
+        <th>Arrival time (s)</th>
+        <th>Width (ms)</th>
+        <th>CB</th>
+    </tr>
+    {triggerinfo}
+    </table>
+    </body>
+    </html>"""
+
 
 def log(message):
     """
@@ -26,15 +60,156 @@ def log(message):
     print "Master-emailer: {}".format(message)
 
 
+def send_email(frm, to, subject, html, attachments=None):
+    """
+    Send an html email. If the attachments are refused, the email is sent without them
+    frm: sender
+    to: recipients
+    subject: subject
+    html: message text
+    attachments: list of pdf files (optional)
+    """
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = subject
+    msg['From'] = frm
+    msg['To'] = to
+    msg.attach(MIMEText(html, 'html'))
+
+    for fname in attachments or ():
+        with open(fname, 'rb') as f:
+            part = MIMEApplication(f.read(), 'pdf', Name=os.path.basename(fname))
+        part['Content-Disposition'] = 'attachment; filename="{}"'.format(os.path.basename(fname).replace('_candidates_summary', ''))
+        msg.attach(part)
+
+    log("Sending email to: {}".format(to))
+    smtp = smtplib.SMTP()
+    smtp.connect()
+    try:
+        smtp.sendmail(frm, to, msg.as_string())
+    except smtplib.SMTPSenderRefused:
+        # assume attachments are too large
+        # resend without attachments
+        # first element of payload is main text, rest are attachments
+        msg.set_payload(msg.get_payload()[0])
+        smtp.sendmail(frm, to, msg.as_string())
+        
+    smtp.close()
+
+
+def load_triggers(master_dir, beam):
+    """
+    Load the triggers of a beam
+    master_dir: results dir
+    beam: CB index
+    returns: array of TRIGGER_DTYPE, empty if the beam has no triggers
+    """
+    return read_triggers(os.path.join(master_dir, "CB{:02d}_triggers.txt".format(beam)), beam)
+
+
+def read_triggers(trigger_file, beam):
+    """
+    Read a trigger file of a node
+    trigger_file: path to trigger file
+    beam: CB index
+    returns: array of TRIGGER_DTYPE, empty if the file has no triggers
+    """
+    if not os.path.isfile(trigger_file) or not os.path.getsize(trigger_file):
+        return np.zeros(0, dtype=TRIGGER_DTYPE)
+    data = np.loadtxt(trigger_file, ndmin=2)
+    if not data.size:
+        return np.zeros(0, dtype=TRIGGER_DTYPE)
+    triggers = np.zeros(len(data), dtype=TRIGGER_DTYPE)
+    for ind, name in enumerate(TRIGGER_DTYPE.names[:-1]):
+        triggers[name] = data[:, ind]
+    triggers['beam'] = beam
+    return triggers
+
+
+def top_triggers(triggers, n):
+    """
+    Select the best triggers by probability, then S/N
+    triggers: array of TRIGGER_DTYPE
+    n: maximum nr of triggers to select
+    returns: selected triggers sorted from best to worst, remaining triggers
+    """
+    if len(triggers) > n:
+        # all triggers at least as likely as the n-th most likely one, ties are resolved by S/N below
+        pmin = triggers['p'][np.argpartition(-triggers['p'], n - 1)[n - 1]]
+        selected = np.flatnonzero(triggers['p'] >= pmin)
+    else:
+        selected = np.arange(len(triggers))
+    selected = selected[np.lexsort((-triggers['SNR'][selected], -triggers['p'][selected]))][:n]
+    remaining = np.ones(len(triggers), dtype=bool)
+    remaining[selected] = False
+    return triggers[selected], triggers[remaining]
+
+
+def format_overflow(triggers):
+    """
+    Summarise the triggers that are not listed in one table row
+    triggers: array of TRIGGER_DTYPE
+    returns: html row
+    """
+    return "<tr><td colspan=\"6\">{} more candidates in {} CBs not listed (p &le; {:.2f}, " \
+           "S/N &le; {:.2f})</td></tr>".format(len(triggers), len(np.unique(triggers['beam'])),
+                                                  triggers['p'].max(), triggers['SNR'].max())
+
+
+def new_window_results(window_dir, seen):
+    """
+    Get the window trigger files that arrived since the last check
+    window_dir: dir with the results of the time windows
+    seen: set of file names that were already handled, updated in place
+    returns: list of (beam, path)
+    """
+    try:
+        names = sorted(os.listdir(window_dir))
+    except OSError:
+        return []
+    results = []
+    for name in names:
+        match = WINDOW_TRIGGERS.match(name)
+        if match is None or name in seen:
+            continue
+        seen.add(name)
+        results.append((int(match.group(1)), os.path.join(window_dir, name)))
+    return results
+
+
+def alert_candidates(triggers, pthresh, snrmin, n, alerted):
+    """
+    Get the candidates of a beam that are worth an immediate alert
+    triggers: array of TRIGGER_DTYPE
+    pthresh: minimum probability
+    snrmin: minimum S/N
+    n: maximum nr of candidates to select
+    alerted: set of (beam, T0, DM) of candidates that were alerted before, updated in place.
+             A candidate is in the results of its window and in the merged results of its beam
+    returns: selected candidates sorted by probability, then S/N, remaining candidates
+    """
+    mask = (triggers['p'] >= pthresh) & (triggers['SNR'] >= snrmin)
+    mask &= np.array([(line['beam'], line['T0'], line['DM']) not in alerted for line in triggers], dtype=bool)
+    alerted.update([(line['beam'], line['T0'], line['DM']) for line in triggers[mask]])
+    return top_triggers(triggers[mask], n)
+
+
 if __name__ == '__main__':
     master_dir = sys.argv[1]
     expected_beams = np.array(ast.literal_eval(sys.argv[2]), dtype=int)
     nbeam = len(expected_beams)
+    # optional: end of the observation (unix time), the emailer may start before it
+    if len(sys.argv) > 3:
+        tend = float(sys.argv[3])
+    else:
+        tend = time()
+    window_dir = os.path.join(master_dir, trigger_windows.WINDOW_RESULTS)
 
     # load config file
     config_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), CONFIG)
     with open(config_file, 'r') as f:
-        config = yaml.load(f)['emailer']
+        full_config = yaml.load(f)
+    config = full_config['emailer']
+    collector = full_config['result_collector']
     # message recipients
     to = ", ".join(config['to'])
 
@@ -42,79 +217,115 @@ if __name__ == '__main__':
     coord_file = os.path.join(master_dir, 'coordinates.txt')
     # columns are beam, ra, dec, gl, gb
     coordinates = np.loadtxt(coord_file, dtype=str, ndmin=2)
-    # convert to html
-    coordinfo = ""
-    for line in coordinates:
-        coordinfo += "<tr>"
-        for val in line:
-            coordinfo += "<td>{}</td>".format(val)
-        coordinfo += "</tr>"
-
     # load obs info file
     info_file = os.path.join(master_dir, 'info.yaml')
     with open(info_file, 'r') as f:
         obsinfo = yaml.load(f)
+    # MW DMs may be missing for older observations
+    for model in ['ymw16', 'ne2001']:
+        obsinfo.setdefault(model, '-')
+    dm_beams = obsinfo.get('dm_beams', {})
+
+    # convert to html, adding the MW DMs of each CB
+    rows = []
+    for line in coordinates:
+        dms = dm_beams.get(int(line[0]), {})
+        rows.append("<tr>{}</tr>".format(''.join(["<td>{}</td>".format(val) for val in line] +
+                                                 ["<td>{}</td>".format(dms.get(model, '-'))
+                                                  for model in ['ymw16', 'ne2001']])))
+    coordinfo = ''.join(rows)
         
-    # wait until summary file for all beams is present
+    frm = "ARTS FRB Alert System <arts@{}.apertif>".format(socket.gethostname())
+
+    # wait until the results of all beams are in, or the deadline passes. The collector runs in the master process
+    # and answers as soon as a new beam arrives. Results of the time windows arrive during the observation,
+    # so with progressive alerts the emailer also checks for those regularly
     log("Expecting {} beams".format(nbeam))
-    received_beams = 0
-    while received_beams < nbeam:
-        sleep(5)
-        received_beams = 0
-        for beam in expected_beams:
-            summary_file = os.path.join(master_dir, "CB{:02d}_summary.yaml".format(beam))
-            if os.path.isfile(summary_file):
-                received_beams += 1 
-        log("Received {} out of {} beams".format(received_beams, nbeam))
+    deadline = max(tend, time()) + config['deadline']
+    use_collector = True
+    arrived = []
+    # window result files that were handled, candidates that were alerted
+    seen = set()
+    alerted = set()
+    while len(arrived) < nbeam and time() < deadline:
+        result = None
+        timeout = deadline - time()
+        if config['progressive']:
+            timeout = min(timeout, WINDOW_POLL)
+        if use_collector:
+            result = result_collector.wait_for_results(collector['host'], collector['port'], master_dir,
+                                                       expected_beams, timeout, known=arrived)
+            if result is None:
+                # also when the collector refuses this results dir, do not ask it again
+                log("Result collector not running or not serving {}, waiting for result files".format(master_dir))
+                use_collector = False
+        if result is not None:
+            new_arrived = result[0]
+        else:
+            # wait until summary file for all beams is present
+            sleep(5)
+            new_arrived = [beam for beam in expected_beams if
+                           os.path.isfile(os.path.join(master_dir, "CB{:02d}_summary.yaml".format(beam)))]
+        new_beams = [beam for beam in new_arrived if beam not in arrived]
+        arrived = new_arrived
+        if new_beams:
+            log("Received {} out of {} beams".format(len(arrived), nbeam))
+        # immediate alert for bright candidates, so the alert does not wait for the end of the observation
+        # or the slowest beam
+        if config['progressive']:
+            results = [(beam, read_triggers(fname, beam)) for beam, fname in new_window_results(window_dir, seen)]
+            results += [(beam, load_triggers(master_dir, beam)) for beam in new_beams]
+            for beam, triggers in results:
+                candidates, remaining = alert_candidates(triggers, config['alert_pthresh'], config['alert_snrmin'],
+                                                         config['max_triggers'], alerted)
+                if not len(candidates):
+                    continue
+                log("Sending alert for {} candidates in CB{:02d}".format(len(candidates) + len(remaining), beam))
+                triggerinfo = ''.join([TRIGGER_ROW.format(*line) for line in candidates])
+                if len(remaining):
+                    triggerinfo += format_overflow(remaining)
+                html = ALERT.format(beam=beam, triggerinfo=triggerinfo, **obsinfo)
+                subject = "ARTS FRB Alert System: candidate in CB{:02d} @ {}".format(beam, datetime.utcnow())
+                try:
+                    send_email(frm, to, subject, html)
+                except (smtplib.SMTPException, socket.error) as e:
+                    log("WARNING: could not send alert: {}".format(e))
+    missing = [beam for beam in expected_beams if beam not in arrived]
+    if missing:
+        log("WARNING: no results of CB {}".format(', '.join(["{:02d}".format(beam) for beam in missing])))
 
     # load beam stats
     log("Loading stats and triggers")
-    triggers = {}
+    triggers = [np.zeros(0, dtype=TRIGGER_DTYPE)]
     attachments = []
-    beamstats = ""
+    rows = []
     for i, beam in enumerate(expected_beams):
+        if beam in missing:
+            rows.append("<tr><td>{:02d}</td><td colspan=\"3\">no results</td></tr>".format(beam))
+            continue
         summary_file = os.path.join(master_dir, "CB{:02d}_summary.yaml".format(beam))
         with open(summary_file, 'r') as f:
             summary = yaml.load(f)
-        beamstats += "<tr><td>{:02d}</td><td>{}</td><td>{}</td><td>{}</td></tr>".format(beam, summary['ncand_raw'], summary['ncand_trigger'], summary['ncand_classifier'])
+        rows.append("<tr><td>{:02d}</td><td>{}</td><td>{}</td><td>{}</td></tr>".format(beam, summary['ncand_raw'], summary['ncand_trigger'], summary['ncand_classifier']))
         if summary['success']:
-            trigger_file = os.path.join(master_dir, "CB{:02d}_triggers.txt".format(beam))
-            triggers[beam] = np.loadtxt(trigger_file, dtype=str, ndmin=2)
+            triggers.append(load_triggers(master_dir, beam))
             attachments.append(os.path.join(master_dir, "CB{:02d}_candidates_summary.pdf".format(beam)))
+    beamstats = ''.join(rows)
 
-    # convert triggers to one big numpy array we can sort
-    alltriggers = []
-    for beam in triggers.keys():
-        for trigger in triggers[beam]:
-            trigger = np.concatenate([trigger, np.array(["{:02d}".format(beam)])])
-            alltriggers.append(tuple(trigger))
-    dtypes = [('SNR', 'S10'), ('DM', 'S10'), ('Width', 'S10'), ('T0', 'S10'), ('p', 'S10'), ('beam', 'S10')]
-    alltriggers = np.array(alltriggers, dtype=dtypes)
-    # sort by p, then SNR if equal
-    alltriggers = np.sort(alltriggers, order=('p', 'SNR'))[::-1]
-    
+    # one table of the triggers of all beams, only the best are listed
+    alltriggers = np.concatenate(triggers)
+    top, remaining = top_triggers(alltriggers, config['max_triggers'])
+    log("Listing {} out of {} triggers".format(len(top), len(alltriggers)))
+    triggerinfo = ''.join([TRIGGER_ROW.format(*line) for line in top])
+    if len(remaining):
+        triggerinfo += format_overflow(remaining)
 
-    # convert triggers to html
-    # cols of trigger:  SNR DM Width T0 p beam
-    # order in email: p SNR DM T0 Width beam
-    # nrs: 4 0 1 3 2 5
-    triggerinfo = ""
-    for line in alltriggers:
-        triggerinfo += "<tr><td>{4}</td><td>{0}</td><td>{1}</td><td>{3}</td><td>{2}</td><td>{5}</td></tr>".format(*line)
-    
-        
     # create email
     # kwarg for tables
-    kwargs = dict(beamstats=beamstats, coordinfo=coordinfo, triggerinfo=triggerinfo)
+    kwargs = dict(beamstats=beamstats, coordinfo=coordinfo, triggerinfo=triggerinfo,
+                  missing=', '.join(["{:02d}".format(beam) for beam in missing]) or 'none')
     # add obs info
     kwargs.update(obsinfo)
-    frm = "ARTS FRB Alert System <arts@{}.apertif>".format(socket.gethostname())
-
-    msg = MIMEMultipart('alternative')
-    msg['Subject'] = "ARTS FRB Alert System @ {}".format(datetime.utcnow())
-    msg['From'] = frm
-    msg['To'] = to
-
     txt="""<html>
     <head><title>FRB Alert System</title></head>
     <body>
@@ -129,9 +340,11 @@ if __name__ == '__main__':
     </tr><tr>
         <th style="text-align:left">Observation duration</th><td colspan="4">{tobs}</td>
     </tr><tr>
-        <th style="text-align:left">NE2001 DM (central beam)</th><td colspan="2">TBD</td>
+        <th style="text-align:left">NE2001 DM (central beam)</th><td colspan="2">{ne2001}</td>
     </tr><tr>
         <th style="text-align:left">YMW16 DM (central beam)</th><td colspan="2">{ymw16}</td>
+    </tr><tr>
+        <th style="text-align:left">CBs without results</th><td colspan="4">{missing}</td>
     </tr>
     </table>
     </p>
@@ -177,6 +390,8 @@ if __name__ == '__main__':
         <th>DEC</th>
         <th>Gl</th>
         <th>Gb</th>
+        <th>YMW16 DM (pc/cc)</th>
+        <th>NE2001 DM (pc/cc)</th>
     </tr>
     {coordinfo}
     </table>
@@ -185,24 +400,4 @@ if __name__ == '__main__':
     </body>
     </html>""".format(**kwargs)
 
-    msg.attach(MIMEText(txt, 'html'))
-
-    for fname in attachments or ():
-        with open(fname, 'rb') as f:
-            part = MIMEApplication(f.read(), 'pdf', Name=os.path.basename(fname))
-        part['Content-Disposition'] = 'attachment; filename="{}"'.format(os.path.basename(fname).replace('_candidates_summary', ''))
-        msg.attach(part)
-
-    log("Sending email to: {}".format(to))
-    smtp = smtplib.SMTP()
-    smtp.connect()
-    try:
-        smtp.sendmail(frm, to, msg.as_string())
-    except smtplib.SMTPSenderRefused:
-        # assume attachments are too large
-        # resend without attachments
-        # first element of payload is main text, rest are attachments
-        msg.set_payload(msg.get_payload()[0])
-        smtp.sendmail(frm, to, msg.as_string())
-        
-    smtp.close()
+    send_email(frm, to, "ARTS FRB Alert System @ {}".format(datetime.utcnow()), txt, attachments)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+#
+# Lightweight time and coordinate conversions for WSRT, using only numpy
+# Used instead of astropy where its import time matters more than its accuracy
+# Author: L.C. Oostrum
+#
+# Accuracy compared to astropy with delta_ut1_utc = 0:
+#  - MJD and unix time are exact (UTC, no leap second issues for unix input)
+#  - LST: UT1 is assumed equal to UTC, so the LST is off by at most |UT1-UTC| < 0.9 s (13.5 arcsec).
+#    The IAU 1982 GMST expression differs from astropy by 2-4 ms (up to 0.06 arcsec) for 2017-2027.
+#  - Alt/Az: precession (IAU 1976) is included, nutation (< 20 arcsec), annual aberration (< 21 arcsec)
+#    and polar motion are not. Total error is below 1 arcmin. No refraction, same as astropy with
+#    the default pressure of 0.
+#  - Galactic coordinates: fixed ICRS -> Galactic rotation, error well below 1 arcsec.
+
+import calendar
+from datetime import datetime
+
+import numpy as np
+
+# WSRT location, same as used with astropy
+WSRT_LAT = 52.915184  # degrees
+WSRT_LON = 6.60387  # degrees
+# MJD of unix epoch
+MJD_UNIX_EPOCH = 40587.
+# Julian date of J2000.0
+JD_J2000 = 2451545.0
+# supported UTC string formats
+UTC_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M']
+# rotation matrix from ICRS (~J2000) to Galactic coordinates
+ICRS_TO_GAL = np.array([[-0.0548755604162154, -0.8734370902348850, -0.4838350155487132],
+                        [0.4941094278755837, -0.4448296299600112, 0.7469822444972189],
+                        [-0.8676661490190047, -0.1980763734312015, 0.4559837761750669]])
+
+
+def parse_utc(utc):
+    """
+    Convert UTC string to unix time
+    utc: string, e.g. 2017-01-01 00:00:00 or 2017-01-01T00:00:00.5
+    returns: unix time (float)
+    """
+    # split off fractional seconds
+    if '.' in utc:
+        utc, frac = utc.rsplit('.', 1)
+        frac = float('0.' + frac)
+    else:
+        frac = 0.
+    for fmt in UTC_FORMATS:
+        try:
+            dt = datetime.strptime(utc.strip(), fmt)
+        except ValueError:
+            continue
+        return calendar.timegm(dt.timetuple()) + frac
+    raise ValueError("Cannot parse UTC time: {}".format(utc))
+
+
+def unix_to_datetime(unix):
+    """
+    Convert unix time to UTC datetime object
+    """
+    return datetime.utcfromtimestamp(unix)
+
+
+def unix_to_mjd(unix):
+    """
+    Convert unix time to MJD (UTC)
+    """
+    return np.asarray(unix) / 86400. + MJD_UNIX_EPOCH
+
+
+def _julian_centuries(unix):
+    """
+    Julian centuries since J2000.0 and days since J2000.0
+    """
+    days = unix_to_mjd(unix) + 2400000.5 - JD_J2000
+    return days / 36525., days
+
+
+def gmst(unix):
+    """
+    Greenwich mean sidereal time (IAU 1982), assuming UT1 = UTC
+    unix: unix time
+    returns: GMST in degrees
+    """
+    T, days = _julian_centuries(unix)
+    theta = 280.46061837 + 360.98564736629 * days + 0.000387933 * T**2 - T**3 / 38710000.
+    return theta % 360
+
+
+def lst(unix, lon=WSRT_LON):
+    """
+    Local mean sidereal time
+    unix: unix time
+    lon: east longitude in degrees
+    returns: LST in degrees
+    """
+    return (gmst(unix) + lon) % 360
+
+
+def _rot(axis, angle):
+    """
+    Rotation matrix of a coordinate frame around x, y or z axis (angle in radians)
+    """
+    c = np.cos(angle)
+    s = np.sin(angle)
+    if axis == 'y':
+        return np.array([[c, 0, -s], [0, 1, 0], [s, 0, c]])
+    elif axis == 'z':
+        return np.array([[c, s, 0], [-s, c, 0], [0, 0, 1]])
+    else:
+        return np.array([[1, 0, 0], [0, c, s], [0, -s, c]])
+
+
+def precession_matrix(unix):
+    """
+    Precession matrix (IAU 1976) from J2000 to mean equinox of date
+    """
+    T, _ = _julian_centuries(unix)
+    arcsec = np.pi / 180 / 3600
+    zeta = (2306.2181 * T + 0.30188 * T**2 + 0.017998 * T**3) * arcsec
+    z = (2306.2181 * T + 1.09468 * T**2 + 0.018203 * T**3) * arcsec
+    theta = (2004.3109 * T - 0.42665 * T**2 - 0.041833 * T**3) * arcsec
+    return np.dot(_rot('z', -z), np.dot(_rot('y', theta), _rot('z', -zeta)))
+
+
+def _to_xyz(lon, lat):
+    """
+    Convert spherical coordinates (degrees) to unit vectors, shape (3, ...)
+    """
+    lon = np.radians(lon)
+    lat = np.radians(lat)
+    return np.array([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def _from_xyz(xyz):
+    """
+    Convert unit vectors of shape (3, ...) to spherical coordinates (degrees)
+    """
+    lon = np.degrees(np.arctan2(xyz[1], xyz[0])) % 360
+    lat = np.degrees(np.arcsin(np.clip(xyz[2], -1, 1)))
+    return lon, lat
+
+
+def radec_to_galactic(ra, dec):
+    """
+    Convert J2000 RA, DEC to Galactic coordinates
+    ra, dec: degrees, scalar or array
+    returns: l, b in degrees
+    """
+    return _from_xyz(np.tensordot(ICRS_TO_GAL, _to_xyz(ra, dec), axes=1))
+
+
+def radec_to_altaz(ra, dec, unix, lat=WSRT_LAT, lon=WSRT_LON):
+    """
+    Convert J2000 RA, DEC to Alt, Az
+    ra, dec: degrees, scalar or array
+    unix: unix time
+    lat, lon: observer location in degrees
+    returns: alt, az in degrees. Az is from North through East
+    """
+    # precess to equinox of date
+    ra, dec = _from_xyz(np.tensordot(precession_matrix(unix), _to_xyz(ra, dec), axes=1))
+    ha = np.radians(lst(unix, lon) - ra)
+    dec = np.radians(dec)
+    lat = np.radians(lat)
+    alt = np.arcsin(np.sin(lat) * np.sin(dec) + np.cos(lat) * np.cos(dec) * np.cos(ha))
+    az = np.arctan2(-np.cos(dec) * np.sin(ha), np.sin(dec) * np.cos(lat) - np.cos(dec) * np.sin(lat) * np.cos(ha))
+    return np.degrees(alt), np.degrees(az) % 360
+
+
+def altaz_to_radec(alt, az, unix, lat=WSRT_LAT, lon=WSRT_LON):
+    """
+    Convert Alt, Az to J2000 RA, DEC
+    alt, az: degrees, scalar or array. Az is from North through East
+    unix: unix time
+    lat, lon: observer location in degrees
+    returns: ra, dec in degrees
+    """
+    alt = np.radians(alt)
+    az = np.radians(az)
+    lat = np.radians(lat)
+    dec = np.arcsin(np.sin(lat) * np.sin(alt) + np.cos(lat) * np.cos(alt) * np.cos(az))
+    ha = np.arctan2(-np.cos(alt) * np.sin(az), np.sin(alt) * np.cos(lat) - np.cos(alt) * np.sin(lat) * np.cos(az))
+    ra = lst(unix, lon) - np.degrees(ha)
+    # precess back to J2000
+    return _from_xyz(np.tensordot(precession_matrix(unix).T, _to_xyz(ra, np.degrees(dec)), axes=1))
+
+
+def sexagesimal_to_deg(value, hours=False):
+    """
+    Convert sexagesimal string to degrees
+    value: string, e.g. 12:30:00.0, -05:00:00 or 12 30 00. Decimal values are also accepted
+    hours: value is in hours instead of degrees
+    returns: value in degrees
+    """
+    value = value.strip()
+    negative = value.startswith('-')
+    parts = [abs(float(part)) for part in value.replace(':', ' ').split()]
+    result = sum([part / 60.**ind for ind, part in enumerate(parts)])
+    if negative:
+        result *= -1
+    if hours:
+        result *= 15
+    return result
+
+
+def deg_to_sexagesimal(value, hours=False, precision=1):
+    """
+    Convert degrees to padded sexagesimal string(s), e.g. 05:30:00.0
+    value: degrees, scalar or array
+    hours: output in hours instead of degrees
+    precision: nr of decimals of the seconds
+    returns: string, or list of strings for array input
+    """
+    if not np.isscalar(value):
+        return [deg_to_sexagesimal(val, hours, precision) for val in value]
+    if hours:
+        value = (value % 360) / 15.
+    sign = '-' if value < 0 else ''
+    # round to the requested precision first, so 59.96 s carries over
+    scale = 10**precision
+    total = int(round(abs(value) * 3600 * scale))
+    if hours:
+        total %= 24 * 3600 * scale
+    whole, frac = divmod(total, scale)
+    minutes, seconds = divmod(whole, 60)
+    degrees, minutes = divmod(minutes, 60)
+    if precision > 0:
+        seconds = "{:02d}.{:0{prec}d}".format(seconds, frac, prec=precision)
+    else:
+        seconds = "{:02d}".format(seconds)
+    return "{}{:02d}:{:02d}:{}".format(sign, degrees, minutes, seconds)
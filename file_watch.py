@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+#
+# Wait for a file to be written to
+# Uses inotify through libc where available, otherwise polls the file size
+# Author: L.C. Oostrum
+
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+from time import sleep, time
+
+# inotify event masks, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+# wd, mask, cookie, len
+EVENT_HEADER = struct.Struct("iIII")
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    _libc.inotify_init
+    _libc.inotify_add_watch
+except (OSError, AttributeError):
+    _libc = None
+
+
+class PollWatcher(object):
+    """
+    Wait for a file to change by polling its size and modification time
+    """
+
+    method = 'poll'
+
+    def __init__(self, fname, poll=0.05):
+        """
+        fname: file to watch, does not need to exist yet
+        poll: interval between checks (s)
+        """
+        self.fname = fname
+        self.poll = poll
+        self.state = self.stat()
+
+    def stat(self):
+        """
+        Get size and modification time of the file, None if it does not exist
+        """
+        try:
+            st = os.stat(self.fname)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime
+
+    def wait(self, timeout):
+        """
+        Wait until the file changes
+        timeout: maximum time to wait (s)
+        returns: True if the file changed, False on timeout
+        """
+        tstart = time()
+        while True:
+            state = self.stat()
+            if not state == self.state:
+                self.state = state
+                return True
+            if time() - tstart >= timeout:
+                return False
+            sleep(self.poll)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """
+    Wait for a file to change with inotify. The directory is watched, so the file does not need to exist yet
+    """
+
+    method = 'inotify'
+
+    def __init__(self, fname):
+        """
+        fname: file to watch
+        """
+        if _libc is None:
+            raise OSError(errno.ENOSYS, "inotify not available")
+        self.fname = fname
+        self.name = os.path.basename(fname)
+        self.fd = _libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        directory = os.path.dirname(os.path.abspath(fname))
+        wd = _libc.inotify_add_watch(self.fd, directory, IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, "inotify_add_watch failed on {}".format(directory))
+
+    def wait(self, timeout):
+        """
+        Wait until the file changes
+        timeout: maximum time to wait (s)
+        returns: True if the file changed, False on timeout
+        """
+        tstart = time()
+        while True:
+            remaining = timeout - (time() - tstart)
+            if remaining <= 0:
+                return False
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            if not readable:
+                return False
+            # read all pending events, only events of the watched file count
+            data = os.read(self.fd, 65536)
+            offset = 0
+            changed = False
+            while offset + EVENT_HEADER.size <= len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset+length].rstrip('\0')
+                offset += length
+                if name == self.name:
+                    changed = True
+            if changed:
+                return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watcher(fname, method='inotify', poll=0.05):
+    """
+    Create a file watcher
+    fname: file to watch
+    method: inotify or poll. inotify falls back to poll if it is not available
+    poll: interval between checks when polling (s)
+    returns: watcher object with wait(timeout) and close() methods
+    """
+    if method == 'inotify':
+        try:
+            return InotifyWatcher(fname)
+        except OSError as e:
+            print "WARNING: inotify not available ({}), polling instead".format(e)
+    return PollWatcher(fname, poll)
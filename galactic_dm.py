@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+#
+# Milky Way DM lookup with a persistent cache
+# Author: L.C. Oostrum
+
+import os
+import tempfile
+import subprocess
+import threading
+from multiprocessing.pool import ThreadPool
+
+import yaml
+
+
+class GalacticDM(object):
+    """
+    Look up the Milky Way DM towards Galactic coordinates with external models (e.g. YMW16, NE2001).
+    Results are cached on disk per model and quantised (gl, gb), so repeated fields are instant
+    """
+
+    def __init__(self, cache_file, models, resolution=0.01, nworker=8, logger=None):
+        """
+        cache_file: path to YAML cache file
+        models: dict of model name: shell command, with {gl} and {gb} keys. The command should print the DM
+        resolution: size of a cache cell in gl and gb (degrees)
+        nworker: maximum number of model commands to run simultaneously
+        logger: function to log messages with (Default: print)
+        """
+        self.cache_file = cache_file
+        self.models = models
+        self.resolution = resolution
+        self.nworker = nworker
+        if logger is None:
+            self.log = self._log
+        else:
+            self.log = logger
+        self.cache = self.load_cache()
+
+    def _log(self, message):
+        """
+        Log a message. Prints the message
+        """
+        print message
+
+    def load_cache(self):
+        """
+        Load the cache from disk
+        returns: dict of key: DM
+        """
+        try:
+            with open(self.cache_file, 'r') as f:
+                cache = yaml.load(f)
+        except (IOError, yaml.YAMLError):
+            return {}
+        if not isinstance(cache, dict):
+            return {}
+        return cache
+
+    def save_cache(self):
+        """
+        Save the cache to disk. Writes to a temporary file first, so readers never see a partial file.
+        Each call gets its own temporary file, as lookups in several threads can save at the same time
+        """
+        cache_dir = os.path.dirname(self.cache_file)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # copy the cache, other threads may add to it while it is written
+        cache = dict(self.cache)
+        fd, tmp_file = tempfile.mkstemp(prefix=os.path.basename(self.cache_file) + '.', suffix='.tmp',
+                                        dir=cache_dir or '.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                yaml.dump(cache, f, default_flow_style=False)
+            os.rename(tmp_file, self.cache_file)
+        except Exception:
+            os.remove(tmp_file)
+            raise
+
+    def quantise(self, gl, gb):
+        """
+        Round Galactic coordinates to the cache resolution
+        gl, gb: coordinates in degrees
+        returns: quantised gl, gb
+        """
+        gl = round(float(gl) / self.resolution) * self.resolution % 360
+        gb = round(float(gb) / self.resolution) * self.resolution
+        return gl, gb
+
+    def key(self, model, gl, gb):
+        """
+        Cache key of a model at given coordinates
+        """
+        return "{} {:.4f} {:.4f}".format(model, *self.quantise(gl, gb))
+
+    def compute(self, task):
+        """
+        Run a model command
+        task: (model, gl, gb) tuple
+        returns: DM as string, - if the model failed
+        """
+        model, gl, gb = task
+        gl, gb = self.quantise(gl, gb)
+        cmd = self.models[model].format(gl=gl, gb=gb)
+        self.log(cmd)
+        try:
+            dm = subprocess.check_output(cmd, shell=True)
+            return str(float(dm))
+        except (subprocess.CalledProcessError, ValueError):
+            return "-"
+
+    def lookup(self, positions):
+        """
+        Get the DM of every model towards each position
+        positions: list of (gl, gb) tuples in degrees
+        returns: list of dicts of model: DM as string, - if unknown
+        """
+        # find which model/position combinations are not cached yet
+        tasks = []
+        for gl, gb in positions:
+            for model in self.models:
+                key = self.key(model, gl, gb)
+                if key not in self.cache and (model, gl, gb) not in tasks:
+                    tasks.append((model, gl, gb))
+
+        if tasks:
+            nworker = max(1, min(self.nworker, len(tasks)))
+            pool = ThreadPool(nworker)
+            try:
+                dms = pool.map(self.compute, tasks)
+            finally:
+                pool.close()
+                pool.join()
+            for (model, gl, gb), dm in zip(tasks, dms):
+                # failures are not cached so they are tried again next time
+                if not dm == "-":
+                    self.cache[self.key(model, gl, gb)] = dm
+            try:
+                self.save_cache()
+            except (IOError, OSError) as e:
+                self.log("WARNING: Could not save DM cache: {}".format(e))
+
+        results = []
+        for gl, gb in positions:
+            results.append(dict([(model, self.cache.get(self.key(model, gl, gb), "-")) for model in self.models]))
+        return results
+
+    def lookup_async(self, positions):
+        """
+        Get the DMs in a separate thread
+        positions: list of (gl, gb) tuples in degrees
+        returns: thread and dict that holds the output of lookup under 'dms' once the thread is done
+        """
+        result = {'dms': [dict([(model, "-") for model in self.models]) for position in positions]}
+
+        def target():
+            result['dms'] = self.lookup(positions)
+
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        return thread, result
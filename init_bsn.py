@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#
+# Cached init BSN of the correlator
+# The init BSN only changes when the correlator is resynced, so it does not
+# have to be fetched from ccu-corr for every observation
+# Author: L.C. Oostrum
+
+import os
+import sys
+import argparse
+import subprocess
+from time import time
+
+import yaml
+
+CONFIG = "config.yaml"
+# earliest valid sync time (2017-01-01), to catch garbage values
+MIN_SYNC_TIME = 1483228800
+
+
+class InitBSN(object):
+    """
+    Get the init BSN from a local cache, refreshing it from the correlator when it is too old
+    """
+
+    def __init__(self, command, cache_file, validity, time_unit, logger=None):
+        """
+        command: command that prints the init BSN, relative paths are relative to this script
+        cache_file: path to YAML cache file
+        validity: maximum age of the cached value (s)
+        time_unit: BSN increase per second
+        logger: function to log messages with (Default: print)
+        """
+        self.command = os.path.join(os.path.dirname(os.path.realpath(__file__)), command)
+        self.cache_file = cache_file
+        self.validity = validity
+        self.time_unit = time_unit
+        if logger is None:
+            self.log = self._log
+        else:
+            self.log = logger
+
+    def _log(self, message):
+        """
+        Log a message. Prints the message
+        """
+        print message
+
+    def validate(self, init_bsn):
+        """
+        Check whether an init BSN is consistent
+        init_bsn: init BSN (float)
+        returns: error message, None if valid
+        """
+        # init bsn is a multiple of 781250
+        if init_bsn <= 0 or not init_bsn % 781250 == 0:
+            return "init BSN {:.0f} is not a positive multiple of 781250".format(init_bsn)
+        # sync time should be a whole second in the past
+        sync_time = init_bsn / self.time_unit
+        if not sync_time == int(sync_time):
+            return "init BSN {:.0f} does not correspond to a whole second".format(init_bsn)
+        if not MIN_SYNC_TIME <= sync_time <= time():
+            return "init BSN {:.0f} corresponds to invalid sync time {:.0f}".format(init_bsn, sync_time)
+        return None
+
+    def fetch(self):
+        """
+        Get the init BSN from the correlator
+        returns: init BSN (float)
+        """
+        output = subprocess.check_output(self.command).split()
+        # every dish should report the same value
+        values = set(output)
+        if not len(values) == 1:
+            raise ValueError("Expected one init BSN, got: {}".format(' '.join(output)))
+        init_bsn = float(values.pop())
+        error = self.validate(init_bsn)
+        if error is not None:
+            raise ValueError(error)
+        return init_bsn
+
+    def load_cache(self):
+        """
+        Load the cached init BSN
+        returns: dict with init_bsn and fetch time, or None
+        """
+        try:
+            with open(self.cache_file, 'r') as f:
+                cache = yaml.load(f)
+            init_bsn = float(cache['init_bsn'])
+            fetched = float(cache['fetched'])
+        except (IOError, yaml.YAMLError, KeyError, TypeError, ValueError):
+            return None
+        if self.validate(init_bsn) is not None:
+            return None
+        return {'init_bsn': init_bsn, 'fetched': fetched}
+
+    def save_cache(self, init_bsn):
+        """
+        Save the init BSN to the cache
+        """
+        cache_dir = os.path.dirname(self.cache_file)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_file = "{}.{}.tmp".format(self.cache_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            yaml.dump({'init_bsn': int(init_bsn), 'fetched': time()}, f, default_flow_style=False)
+        os.rename(tmp_file, self.cache_file)
+
+    def get(self, refresh=False):
+        """
+        Get the init BSN
+        refresh: always fetch from the correlator, e.g. after a resync. The cached value is then never used,
+                 as it is likely outdated
+        returns: init BSN (float)
+        """
+        cache = self.load_cache()
+        if not refresh and cache is not None and time() - cache['fetched'] < self.validity:
+            return cache['init_bsn']
+
+        try:
+            init_bsn = self.fetch()
+        except (OSError, subprocess.CalledProcessError, ValueError) as e:
+            if cache is None or refresh:
+                raise ValueError("Could not get init bsn from correlator: {}".format(e))
+            # an old value is better than no observation
+            self.log("WARNING: Could not get init bsn from correlator ({}), using cached value "
+                     "from {:.0f} s ago".format(e, time() - cache['fetched']))
+            return cache['init_bsn']
+
+        if cache is not None and not cache['init_bsn'] == init_bsn:
+            self.log("Init BSN changed from {:.0f} to {:.0f}".format(cache['init_bsn'], init_bsn))
+        try:
+            self.save_cache(init_bsn)
+        except (IOError, OSError) as e:
+            self.log("WARNING: Could not save init bsn cache: {}".format(e))
+        return init_bsn
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Get the (cached) init BSN of the correlator")
+    parser.add_argument("--refresh", help="Fetch from the correlator even if the cache is valid "
+                        "(Default: False)", action="store_true")
+    parser.add_argument("--science_case", type=int, help="Science case "
+                        "(Default: 4)", default=4)
+
+    args = parser.parse_args()
+
+    filename = os.path.join(os.path.dirname(os.path.realpath(__file__)), CONFIG)
+    with open(filename, 'r') as f:
+        config = yaml.load(f)
+    conf = config['init_bsn']
+    cache_file = conf['cache_file'].format(home=os.path.expanduser('~'))
+    time_unit = config['sc{:.0f}'.format(args.science_case)]['time_unit']
+
+    try:
+        print "{:.0f}".format(InitBSN(conf['command'], cache_file, conf['validity'], time_unit).get(args.refresh))
+    except ValueError as e:
+        print "ERROR: {}".format(e)
+        sys.exit(1)
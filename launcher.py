@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+#
+# Concurrent start of the node scripts on the ARTS cluster
+# Author: L.C. Oostrum
+
+import os
+import subprocess
+from time import sleep, time
+
+# line printed by start_survey_node.py once all processes are running
+READY_MARKER = "Everything started"
+# line printed by start_survey_node.py if any process failed to start
+FAILED_MARKER = "Failed to start"
+# ssh options: never prompt, reuse one multiplexed connection per node
+SSH_OPTIONS = ["-o", "BatchMode=yes",
+               "-o", "ControlMaster=auto",
+               "-o", "ControlPath=~/.ssh/arts-%r@%h:%p",
+               "-o", "ControlPersist={persist}"]
+
+
+def node_to_hostname(node):
+    """
+    Convert node number to ARTS hostname
+    node: nr of node (string or int)
+    returns: hostname, e.g. arts001
+    """
+    if isinstance(node, str):
+        if len(node) == 1:
+            # assume a leading 0 is missing
+            node = '0'+node
+        elif len(node) > 2:
+            # wrong, should only have 2 digits. Assume extra leading zeros
+            node = node[-2:]
+        return "arts0{}".format(node)
+    else:
+        return "arts0{:02d}".format(node)
+
+
+class NodeLauncher(object):
+    """
+    Start a command on many ARTS nodes at once.
+    Each node is started over a multiplexed ssh connection, its output is written to a log file
+    and the launcher waits until every node reports it is ready
+    """
+
+    def __init__(self, log_dir, timeout=30, persist=600, poll=0.1, logger=None):
+        """
+        log_dir: directory for the ssh output of each node
+        timeout: maximum time to wait for a node to report it is ready (s)
+        persist: how long an idle ssh master connection is kept open (s)
+        poll: interval for checking node output (s)
+        logger: function to log messages with (Default: print)
+        """
+        self.log_dir = log_dir
+        self.timeout = timeout
+        self.persist = persist
+        self.poll = poll
+        if logger is None:
+            self.log = self._log
+        else:
+            self.log = logger
+
+    def _log(self, message):
+        """
+        Log a message. Prints the message
+        """
+        print message
+
+    def ssh_command(self, hostname, command):
+        """
+        Create ssh command as list of arguments
+        hostname: host to run command on
+        command: command to run
+        """
+        options = [opt.format(persist=self.persist) for opt in SSH_OPTIONS]
+        return ["ssh"] + options + [hostname, command]
+
+    def spawn(self, task):
+        """
+        Start command on one node, without waiting for it to be ready
+        task: (beam, node, command) tuple
+        returns: dict with beam, hostname, status, exit code and launch latency,
+                 plus the ssh process and its output file while the node is pending
+        """
+        beam, node, command = task
+        hostname = node_to_hostname(node)
+        logfile = os.path.join(self.log_dir, "launch_CB{:02d}.log".format(beam))
+        result = {'beam': beam, 'hostname': hostname, 'status': 'timeout', 'returncode': None,
+                  'latency': None, 'tstart': time()}
+
+        with open(logfile, 'w') as out:
+            cmd = self.ssh_command(hostname, command)
+            self.log("Executing '{}'".format(' '.join(cmd)))
+            try:
+                # the nodes do not read input, so do not let them share the stdin of the master
+                with open(os.devnull, 'r') as devnull:
+                    result['proc'] = subprocess.Popen(cmd, stdin=devnull, stdout=out, stderr=subprocess.STDOUT)
+            except OSError as e:
+                result['status'] = 'failed'
+                result['latency'] = 0.
+                self.log("ERROR: Could not start ssh to {}: {}".format(hostname, e))
+                return result
+        result['output'] = ''
+        result['file'] = open(logfile, 'r')
+        return result
+
+    def check(self, result):
+        """
+        Check the output of a pending node for the ready marker, or whether ssh exited
+        result: output of spawn, updated in place
+        returns: True if the node is no longer pending
+        """
+        result['output'] += result['file'].read()
+        if READY_MARKER in result['output']:
+            result['status'] = 'ready'
+        elif FAILED_MARKER in result['output']:
+            result['status'] = 'failed'
+        else:
+            returncode = result['proc'].poll()
+            if returncode is None:
+                return False
+            # check for output written just before exit
+            result['output'] += result['file'].read()
+            if READY_MARKER in result['output']:
+                result['status'] = 'ready'
+            else:
+                result['status'] = 'failed'
+            result['returncode'] = returncode
+        result['latency'] = time() - result['tstart']
+        return True
+
+    def start(self, tasks):
+        """
+        Start all tasks and wait until every node is ready, failed or timed out.
+        All nodes are started first, so a slow node does not delay the start of the others
+        tasks: list of (beam, node, command) tuples
+        returns: list of result dicts, sorted by beam
+        """
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+        results = [self.spawn(task) for task in tasks]
+        pending = [result for result in results if 'proc' in result]
+        while pending:
+            for result in pending[:]:
+                if self.check(result):
+                    pending.remove(result)
+                elif time() - result['tstart'] > self.timeout:
+                    result['latency'] = time() - result['tstart']
+                    pending.remove(result)
+            if pending:
+                sleep(self.poll)
+        # ssh keeps running in the background for as long as the node script runs
+        for result in results:
+            if 'file' in result:
+                result['file'].close()
+            for key in ('proc', 'file', 'output', 'tstart'):
+                result.pop(key, None)
+        return sorted(results, key=lambda result: result['beam'])
+
+    def report(self, results):
+        """
+        Log a readiness table of the started nodes
+        results: output of start
+        returns: True if all nodes are ready, else False
+        """
+        self.log("CB   Node     Status   Exit  Latency (s)")
+        for result in results:
+            if result['returncode'] is None:
+                returncode = '-'
+            else:
+                returncode = str(result['returncode'])
+            self.log("{beam:02d}   {hostname}  {status:<7}  {rc:<4}  {latency:.2f}".format(rc=returncode, **result))
+        nready = len([result for result in results if result['status'] == 'ready'])
+        self.log("{} out of {} nodes ready".format(nready, len(results)))
+        return nready == len(results)
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+#
+# Real-time classification of IQUV dump candidates
+# A resident process keeps the Keras model loaded and classifies candidates from the filterbank
+# that is being written, in small batches on the CPU. trigger_IQUV.py asks it through MLGate
+# and falls back to the S/N threshold when no answer arrives in time
+# Author: L.C. Oostrum
+
+import os
+import sys
+import socket
+import argparse
+import threading
+from Queue import Queue, Empty
+from time import time
+
+import numpy as np
+import yaml
+
+CONFIG = "config.yaml"
+# dispersion constant (s MHz^2 / (pc cm^-3))
+DM_CONST = 4148.808
+# interval at which held requests are checked for new data on disk (s)
+HOLD_POLL = 0.05
+
+
+def log(message):
+    """
+    Log a message. Prepends the message with a fixed string
+    """
+    print "ML gate: {}".format(message)
+    sys.stdout.flush()
+
+
+class FilterbankTail(object):
+    """
+    Read data around a candidate from a filterbank that is still being written
+    """
+
+    def __init__(self, fname):
+        """
+        fname: 8-bit sigproc filterbank file
+        """
+        from sigpyproc.Readers import FilReader
+        hdr = FilReader(fname).header
+        if not hdr.nbits == 8:
+            raise ValueError("Only 8-bit filterbanks are supported, {} has {} bits".format(fname, hdr.nbits))
+        self.fname = fname
+        self.hdrlen = hdr.hdrlen
+        self.nchan = hdr.nchans
+        self.tsamp = hdr.tsamp
+        self.freqs = hdr.fch1 + hdr.foff * np.arange(hdr.nchans)
+
+    def nsamp(self):
+        """
+        Nr of complete samples on disk
+        """
+        return (os.path.getsize(self.fname) - self.hdrlen) // self.nchan
+
+    def extent(self, t, DM, width, ntime):
+        """
+        Get the range of samples needed for a candidate
+        t: arrival time at the highest frequency (s since start of file)
+        DM: dispersion measure (pc cm^-3)
+        width: pulse width (s)
+        ntime: nr of output samples
+        returns: downsampling factor, channel delays (samples), first sample, end sample
+        """
+        # downsample to about the pulse width
+        ds = max(1, int(round(width / self.tsamp)))
+        delays = np.round(DM_CONST * DM * (self.freqs**-2 - self.freqs.max()**-2) / self.tsamp).astype(int)
+        start = int(t / self.tsamp) - ntime * ds // 2
+        end = start + ntime * ds + delays.max()
+        return ds, delays, start, end
+
+    def on_disk(self, t, DM, width, ntime):
+        """
+        Check whether the data of a candidate has been written yet
+        t: arrival time at the highest frequency (s since start of file)
+        DM: dispersion measure (pc cm^-3)
+        width: pulse width (s)
+        ntime: nr of output samples
+        returns: True if all samples are on disk
+        """
+        return self.extent(t, DM, width, ntime)[3] <= self.nsamp()
+
+    def freq_time(self, t, DM, width, nfreq, ntime):
+        """
+        Get the dedispersed frequency-time data of a candidate
+        t: arrival time at the highest frequency (s since start of file)
+        DM: dispersion measure (pc cm^-3)
+        width: pulse width (s)
+        nfreq: nr of output subbands
+        ntime: nr of output samples
+        returns: array of shape (nfreq, ntime), normalised
+        """
+        ds, delays, start, end = self.extent(t, DM, width, ntime)
+        nsamp = ntime * ds
+        if start < 0 or end > self.nsamp():
+            raise IndexError("Data of candidate at t={:.2f} is not available".format(t))
+        with open(self.fname, 'rb') as f:
+            f.seek(self.hdrlen + start * self.nchan)
+            data = np.fromfile(f, dtype=np.uint8, count=(end - start) * self.nchan).reshape(-1, self.nchan)
+        # shift each channel by its delay
+        data = data[np.arange(nsamp)[:, None] + delays[None, :], np.arange(self.nchan)[None, :]].astype(np.float32)
+        data = data.reshape(ntime, ds, nfreq, self.nchan // nfreq).mean(axis=(1, 3)).T
+        data -= np.median(data)
+        std = data.std()
+        if std > 0:
+            data /= std
+        return data
+
+
+class ClassifierServer(object):
+    """
+    Resident classifier: keeps the model in memory and classifies requests in small batches
+    """
+
+    def __init__(self, model_file, filfile, port, batch_size=32, batch_wait=0.01, logger=log):
+        """
+        model_file: Keras frequency-time model
+        filfile: filterbank the candidates are taken from
+        port: port to listen on (localhost only)
+        batch_size: maximum nr of candidates per batch
+        batch_wait: time to wait for more candidates after the first of a batch (s)
+        logger: function to log messages with (Default: log)
+        """
+        self.log = logger
+        # run on CPU, the GPUs are used by AMBER
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+        from keras.models import load_model
+        self.model = load_model(model_file)
+        self.nfreq, self.ntime = self.model.input_shape[1:3]
+        self.log("Loaded {} with input shape {}".format(model_file, self.model.input_shape))
+        self.filfile = filfile
+        self.fil = None
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.requests = Queue()
+        # requests whose data is not on disk yet
+        self.held = []
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('localhost', port))
+        self.server.listen(5)
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+
+    def accept(self):
+        """
+        Accept connections, each is read by its own thread
+        """
+        while True:
+            conn, addr = self.server.accept()
+            thread = threading.Thread(target=self.handle, args=(conn, ))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        """
+        Read requests from one connection: CLASSIFY id time DM width [budget]
+        A request is answered within the budget of the client (Default: 0, answer immediately), data that is
+        not on disk yet is waited for until then
+        """
+        lock = threading.Lock()
+        for line in conn.makefile('r'):
+            cols = line.split()
+            if len(cols) not in (5, 6) or not cols[0] == 'CLASSIFY':
+                continue
+            budget = float(cols[5]) if len(cols) == 6 else 0
+            self.requests.put((conn, lock, cols[1], float(cols[2]), float(cols[3]), float(cols[4]),
+                               time() + budget))
+        conn.close()
+
+    def classify(self, batch):
+        """
+        Classify a batch of requests
+        batch: list of requests
+        returns: list of probabilities, -1 where the data could not be read, None where the data is not
+                 on disk yet
+        """
+        if self.fil is None:
+            # the filterbank header is only complete once the observation has started
+            if not os.path.isfile(self.filfile):
+                return [None] * len(batch)
+            self.fil = FilterbankTail(self.filfile)
+        probs = [-1.] * len(batch)
+        data = []
+        valid = []
+        for ind, (conn, lock, cand_id, t, DM, width, expiry) in enumerate(batch):
+            if not self.fil.on_disk(t, DM, width, self.ntime):
+                probs[ind] = None
+                continue
+            try:
+                data.append(self.fil.freq_time(t, DM, width, self.nfreq, self.ntime))
+                valid.append(ind)
+            except IndexError as e:
+                self.log("WARNING: {}".format(e))
+        if valid:
+            # probability of the astrophysical class
+            for ind, p in zip(valid, self.model.predict(np.array(data)[..., None])[:, 1]):
+                probs[ind] = p
+        return probs
+
+    def next_batch(self):
+        """
+        Get the held requests and the new requests that arrive within the batch wait time
+        returns: list of requests, empty if nothing arrived and nothing is held
+        """
+        batch = self.held
+        self.held = []
+        try:
+            # without held requests, there is nothing to do until a new request arrives
+            if batch:
+                batch.append(self.requests.get(timeout=HOLD_POLL))
+            else:
+                batch.append(self.requests.get())
+        except Empty:
+            return batch
+        deadline = time() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def run(self):
+        """
+        Classify requests as they come in. Requests whose data is not on disk yet are held until it is,
+        or until the budget of the client runs out
+        """
+        while True:
+            batch = self.next_batch()
+            if not batch:
+                continue
+            try:
+                probs = self.classify(batch)
+            except Exception as e:
+                self.log("ERROR: classification failed: {}".format(e))
+                probs = [-1.] * len(batch)
+            now = time()
+            for request, p in zip(batch, probs):
+                conn, lock, cand_id, t, DM, width, expiry = request
+                if p is None:
+                    if now < expiry:
+                        self.held.append(request)
+                        continue
+                    self.log("WARNING: Data of candidate at t={:.2f} not on disk within the budget".format(t))
+                    p = -1
+                with lock:
+                    try:
+                        conn.sendall("RESULT {} {:.4f}\n".format(cand_id, p))
+                    except socket.error:
+                        pass
+
+
+class MLGate(object):
+    """
+    Ask the resident classifier about candidates, within a latency budget
+    """
+
+    def __init__(self, host, port, budget=0.5, reconnect=10.):
+        """
+        host: classifier host
+        port: classifier port
+        budget: maximum time to wait for the classifier (s)
+        reconnect: minimum time between connection attempts (s)
+        """
+        self.host = host
+        self.port = port
+        self.budget = budget
+        self.reconnect = reconnect
+        self.sock = None
+        self.buffer = ''
+        self.last_attempt = 0
+        self.nextid = 0
+
+    def connect(self):
+        """
+        Connect to the classifier
+        returns: True if connected
+        """
+        if self.sock is not None:
+            return True
+        if time() - self.last_attempt < self.reconnect:
+            return False
+        self.last_attempt = time()
+        try:
+            self.sock = socket.create_connection((self.host, self.port), timeout=self.budget)
+        except socket.error as e:
+            print "WARNING: ML gate not available ({}), using S/N threshold only".format(e)
+            self.sock = None
+            return False
+        self.buffer = ''
+        return True
+
+    def disconnect(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def classify(self, times, DMs, widths):
+        """
+        Get the probability that candidates are astrophysical
+        times: arrival times (s since start of observation)
+        DMs: dispersion measures
+        widths: pulse widths (s)
+        returns: list of probabilities, None where no valid answer arrived within the budget
+        """
+        deadline = time() + self.budget
+        ids = range(self.nextid, self.nextid + len(times))
+        self.nextid += len(ids)
+        results = dict([(cand_id, None) for cand_id in ids])
+        if not self.connect():
+            return [None] * len(ids)
+        try:
+            # the classifier holds requests whose data is not on disk yet for the rest of the budget
+            budget = max(deadline - time(), 0)
+            self.sock.sendall(''.join(["CLASSIFY {} {!r} {!r} {!r} {!r}\n".format(cand_id, float(t), float(DM),
+                                                                                   float(width), budget)
+                                       for cand_id, t, DM, width in zip(ids, times, DMs, widths)]))
+            nresult = 0
+            while nresult < len(ids):
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                self.sock.settimeout(remaining)
+                data = self.sock.recv(4096)
+                if not data:
+                    raise socket.error("connection closed by classifier")
+                self.buffer += data
+                lines = self.buffer.split('\n')
+                self.buffer = lines.pop()
+                for line in lines:
+                    cols = line.split()
+                    # answers to earlier, timed out requests are ignored
+                    if len(cols) == 3 and int(cols[1]) in results:
+                        p = float(cols[2])
+                        results[int(cols[1])] = p if p >= 0 else None
+                        nresult += 1
+        except socket.timeout:
+            pass
+        except socket.error as e:
+            print "WARNING: lost connection to ML gate ({})".format(e)
+            self.disconnect()
+        return [results[cand_id] for cand_id in ids]
+
+
+if __name__ == '__main__':
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), CONFIG), 'r') as f:
+        conf = yaml.load(f)['ml_gate']
+
+    parser = argparse.ArgumentParser(description="Resident classifier for IQUV dump candidates")
+    parser.add_argument("--filfile", type=str, help="Filterbank file of this CB", required=True)
+    parser.add_argument("--port", type=int, help="Port to listen on (Default: {})".format(conf['port']),
+                        default=conf['port'])
+
+    args = parser.parse_args()
+
+    model_file = os.path.join(conf['modeldir'].format(home=os.path.expanduser('~')), conf['model'])
+    server = ClassifierServer(model_file, args.filfile, args.port, conf['batch_size'], conf['batch_wait'])
+    server.run()
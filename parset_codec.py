@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#
+# Encode and decode the parset stored in the PSRDADA header
+# The codec is stored in the PARSET_CODEC header key
+# Author: L.C. Oostrum
+
+import os
+import bz2
+import zlib
+import base64
+import hashlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# maximum length of the encoded parset in the header
+MAX_LENGTH = 24575
+# codec used before the PARSET_CODEC key existed
+LEGACY_CODEC = 'bz2hex'
+
+
+def _encode_lzma(data):
+    if lzma is None:
+        raise ValueError("lzma codec requires the lzma module (backports.lzma on python 2)")
+    return base64.b64encode(lzma.compress(data, preset=9))
+
+
+def _decode_lzma(data):
+    if lzma is None:
+        raise ValueError("lzma codec requires the lzma module (backports.lzma on python 2)")
+    return lzma.decompress(base64.b64decode(data))
+
+
+# codec name: (encode, decode)
+CODECS = {'bz2hex': (lambda data: bz2.compress(data).encode('hex'),
+                     lambda data: bz2.decompress(data.decode('hex'))),
+          'bz2': (lambda data: base64.b64encode(bz2.compress(data)),
+                  lambda data: bz2.decompress(base64.b64decode(data))),
+          'zlib': (lambda data: base64.b64encode(zlib.compress(data, 9)),
+                   lambda data: zlib.decompress(base64.b64decode(data))),
+          'lzma': (_encode_lzma, _decode_lzma)}
+# stores the parset on shared storage and only puts the path in the header
+REF_CODEC = 'ref'
+
+
+def parset_hash(parset):
+    """
+    Content hash of a parset
+    """
+    return hashlib.sha256(parset).hexdigest()
+
+
+def encode(parset, codec, store_dir=None):
+    """
+    Encode a parset for the PSRDADA header
+    parset: parset contents
+    codec: one of CODECS or 'ref'
+    store_dir: directory on shared storage to save the parset to (ref codec only)
+    returns: encoded parset
+    """
+    if codec == REF_CODEC:
+        if not store_dir:
+            raise ValueError("ref codec requires a parset store directory")
+        # file name is the content hash, so identical parsets are only stored once
+        path = os.path.join(store_dir, "{}.parset".format(parset_hash(parset)))
+        if not os.path.isfile(path):
+            if not os.path.isdir(store_dir):
+                os.makedirs(store_dir)
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                f.write(parset)
+            os.rename(tmp_path, path)
+        return path
+    try:
+        encoder = CODECS[codec][0]
+    except KeyError:
+        raise ValueError("Unknown parset codec: {}. Valid codecs are: {}".format(
+                         codec, ', '.join(sorted(CODECS.keys() + [REF_CODEC]))))
+    return encoder(parset)
+
+
+def decode(data, codec=LEGACY_CODEC):
+    """
+    Decode a parset from the PSRDADA header
+    data: value of the PARSET header key
+    codec: value of the PARSET_CODEC header key
+    returns: parset contents
+    """
+    if codec == REF_CODEC:
+        with open(data, 'r') as f:
+            parset = f.read()
+        # file name is the content hash
+        expected = os.path.splitext(os.path.basename(data))[0]
+        if not parset_hash(parset) == expected:
+            raise ValueError("Parset {} does not match its hash".format(data))
+        return parset
+    try:
+        decoder = CODECS[codec][1]
+    except KeyError:
+        raise ValueError("Unknown parset codec: {}".format(codec))
+    return decoder(data)
@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+#
+# CPU and memory placement of the observation components on a node
+# Reads the CPU, NUMA and PCI topology from sysfs, so it can be tested against a captured copy
+# Author: L.C. Oostrum
+
+import os
+import glob
+import shutil
+import argparse
+
+import yaml
+
+from ringbuffer_sizing import MODE_READERS
+
+CONFIG = "config.yaml"
+AMBERCONFIG = "amber.yaml"
+# PCI classes of GPUs: VGA controller, 3D controller
+GPU_CLASSES = ('0x0300', '0x0302')
+# PCI vendor id of the GPUs AMBER runs on (NVIDIA), onboard VGA of the BMC has a different vendor
+GPU_VENDOR = '0x10de'
+# device each component should be close to, AMBER instances are close to their GPU
+COMPONENT_DEVICES = {'fill_ringbuffer': 'network',
+                     'dada_db': 'network',
+                     'dada_dbscrubber': 'network',
+                     'dada_dbdisk': 'disk',
+                     'dadafits': 'disk',
+                     'dadafilterbank': 'disk'}
+# order in which components get their cores
+PRIORITY = ['fill_ringbuffer', 'amber', 'dada_dbdisk', 'dadafits', 'dadafilterbank', 'dada_dbscrubber']
+# components that exit right after starting, these do not need a core of their own
+SHORT_LIVED = ['dada_db']
+# transparent huge page modes that also apply to the SysV shared memory of the ringbuffer
+THP_SHMEM_MODES = ('always', 'within_size', 'force')
+
+
+def parse_cpulist(text):
+    """
+    Parse a Linux cpu list
+    text: cpu list, e.g. 0-9,20-29
+    returns: list of cpus
+    """
+    cpus = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last)+1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpulist(cpus):
+    """
+    Create a Linux cpu list, as accepted by taskset and numactl
+    cpus: list of cpus
+    returns: cpu list, e.g. 0-9,20-29
+    """
+    parts = []
+    for cpu in sorted(set(cpus)):
+        if parts and parts[-1][1] == cpu - 1:
+            parts[-1][1] = cpu
+        else:
+            parts.append([cpu, cpu])
+    return ','.join([str(first) if first == last else "{}-{}".format(first, last) for first, last in parts])
+
+
+def amber_components(opencl_devices):
+    """
+    Get the AMBER components and their devices
+    opencl_devices: OpenCL device of each AMBER instance
+    returns: dict of component: device
+    """
+    return dict([('amber_{}'.format(ind+1), 'gpu{}'.format(device)) for ind, device in enumerate(opencl_devices)])
+
+
+def obs_components(obs_mode, opencl_devices):
+    """
+    Get the components of an observation and their devices
+    obs_mode: observation mode
+    opencl_devices: OpenCL device of each AMBER instance
+    returns: dict of component: device
+    """
+    components = {'fill_ringbuffer': COMPONENT_DEVICES['fill_ringbuffer'], 'dada_db': COMPONENT_DEVICES['dada_db']}
+    for reader in MODE_READERS[obs_mode]:
+        if not reader.startswith('amber'):
+            components[reader] = COMPONENT_DEVICES[reader]
+    if obs_mode in ('amber', 'survey'):
+        components.update(amber_components(opencl_devices))
+    return components
+
+
+class Topology(object):
+    """
+    CPU, NUMA and device topology of a node, as read from sysfs
+    """
+
+    def __init__(self, sysfs='/sys', gpu_vendor=GPU_VENDOR):
+        """
+        sysfs: root of sysfs, or of a captured copy
+        gpu_vendor: PCI vendor id of the GPUs used through OpenCL
+        """
+        self.sysfs = sysfs
+        # NUMA node: cpus
+        self.numa_nodes = {}
+        for path in glob.glob(os.path.join(sysfs, 'devices/system/node/node*/cpulist')):
+            node = int(os.path.basename(os.path.dirname(path))[4:])
+            with open(path) as f:
+                self.numa_nodes[node] = parse_cpulist(f.read())
+        # cpu: physical core, as the lowest cpu sharing the core
+        self.cores = {}
+        for path in glob.glob(os.path.join(sysfs, 'devices/system/cpu/cpu[0-9]*/topology/thread_siblings_list')):
+            cpu = int(os.path.basename(os.path.dirname(os.path.dirname(path)))[3:])
+            with open(path) as f:
+                self.cores[cpu] = min(parse_cpulist(f.read()))
+        if not self.numa_nodes:
+            # kernel without NUMA support: all cpus on one node
+            self.numa_nodes[0] = sorted(self.cores.keys())
+        # GPUs of the OpenCL vendor in PCI bus order, which is the order the NVIDIA OpenCL platform
+        # enumerates identical devices in. PCI addresses are zero-padded, so they sort in bus order
+        self.gpus = []
+        for path in sorted(glob.glob(os.path.join(sysfs, 'bus/pci/devices/*'))):
+            try:
+                with open(os.path.join(path, 'class')) as f:
+                    pci_class = f.read().strip()
+                with open(os.path.join(path, 'vendor')) as f:
+                    vendor = f.read().strip()
+            except IOError:
+                continue
+            if pci_class[:6] in GPU_CLASSES and vendor == gpu_vendor:
+                self.gpus.append(path)
+
+    def cpu_node(self, cpu):
+        """
+        NUMA node of a cpu, None if the cpu does not exist
+        """
+        for node, cpus in self.numa_nodes.items():
+            if cpu in cpus:
+                return node
+        return None
+
+    def device_node(self, path):
+        """
+        NUMA node of a device, found by walking up its sysfs path to the PCI device
+        path: sysfs path of the device
+        returns: NUMA node, None if unknown
+        """
+        path = os.path.realpath(path)
+        root = os.path.realpath(self.sysfs)
+        while path.startswith(root) and not path == root:
+            try:
+                with open(os.path.join(path, 'numa_node')) as f:
+                    node = int(f.read())
+                # -1 means the platform does not tell
+                return node if node >= 0 else None
+            except (IOError, ValueError):
+                path = os.path.dirname(path)
+        return None
+
+    def resolve(self, name, conf):
+        """
+        NUMA node of a device from the placement config
+        name: network, disk, or gpuN
+        conf: placement section of config.yaml
+        returns: NUMA node, None if unknown
+        """
+        if name.startswith('gpu'):
+            index = int(name[3:])
+            if index < len(self.gpus):
+                return self.device_node(self.gpus[index])
+            return None
+        device = conf['devices'][name]
+        node = None
+        if device['name']:
+            if name == 'network':
+                node = self.device_node(os.path.join(self.sysfs, 'class/net', device['name']))
+            else:
+                node = self.device_node(os.path.join(self.sysfs, 'block', device['name']))
+        if node is None:
+            node = device['numa']
+        return node
+
+    def free_memory(self, node):
+        """
+        Free memory of a NUMA node in bytes, None if unknown
+        """
+        try:
+            with open(os.path.join(self.sysfs, 'devices/system/node/node{}/meminfo'.format(node))) as f:
+                for line in f:
+                    if 'MemFree:' in line:
+                        return int(line.split()[-2]) * 1024
+        except IOError:
+            pass
+        return None
+
+    def thp_shmem(self):
+        """
+        Transparent huge page mode of shared memory, None if unknown
+        """
+        try:
+            with open(os.path.join(self.sysfs, 'kernel/mm/transparent_hugepage/shmem_enabled')) as f:
+                modes = f.read().split()
+        except IOError:
+            return None
+        for mode in modes:
+            if mode.startswith('['):
+                return mode.strip('[]')
+        return None
+
+
+class Placement(object):
+    """
+    Assign cpus and memory nodes to the components of an observation
+    """
+
+    def __init__(self, topology, components, conf):
+        """
+        topology: Topology of the node
+        components: dict of component: device
+        conf: placement section of config.yaml
+        """
+        self.topology = topology
+        self.components = components
+        self.conf = conf
+        self.nodes = dict([(device, topology.resolve(device, conf)) for device in set(components.values())])
+
+    def node(self, component):
+        """
+        NUMA node a component should run on, None if unknown
+        """
+        return self.nodes[self.components[component]]
+
+    def ordered(self):
+        """
+        Components in the order in which they get cores
+        """
+        def priority(component):
+            for ind, prefix in enumerate(PRIORITY):
+                if component.startswith(prefix):
+                    return ind, component
+            return len(PRIORITY), component
+        return sorted([component for component in self.components if component not in SHORT_LIVED], key=priority)
+
+    def plan(self):
+        """
+        Give every component dedicated physical cores on the NUMA node of its device.
+        Only one cpu of each core is used, so components never share a core through hyperthreading.
+        Cores are only shared when there are not enough, check reports this
+        returns: dict of component: list of cpus
+        """
+        reserved = set(self.conf['reserved'])
+        # one cpu per physical core
+        cores = sorted(set([core for cpu, core in self.topology.cores.items()
+                            if core not in reserved and cpu not in reserved]))
+        if not cores:
+            cores = sorted(set(self.topology.cores.values()))
+        usage = dict([(core, 0) for core in cores])
+        assignment = {}
+        for component in self.ordered():
+            ncpu = min(self.conf['threads'].get(component, 1), len(cores))
+            node = self.node(component)
+            # least used cores first, then cores on the NUMA node of the device
+            cpus = sorted(cores, key=lambda core: (usage[core], not self.topology.cpu_node(core) == node,
+                                                   core))[:ncpu]
+            for core in cpus:
+                usage[core] += 1
+            assignment[component] = sorted(cpus)
+        # short-lived components can run on any cpu of their NUMA node
+        for component in self.components:
+            if component in SHORT_LIVED:
+                node = self.node(component)
+                assignment[component] = self.topology.numa_nodes.get(node, sorted(self.topology.cores.keys()))
+        return assignment
+
+    def from_affinity(self, affinity):
+        """
+        Get the assignment of the fixed affinity section of config.yaml
+        affinity: affinity section of config.yaml
+        returns: dict of component: list of cpus
+        """
+        assignment = {}
+        for component in self.components:
+            if component.startswith('amber_'):
+                cpus = [affinity['amber'][int(component[6:])-1]]
+            elif component in ('fill_ringbuffer', 'dada_db', 'dada_dbdisk'):
+                cpus = [affinity['{}_i'.format(component)]]
+            elif component in affinity:
+                cpus = [affinity[component]]
+            else:
+                continue
+            assignment[component] = cpus
+        return assignment
+
+    def check(self, assignment, threads=None):
+        """
+        Find placement problems
+        assignment: dict of component: list of cpus
+        threads: dict of component: nr of threads, if different from nr of cpus
+        returns: list of warnings
+        """
+        warnings = []
+        threads = threads or {}
+        users = {}
+        for component in sorted(assignment):
+            cpus = assignment[component]
+            for cpu in cpus:
+                if cpu not in self.topology.cores:
+                    warnings.append("{} is assigned to cpu {}, which does not exist".format(component, cpu))
+                elif component not in SHORT_LIVED:
+                    users.setdefault(self.topology.cores[cpu], []).append(component)
+            expected = self.node(component)
+            nodes = set([self.topology.cpu_node(cpu) for cpu in cpus])
+            if expected is not None and None not in nodes and not nodes == set([expected]):
+                warnings.append("{} runs on NUMA node {}, but its {} is on NUMA node {}".format(
+                                component, ','.join([str(node) for node in sorted(nodes)]),
+                                self.components[component], expected))
+            if threads.get(component, len(cpus)) > len(cpus):
+                warnings.append("{} runs {} threads on {} cpu(s)".format(component, threads[component], len(cpus)))
+        for core in sorted(users):
+            if len(users[core]) > 1:
+                warnings.append("{} share core {}".format(' and '.join(users[core]), core))
+        return warnings
+
+    def check_ringbuffer(self, size):
+        """
+        Check whether the ringbuffer fits in the memory of its NUMA node and can use huge pages
+        size: size of the ringbuffer (bytes)
+        returns: list of warnings
+        """
+        warnings = []
+        node = self.node('dada_db')
+        free = self.topology.free_memory(node)
+        if free is not None and size > free:
+            warnings.append("Ringbuffer of {:.1f} GB does not fit in the {:.1f} GB free on NUMA node {}".format(
+                            size / 1024.**3, free / 1024.**3, node))
+        if self.conf['hugepages']:
+            mode = self.topology.thp_shmem()
+            if mode not in THP_SHMEM_MODES:
+                warnings.append("Huge pages requested, but transparent huge pages for shared memory are {}. "
+                                "Set {} to always (as root)".format(mode, 'kernel/mm/transparent_hugepage/'
+                                                                          'shmem_enabled'))
+        return warnings
+
+
+def capture(sysfs, output_dir):
+    """
+    Copy the parts of sysfs used by Topology, to test placement on another machine
+    sysfs: root of sysfs
+    output_dir: directory to create the copy in
+    """
+    def copy(relpath):
+        src = os.path.join(sysfs, relpath)
+        dest = os.path.join(output_dir, relpath)
+        if not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        try:
+            shutil.copyfile(src, dest)
+        except IOError:
+            pass
+
+    def link(relpath):
+        # recreate a symlink and copy the numa_node files along the path it points to
+        src = os.path.join(sysfs, relpath)
+        dest = os.path.join(output_dir, relpath)
+        if not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        if not os.path.lexists(dest):
+            os.symlink(os.readlink(src), dest)
+        target = os.path.relpath(os.path.realpath(src), os.path.realpath(sysfs))
+        if not os.path.isdir(os.path.join(output_dir, target)):
+            os.makedirs(os.path.join(output_dir, target))
+        while target and not target == os.curdir:
+            copy(os.path.join(target, 'numa_node'))
+            copy(os.path.join(target, 'class'))
+            copy(os.path.join(target, 'vendor'))
+            target = os.path.dirname(target)
+
+    for pattern in ['devices/system/node/node*/cpulist', 'devices/system/node/node*/meminfo',
+                    'devices/system/cpu/cpu[0-9]*/topology/thread_siblings_list',
+                    'kernel/mm/transparent_hugepage/shmem_enabled']:
+        for path in glob.glob(os.path.join(sysfs, pattern)):
+            copy(os.path.relpath(path, sysfs))
+    for pattern in ['bus/pci/devices/*', 'class/net/*', 'block/*']:
+        for path in glob.glob(os.path.join(sysfs, pattern)):
+            link(os.path.relpath(path, sysfs))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Show the cpu and memory placement of an observation")
+    parser.add_argument("--sysfs", type=str, help="Root of sysfs or a captured copy (Default: /sys)",
+                        default="/sys")
+    parser.add_argument("--obs_mode", type=str, help="Observation mode (Default: survey)", default="survey")
+    parser.add_argument("--amber_mode", type=str, help="AMBER dedispersion mode (Default: subband)",
+                        default="subband")
+    parser.add_argument("--capture", type=str, help="Copy the relevant parts of sysfs to this directory "
+                        "and exit")
+
+    args = parser.parse_args()
+
+    if args.capture:
+        capture(args.sysfs, args.capture)
+        exit()
+
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    with open(os.path.join(script_dir, CONFIG), 'r') as f:
+        config = yaml.load(f)
+    with open(os.path.join(script_dir, AMBERCONFIG), 'r') as f:
+        amber_config = yaml.load(f)
+
+    components = obs_components(args.obs_mode, amber_config[args.amber_mode]['opencl_device'])
+
+    topology = Topology(args.sysfs, config['placement']['gpu_vendor'])
+    placement = Placement(topology, components, config['placement'])
+    print "GPUs in OpenCL device order:"
+    for ind, path in enumerate(topology.gpus):
+        print "  gpu{} {} NUMA node {}".format(ind, os.path.basename(path), topology.device_node(path))
+    print "Fixed affinity:"
+    fixed = placement.from_affinity(config['affinity'])
+    for component in sorted(fixed):
+        print "  {:<16s} {}".format(component, format_cpulist(fixed[component]))
+    for warning in placement.check(fixed, threads={'dadafilterbank': 40}):
+        print "  WARNING: {}".format(warning)
+    print "Planned:"
+    planned = placement.plan()
+    for component in sorted(planned):
+        print "  {:<16s} {:<10s} NUMA node {}".format(component, format_cpulist(planned[component]),
+                                                       placement.node(component))
+    for warning in placement.check(planned):
+        print "  WARNING: {}".format(warning)
@@ -9,6 +9,7 @@ SOURCE_DIR=$(cd $(dirname ${BASH_SOURCE[0]}) && pwd)
 triggerscript=$SOURCE_DIR/external/arts-analysis/triggers.py
 classifier=$SOURCE_DIR/external/single_pulse_ml/single_pulse_ml/classify.py
 trigger_to_master=$SOURCE_DIR/trigger_to_master.py
+merge_steps=$SOURCE_DIR/amber_triggers.py
 # python venv location
 venv_dir=$HOME/python34
 
@@ -31,21 +32,31 @@ master_dir=$4
 snrmin=$5
 CB=$6
 time_limit=$7
+# optional: only process the triggers of this time window
+window=$8
 
 # Set GPUs visible to the classifier
 export CUDA_VISIBLE_DEVICES=$ML_GPUs
 
-# create master trigger files
-cat ${prefix}_step*trigger > ${prefix}.trigger
+if [ -z "$window" ]; then
+    # create master trigger file, sorted by arrival time and without duplicates between steps
+    trigger_file=${prefix}.trigger
+    python $merge_steps --prefix $prefix --output $trigger_file
+else
+    # window trigger file is created by the node script, each window has its own output dir
+    trigger_file=$(printf "%s_window%03d.trigger" $prefix $window)
+    outputdir=$(printf "%s/window%03d" $outputdir $window)
+    mkdir -p $outputdir/data $outputdir/plots
+fi
 # get number of raw candidates
-ncand_raw=$(grep -v \# ${prefix}.trigger | wc -l)
+ncand_raw=$(grep -v \# $trigger_file | wc -l)
 
 # make sure we start clean
 rm -f $outputdir/data/*
 rm -f $outputdir/plots/*pdf
 cd $outputdir
 # process the triggers without making plots
-python $triggerscript --sig_thresh_local $snrmin_local --time_limit $time_limit --descending_snr --beamno $CB --mk_plot --dm_min $dmmin --dm_max $dmmax --sig_thresh $snrmin --ndm $ndm --save_data $fmt --nfreq_plot $nfreq_plot --ntime_plot $ntime_plot --cmap $cmap --outdir=$outputdir $filfile ${prefix}.trigger
+python $triggerscript --sig_thresh_local $snrmin_local --time_limit $time_limit --descending_snr --beamno $CB --mk_plot --dm_min $dmmin --dm_max $dmmax --sig_thresh $snrmin --ndm $ndm --save_data $fmt --nfreq_plot $nfreq_plot --ntime_plot $ntime_plot --cmap $cmap --outdir=$outputdir $filfile $trigger_file
 
 # get number of triggers after grouping
 if [ ! -f grouped_pulses.singlepulse ]; then
@@ -66,4 +77,4 @@ else
     fi
 fi
 # copy results to masternode
-python $trigger_to_master ranked_CB${CB}_freq_time.hdf5 $ncand_raw $ncand_grouped $master_dir
+python $trigger_to_master ranked_CB${CB}_freq_time.hdf5 $ncand_raw $ncand_grouped $master_dir $window
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+#
+# Collect the trigger results of all nodes on the master node
+# Each node sends its result files in one framed message. The collector writes them to the results dir
+# of the observation and tracks which beams have arrived, so the emailer can start as soon as the last
+# beam is in instead of polling the file system
+# Author: L.C. Oostrum
+
+import os
+import sys
+import struct
+import shutil
+import socket
+import argparse
+import threading
+from time import sleep, time
+
+import yaml
+
+CONFIG = "config.yaml"
+# message types
+BUNDLE = "ARTSRC1\n"
+WAIT = "ARTSRW1\n"
+# bundle header: beam, nr of files, length of results dir
+BUNDLE_HEADER = struct.Struct("<III")
+# file header: length of name, length of data
+FILE_HEADER = struct.Struct("<IQ")
+# wait request: timeout, length of yaml payload
+WAIT_HEADER = struct.Struct("<dI")
+# file whose arrival marks a beam as done when results are copied instead of sent
+SUMMARY_FILE = "CB{beam:02d}_summary.yaml"
+
+
+def log(message):
+    """
+    Log a message. Prepends the message with a fixed string
+    """
+    print "Result collector: {}".format(message)
+    sys.stdout.flush()
+
+
+def recv_exact(sock, nbyte):
+    """
+    Receive an exact nr of bytes
+    sock: socket
+    nbyte: nr of bytes
+    returns: data
+    """
+    chunks = []
+    while nbyte > 0:
+        chunk = sock.recv(min(nbyte, 1 << 20))
+        if not chunk:
+            raise socket.error("connection closed")
+        chunks.append(chunk)
+        nbyte -= len(chunk)
+    return ''.join(chunks)
+
+
+def pack_bundle(master_dir, beam, files):
+    """
+    Create a result bundle
+    master_dir: results dir of the observation on the master node
+    beam: CB index
+    files: list of paths of result files
+    returns: message
+    """
+    parts = [BUNDLE, BUNDLE_HEADER.pack(beam, len(files), len(master_dir)), master_dir]
+    for fname in files:
+        with open(fname, 'rb') as f:
+            data = f.read()
+        name = os.path.basename(fname)
+        parts.extend([FILE_HEADER.pack(len(name), len(data)), name, data])
+    return ''.join(parts)
+
+
+def send_results(host, port, master_dir, beam, files, timeout=60):
+    """
+    Send the result files of a beam to the collector
+    host: collector host
+    port: collector port
+    master_dir: results dir of the observation on the master node
+    beam: CB index
+    files: list of paths of result files
+    timeout: time to keep trying (s)
+    returns: True if the collector confirmed the arrival
+    """
+    message = pack_bundle(master_dir, beam, files)
+    tstart = time()
+    while True:
+        try:
+            sock = socket.create_connection((host, port), timeout=timeout)
+            try:
+                sock.sendall(message)
+                return recv_exact(sock, 3) == "OK\n"
+            finally:
+                sock.close()
+        except socket.error as e:
+            if time() - tstart > timeout:
+                print "WARNING: could not send results to {}:{} ({})".format(host, port, e)
+                return False
+            sleep(1)
+
+
+def deliver(conf, master_dir, beam, files):
+    """
+    Send result files to the collector, or copy them to the results dir if the collector cannot be reached
+    conf: result_collector settings
+    master_dir: results dir of the observation on the master node
+    beam: CB index
+    files: list of paths of result files, the summary file last
+    returns: True if the files were sent to the collector
+    """
+    if send_results(conf['host'], conf['port'], master_dir, beam, files, conf['connect_timeout']):
+        return True
+    # the emailer waits for the summary, so it is copied last
+    if not os.path.isdir(master_dir):
+        os.makedirs(master_dir)
+    for fname in files:
+        shutil.copy(fname, master_dir)
+    return False
+
+
+def wait_for_results(host, port, master_dir, beams, timeout, known=None):
+    """
+    Wait until the results of all beams have arrived at the collector, or until the results of a beam
+    that is not yet known arrive
+    host: collector host
+    port: collector port
+    master_dir: results dir of the observation on the master node
+    beams: list of expected beams
+    timeout: maximum time to wait (s)
+    known: list of beams whose arrival is already known, None to wait for all beams
+    returns: list of arrived beams, list of missing beams. None if the collector is not running
+             or refuses to wait for this results dir
+    """
+    payload = yaml.dump({'master_dir': master_dir, 'beams': [int(beam) for beam in beams],
+                         'known': None if known is None else [int(beam) for beam in known]})
+    try:
+        sock = socket.create_connection((host, port), timeout=10)
+    except socket.error:
+        return None
+    try:
+        sock.sendall(WAIT + WAIT_HEADER.pack(timeout, len(payload)) + payload)
+        # the answer comes when all beams are in, or at the timeout
+        sock.settimeout(None)
+        nbyte = struct.unpack("<I", recv_exact(sock, 4))[0]
+        reply = yaml.safe_load(recv_exact(sock, nbyte))
+    except socket.error:
+        return None
+    finally:
+        sock.close()
+    if reply.get('refused'):
+        return None
+    return reply['arrived'], reply['missing']
+
+
+def results_dirs(conf):
+    """
+    Get the dirs the collector accepts results below
+    conf: result_collector settings
+    returns: list of paths
+    """
+    return [path.format(home=os.path.expanduser('~')) for path in conf['results_dirs']]
+
+
+def is_below(path, roots):
+    """
+    Check whether a path is one of the given dirs or inside one of them, after resolving links
+    path: path to check
+    roots: list of dirs
+    """
+    path = os.path.realpath(path)
+    for root in roots:
+        root = os.path.realpath(root)
+        if path == root or path.startswith(root + os.sep):
+            return True
+    return False
+
+
+class ResultCollector(object):
+    """
+    Receive result bundles of the nodes and answer the emailer once all beams of an observation are in
+    """
+
+    def __init__(self, host, port, roots, logger=log):
+        """
+        host: address to listen on, the cluster interface of the master node
+        port: port to listen on
+        roots: results are only accepted in dirs below these dirs
+        logger: function to log messages with (Default: log)
+        """
+        self.log = logger
+        self.host = host
+        self.port = port
+        self.roots = roots
+        # arrival time of each beam, per results dir
+        self.arrived = {}
+        self.changed = threading.Condition()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(64)
+
+    def start(self):
+        """
+        Accept connections in a background thread
+        """
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        self.log("Result collector listening on {}:{}".format(self.host, self.port))
+
+    def run(self):
+        """
+        Accept connections, each is handled by its own thread
+        """
+        while True:
+            conn, addr = self.server.accept()
+            thread = threading.Thread(target=self.handle, args=(conn, ))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        """
+        Handle one message
+        """
+        try:
+            kind = recv_exact(conn, len(BUNDLE))
+            if kind == BUNDLE:
+                self.receive_bundle(conn)
+            elif kind == WAIT:
+                self.answer_wait(conn)
+            else:
+                self.log("WARNING: unknown message type {!r}".format(kind))
+        except socket.error as e:
+            self.log("WARNING: connection failed ({})".format(e))
+        finally:
+            conn.close()
+
+    def receive_bundle(self, conn):
+        """
+        Store the result files of one beam
+        """
+        beam, nfile, ndir = BUNDLE_HEADER.unpack(recv_exact(conn, BUNDLE_HEADER.size))
+        master_dir = recv_exact(conn, ndir)
+        if not is_below(master_dir, self.roots):
+            self.log("WARNING: refusing results of CB{:02d} for {}, not below {}".format(beam, master_dir,
+                                                                                     ', '.join(self.roots)))
+            conn.sendall("NO\n")
+            return
+        if not os.path.isdir(master_dir):
+            os.makedirs(master_dir)
+        for i in range(nfile):
+            nname, ndata = FILE_HEADER.unpack(recv_exact(conn, FILE_HEADER.size))
+            name = os.path.basename(recv_exact(conn, nname))
+            data = recv_exact(conn, ndata)
+            if name in ('', '.', '..'):
+                self.log("WARNING: skipping result file with invalid name {!r}".format(name))
+                continue
+            # write to a temporary file first, so readers never see a partial file
+            fname = os.path.join(master_dir, name)
+            with open(fname + '.part', 'wb') as f:
+                f.write(data)
+            os.rename(fname + '.part', fname)
+        with self.changed:
+            self.arrived.setdefault(master_dir, {})[beam] = time()
+            self.changed.notify_all()
+        conn.sendall("OK\n")
+        self.log("Received {} result files of CB{:02d} for {}".format(nfile, beam, master_dir))
+
+    def answer_wait(self, conn):
+        """
+        Answer once all expected beams have arrived, once a beam that is not yet known to the client
+        has arrived, or when the timeout expires
+        """
+        timeout, nbyte = WAIT_HEADER.unpack(recv_exact(conn, WAIT_HEADER.size))
+        request = yaml.safe_load(recv_exact(conn, nbyte))
+        master_dir = request['master_dir']
+        expected = set(request['beams'])
+        known = request.get('known')
+        deadline = time() + timeout
+        if not is_below(master_dir, self.roots):
+            self.log("WARNING: refusing to wait for results in {}, not below {}".format(master_dir,
+                                                                                     ', '.join(self.roots)))
+            reply = yaml.dump({'refused': True})
+            conn.sendall(struct.pack("<I", len(reply)) + reply)
+            return
+        with self.changed:
+            arrived = self.arrived.setdefault(master_dir, {})
+            while True:
+                # results copied by nodes that could not reach the collector count as well
+                for beam in expected - set(arrived):
+                    if os.path.isfile(os.path.join(master_dir, SUMMARY_FILE.format(beam=beam))):
+                        arrived[beam] = time()
+                remaining = deadline - time()
+                if expected.issubset(arrived) or remaining <= 0:
+                    break
+                if known is not None and expected.intersection(arrived) - set(known):
+                    break
+                # wake up regularly to check for copied files
+                self.changed.wait(min(remaining, 5))
+            done = sorted(expected.intersection(arrived))
+            missing = sorted(expected - set(arrived))
+        if missing:
+            self.log("WARNING: no results of {} beams for {}".format(len(missing), master_dir))
+        reply = yaml.dump({'arrived': done, 'missing': missing})
+        conn.sendall(struct.pack("<I", len(reply)) + reply)
+
+
+if __name__ == '__main__':
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), CONFIG), 'r') as f:
+        conf = yaml.load(f)['result_collector']
+
+    parser = argparse.ArgumentParser(description="Collect trigger results of the nodes, or send results to the "
+                                                 "collector")
+    parser.add_argument("--port", type=int, help="Collector port (Default: {})".format(conf['port']),
+                        default=conf['port'])
+    parser.add_argument("--host", type=str, help="Collector host, also the address the collector listens on "
+                        "(Default: {})".format(conf['host']), default=conf['host'])
+    parser.add_argument("--send", type=str, nargs='+', help="Send these files instead of running the collector")
+    parser.add_argument("--master_dir", type=str, help="Results dir to send files to")
+    parser.add_argument("--beam", type=int, help="CB index of the files to send")
+
+    args = parser.parse_args()
+
+    if args.send:
+        if not send_results(args.host, args.port, args.master_dir, args.beam, args.send, conf['connect_timeout']):
+            sys.exit(1)
+    else:
+        collector = ResultCollector(args.host, args.port, results_dirs(conf))
+        collector.start()
+        while True:
+            sleep(60)
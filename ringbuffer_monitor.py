@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+#
+# Sample the fill level of a PSRDADA ringbuffer during an observation
+# Writes a binary time series of the data block state and a summary
+# Author: L.C. Oostrum
+
+import os
+import struct
+import argparse
+import subprocess
+from time import sleep, time
+
+import numpy as np
+import yaml
+
+# file format: MAGIC, then one record per sample
+MAGIC = "ARTSRB2\n"
+# time, total buffers, full buffers, clear buffers, buffers written, buffers read
+RECORD = struct.Struct("<dHHHII")
+RECORD_DTYPE = np.dtype([('time', '<f8'), ('total', '<u2'), ('full', '<u2'), ('clear', '<u2'),
+                         ('written', '<u4'), ('read', '<u4')])
+
+
+def parse_metric(output):
+    """
+    Parse the output of dada_dbmetric
+    The line holds the data block counters, followed by the header block counters:
+    total,full,clear,written,read,total,full,clear,written,read
+    PSRDADA does not report the position of each reader, the read count is that of the ringbuffer
+    output: output of dada_dbmetric
+    returns: total, full, clear, written, read of the data block. None if the output cannot be parsed
+    """
+    for line in output.split('\n'):
+        try:
+            values = [int(value) for value in line.strip().strip(',').split(',')]
+        except ValueError:
+            continue
+        if len(values) >= 5:
+            return tuple(values[:5])
+    return None
+
+
+def dbmetric(dadakey):
+    """
+    Get the current state of the data block of a ringbuffer
+    dadakey: PSRDADA key
+    returns: total, full, clear, written, read. None if not available
+    """
+    try:
+        output = subprocess.check_output(['dada_dbmetric', '-k', str(dadakey)], stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return parse_metric(output)
+
+
+def read_telemetry(filename):
+    """
+    Read a telemetry file
+    filename: path to file
+    returns: numpy structured array with time, total, full, clear, written and read fields
+    """
+    with open(filename, 'rb') as f:
+        if not f.read(len(MAGIC)) == MAGIC:
+            raise ValueError("{} is not a ringbuffer telemetry file".format(filename))
+        return np.fromfile(f, dtype=RECORD_DTYPE)
+
+
+def summarise(data):
+    """
+    Summarise the ringbuffer state of an observation
+    data: output of read_telemetry
+    returns: dict with the buffer usage and the lag of the readers
+    """
+    summary = {'nsample': len(data)}
+    if not len(data):
+        return summary
+    summary['duration'] = float(data['time'][-1] - data['time'][0])
+    summary['nbuffer'] = int(data['total'].max())
+    summary['max_full'] = int(data['full'].max())
+    summary['min_clear'] = int(data['clear'].min())
+    # lag is the nr of buffers written but not yet read
+    lag = data['written'].astype(int) - data['read'].astype(int)
+    summary['mean_lag'] = float(lag.mean())
+    summary['p99_lag'] = float(np.percentile(lag, 99))
+    summary['max_lag'] = int(lag.max())
+    # fraction of samples where the readers hold up the writer
+    summary['full_fraction'] = float((data['full'] >= data['total'] - 1).mean())
+    return summary
+
+
+class RingbufferMonitor(object):
+    """
+    Sample the state of a ringbuffer at a fixed cadence
+    """
+
+    def __init__(self, dadakey, filename, interval=1.0, idle=10.0, logger=None):
+        """
+        dadakey: PSRDADA key of the ringbuffer
+        filename: output telemetry file
+        interval: time between samples (s)
+        idle: stop when nothing was written for this long after the writer started (s)
+        logger: function to log messages with (Default: print)
+        """
+        self.dadakey = dadakey
+        self.filename = filename
+        self.interval = interval
+        self.idle = idle
+        if logger is None:
+            self.log = self._log
+        else:
+            self.log = logger
+
+    def _log(self, message):
+        """
+        Log a message. Prints the message
+        """
+        print message
+
+    def run(self, end_time):
+        """
+        Sample the ringbuffer until the writer is done or the end time is reached
+        end_time: unix time to stop at the latest
+        returns: nr of samples
+        """
+        nsample = 0
+        last_written = None
+        last_change = None
+        with open(self.filename, 'wb') as f:
+            f.write(MAGIC)
+            while time() < end_time:
+                tsample = time()
+                state = dbmetric(self.dadakey)
+                if state is None:
+                    if nsample:
+                        # ringbuffer was removed
+                        break
+                else:
+                    total, full, clear, written, read = state
+                    f.write(RECORD.pack(tsample, total, full, clear, written, read))
+                    f.flush()
+                    nsample += 1
+                    if not written == last_written:
+                        if last_written is not None:
+                            last_change = tsample
+                        last_written = written
+                    elif last_change is not None and tsample - last_change > self.idle:
+                        # writer is done
+                        break
+                sleep(max(0, self.interval - (time() - tsample)))
+        self.log("Recorded {} ringbuffer samples".format(nsample))
+        return nsample
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Record the fill level of a PSRDADA ringbuffer")
+    parser.add_argument("--key", type=str, help="PSRDADA key", required=True)
+    parser.add_argument("--output", type=str, help="Output telemetry file", required=True)
+    parser.add_argument("--end", type=float, help="Unix time to stop at the latest", required=True)
+    parser.add_argument("--interval", type=float, help="Time between samples in seconds "
+                        "(Default: 1)", default=1.0)
+    parser.add_argument("--idle", type=float, help="Stop when nothing was written for this many seconds "
+                        "(Default: 10)", default=10.0)
+    parser.add_argument("--summary", type=str, help="YAML file to write summary to (Default: none)")
+
+    args = parser.parse_args()
+
+    monitor = RingbufferMonitor(args.key, args.output, interval=args.interval, idle=args.idle)
+    monitor.run(args.end)
+
+    if args.summary:
+        summary = summarise(read_telemetry(args.output))
+        summary_dir = os.path.dirname(args.summary)
+        if summary_dir and not os.path.isdir(summary_dir):
+            os.makedirs(summary_dir)
+        with open(args.summary, 'w') as f:
+            yaml.dump(summary, f, default_flow_style=False)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+#
+# Ringbuffer sizing model
+# Chooses the nr of buffers and the page size of the PSRDADA ringbuffer from the readers
+# of an observation, their processing time per page, the available memory and the
+# acceptable risk of data loss
+# Author: L.C. Oostrum
+
+import os
+import math
+import argparse
+
+import yaml
+
+CONFIG = "config.yaml"
+# readers of the ringbuffer in each observing mode
+MODE_READERS = {'scrub': ['dada_dbscrubber'],
+                'dump': ['dada_dbdisk'],
+                'fil': ['dadafilterbank'],
+                'fits': ['dadafits'],
+                'amber': ['amber_1', 'amber_2', 'amber_3'],
+                'survey': ['amber_1', 'amber_2', 'amber_3', 'dadafilterbank', 'dadafits']}
+
+
+def loss_risk(mean, std, stall, page_time, nbuffer, npage):
+    """
+    Probability that a reader falls behind by more than the ringbuffer can hold during an observation.
+    The backlog of a reader is modelled as a random walk with a drift of mean - page_time per page.
+    Its stationary distribution has an exponential tail with rate 2 * slack / std**2
+    mean: mean processing time per page (s)
+    std: standard deviation of the processing time per page (s)
+    stall: longest expected stall of the reader, e.g. at startup (s)
+    page_time: duration of one page (s)
+    nbuffer: nr of buffers
+    npage: nr of pages in the observation
+    returns: probability of data loss
+    """
+    # one buffer is being written, the others can hold the backlog
+    capacity = (nbuffer - 1) * page_time - stall
+    slack = page_time - mean
+    if slack <= 0 or capacity <= 0:
+        return 1.
+    if std == 0:
+        return 0.
+    return min(1., npage * math.exp(-2 * slack * capacity / std**2))
+
+
+def plan(readers, ntabs, nchan, tsamp, duration, hdr_size, conf):
+    """
+    Choose nbuffer and page size for an observation.
+    Of the settings with an acceptable data loss risk, the one using the least memory is chosen.
+    If there is none, the setting with the lowest risk that fits in memory is chosen
+    readers: names of the ringbuffer readers, as in MODE_READERS
+    ntabs: nr of TABs
+    nchan: nr of channels
+    tsamp: sampling time (s)
+    duration: duration of the observation (s)
+    hdr_size: size of the ringbuffer header (bytes)
+    conf: ringbuffer section of config.yaml
+    returns: dict with nbuffer, page_size, buffersize, memory, risk, limiting reader, ok flag and justification
+    """
+    memory_limit = conf['node_memory'] * conf['memory_fraction'] * 1024.**3
+    ref_size = conf['reference']['page_size'] * conf['reference']['ntabs']
+
+    candidates = []
+    for page_size in conf['page_sizes']:
+        page_time = page_size * tsamp
+        buffersize = ntabs * nchan * page_size
+        npage = int(math.ceil(duration / page_time))
+        # processing time scales with amount of data per page
+        scale = float(page_size * ntabs) / ref_size
+        profiles = {}
+        for reader in readers:
+            profile = conf['readers'][reader]
+            profiles[reader] = (profile['mean'] * scale, profile['std'] * scale, profile['stall'])
+        max_nbuffer = min(conf['max_nbuffer'], int((memory_limit - hdr_size) // buffersize))
+
+        best = None
+        for nbuffer in range(conf['min_nbuffer'], max_nbuffer + 1):
+            risks = dict([(reader, loss_risk(mean, std, stall, page_time, nbuffer, npage))
+                          for reader, (mean, std, stall) in profiles.items()])
+            risk = 1 - reduce(lambda a, b: a * b, [1 - r for r in risks.values()], 1.)
+            best = {'nbuffer': nbuffer, 'page_size': page_size, 'page_time': page_time,
+                    'buffersize': buffersize, 'memory': nbuffer * buffersize + hdr_size,
+                    'npage': npage, 'risk': risk, 'risks': risks, 'profiles': profiles,
+                    'limiting': max(risks, key=lambda reader: (risks[reader], profiles[reader][0])),
+                    'ok': risk <= conf['max_loss_risk']}
+            if best['ok']:
+                break
+        if best is not None:
+            candidates.append(best)
+
+    if not candidates:
+        raise ValueError("Not even {} buffers fit in {:.1f} GB of memory".format(
+                         conf['min_nbuffer'], memory_limit / 1024.**3))
+    result = sorted(candidates, key=lambda c: (not c['ok'], c['memory'] if c['ok'] else c['risk']))[0]
+    result['justification'] = justify(result, memory_limit, conf['max_loss_risk'])
+    return result
+
+
+def justify(result, memory_limit, max_loss_risk):
+    """
+    Describe why a ringbuffer setting was chosen
+    result: output of plan
+    memory_limit: memory available for the ringbuffer (bytes)
+    max_loss_risk: maximum acceptable risk of data loss
+    returns: list of log lines
+    """
+    lines = []
+    lines.append("Ringbuffer: {nbuffer} buffers of {page_size} samples ({page_time:.3f} s, {mb:.1f} MB), "
+                 "{gb:.2f} of {limit:.1f} GB".format(mb=result['buffersize'] / 1024.**2,
+                                                     gb=result['memory'] / 1024.**3,
+                                                     limit=memory_limit / 1024.**3, **result))
+    for reader in sorted(result['profiles']):
+        mean, std, stall = result['profiles'][reader]
+        lines.append("  {:<16s} {:.3f} +- {:.3f} s per page, slack {:.3f} s, stall {:.1f} s, "
+                     "loss risk {:.1e}".format(reader, mean, std, result['page_time'] - mean, stall,
+                                               result['risks'][reader]))
+    limiting = result['limiting']
+    if result['ok']:
+        lines.append("Loss risk {:.1e} over {} pages is below {:.1e}, limited by {}".format(
+                     result['risk'], result['npage'], max_loss_risk, limiting))
+    elif result['page_time'] <= result['profiles'][limiting][0]:
+        lines.append("WARNING: {} is slower than real time, data will be lost".format(limiting))
+    else:
+        lines.append("WARNING: loss risk {:.1e} is above {:.1e} with the available memory, limited by {}".format(
+                     result['risk'], max_loss_risk, limiting))
+    return lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Show the ringbuffer size chosen for an observation")
+    parser.add_argument("--obs_mode", type=str, help="Observation mode (Default: survey)", default="survey")
+    parser.add_argument("--science_mode", type=str, help="Science mode (Default: i+tab)", default="i+tab")
+    parser.add_argument("--science_case", type=int, help="Science case (Default: 4)", default=4)
+    parser.add_argument("--duration", type=float, help="Duration of observation in seconds "
+                        "(Default: 300)", default=300)
+
+    args = parser.parse_args()
+
+    filename = os.path.join(os.path.dirname(os.path.realpath(__file__)), CONFIG)
+    with open(filename, 'r') as f:
+        config = yaml.load(f)
+    conf_sc = config['sc{:.0f}'.format(args.science_case)]
+    try:
+        result = plan(MODE_READERS[args.obs_mode], config[args.science_mode.lower()]['ntabs'], conf_sc['nchan'],
+                      conf_sc['tsamp'], args.duration, conf_sc['hdr_size'], config['ringbuffer'])
+    except ValueError as e:
+        print "ERROR: {}".format(e)
+        exit(1)
+    for line in result['justification']:
+        print line
@@ -6,52 +6,36 @@
 
 import os
 import sys
+import shutil
 import argparse
 import socket
 import subprocess
 import warnings
-from time import sleep
+import threading
+from time import sleep, time
 
 import yaml
 import numpy as np
-from astropy.time import Time, TimeDelta
-from astropy import units as u
-from astropy.coordinates import SkyCoord, EarthLocation, AltAz
+
+import beam_layout
+import fast_astro
+import parset_codec
+import ringbuffer_sizing
+import result_collector
+from galactic_dm import GalacticDM
+from init_bsn import InitBSN
+from launcher import NodeLauncher
 
 CONFIG = "config.yaml"
-NODECONFIG = "nodes/CB{:02d}.yaml"
-NODEHEADER = "nodes/CB{:02d}_header.txt"
+NODEDIR = "nodes"
+QUEUEDIR = "nodes/queue/{datetimesource}"
+NODECONFIG = "CB{:02d}.yaml"
+NODEHEADER = "CB{:02d}_header.txt"
 TEMPLATE = "header_template.txt"
 AMBERCONFIG = "amber.yaml"
 AMBERCONFDIR = "amber_conf"
 COORD = "coordinates.txt"
 INFO = "info.yaml"
-CHECKBSN = "utilities/get_init_bsn.sh"
-
-
-def run_on_node(node, command, background=False):
-    """Run command on an ARTS node. Assumes ssh keys have been set up
-        node: nr of node (string or int)
-        command: command to run
-        background: whether to run ssh in the background
-    """
-    if isinstance(node, str):
-        if len(node) == 1:
-            # assume a leading 0 is missing
-            node = '0'+node
-        elif len(node) > 2:
-            # wrong, should only have 2 digits. Assume extra leading zeros
-            node = node[-3:]
-        hostname = "arts0{}".format(node)
-    else:
-        hostname = "arts0{:02d}".format(node)
-
-    if background:
-        ssh_cmd = "ssh {} {} &".format(hostname, command)
-    else:
-        ssh_cmd = "ssh {} {}".format(hostname, command)
-    log("Executing '{}'".format(ssh_cmd))
-    os.system(ssh_cmd)
 
 
 def log(message):
@@ -61,141 +45,117 @@ def log(message):
     print "Master: {}".format(message)
 
 
-def pointing_to_CB_pos(CB, coords, pol='X'):
+def CB_radec(CB, ra, dec, pol='X', layout=beam_layout.DEFAULT_LAYOUT):
     """
-    Convert dish pointing to RA and DEC of specified CB
-    CB: number of CB to get position of
-    coords: astropy.coordinates.SkyCoord object with dish pointing
+    Convert dish pointing to RA and DEC of specified CB(s)
+    CB: number of CB to get position of, or list of CB numbers
+    ra, dec: dish pointing in degrees
     pol: polarization to use: X, Y, or average. Default: X
-    returns: SkyCoord object with shifted coordinates
+    layout: name of beam layout, see beam_layout.LAYOUTS
+    returns: RA, DEC in degrees, arrays if a list of CBs is given
     """
+    scalar = np.isscalar(CB)
+    CBs = np.atleast_1d(CB).astype(int)
 
-    # PAF layout is based on generic elements (gels):
-    # generic element (gel) layout:
-    #
-    #  0-----55------110
-    #  |      |      |
-    #  |      |      |
-    #  5-----60------115
-    #  |      |      |
-    #  |      |      |
-    #  10----65------120
-    #
-    # +DEC = North = down, +HA is West = right
-    # +RA = east = left
-
-    # 11*11 grid of elements
-    nrows = 11
-    ncols = 11
-    # gel offsets
-    # Found in calc_beam_dirs.py in Apertif software:
-    # From Marc Verheijen:
-    #  Vivaldi elements are separated by 10cm in the PAF.
-    #  The horizontal and vertical seperation of the Vivaldi's is thus
-    #  10/sqrt(2)=7.071 cm, which corresponds to a geometric angle of
-    #  atan(7.071/875) = 0.4630 degrees for a F/0.35 dish.
-    #
-    #  Because of the fast focal ratio, the focal plane is strongly curved.
-    #  This leads to a Beam Deviation Factor of 0.7845. Therefore, the
-    #  effective horizontal and vertical separation of the elements is
-    #  actually dA = 0.7845*0.4630 = 0.3632 deg on the sky.
-    #  Note that a SKA White Paper (SD-FPA_system_tradeoffs_V2.doc)
-    #  describes how to calculate the BFD.
-    #
-    #  The planar PAF can be considered as a plane that is tangential to
-    #  the celestial sphere, so the sky maps with a TAN projection onto the
-    #  PAF.
-    #
-    offset_to_RADEC = 0.7845*0.4630  # degrees
-
-    # 32-beam IAB layout
-    # shift = 0.075  # degrees, extra shift needed for some rows/cols to match Apertif layout
-    shift = 0.0  # degrees, extra shift needed for some rows/cols to match Apertif layout
-    # gel for each CB, -1 means gel is not used
-    # because gels use fortran ordering, this looks like the transpose of the beam layout on-sky
-    gel_to_CB = [-1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,
-                 -1,  -1,   0,  -1,  12,  -1,  26,  -1,  23,  -1,  -1,
-                 -1,   3,   0,   6,  12,  20,  26,  32,  23,  -1,  -1,
-                 -1,   3,   1,   6,  15,  20,  27,  32,  28,  -1,  -1,
-                 -1,   8,   1,   7,  15,  21,  27,  35,  28,  -1,  -1,
-                 -1,   8,   2,   7,  16,  21,  30,  35,  33,  -1,  -1,
-                 -1,  13,   2,  10,  16,  22,  30,  36,  33,  -1,  -1,
-                 -1,  13,   5,  10,  17,  22,  31,  36,  38,  -1,  -1,
-                 -1,  18,   5,  11,  17,  25,  31,  37,  38,  -1,  -1,
-                 -1,  18,  -1,  11,  -1,  25,  -1,  37,  -1,  -1,  -1,
-                 -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1]
-
-    # 37-beam apertif hex (so no CB37,CB38)
-    # shift = 0
-    # gel_to_CB = [ -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,
-    #              -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,
-    #              -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,
-    #              -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,
-    #              -1,  -1,  -1,  -1,  -1,   0,  -1,  -1,  -1,  -1,  -1,
-    #              -1,  -1,  -1,  -1,  -1,   0,  -1,  -1,  -1,  -1,  -1,
-    #              -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,
-    #              -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,
-    #              -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,
-    #              -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,
-    #              -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1,  -1]
-    # create CB -> gel mapping
-    CB_to_gel_X = {}
-    CB_to_gel_Y = {}
-    for gel, cb in enumerate(gel_to_CB):
-        if gel % 2:
-            CB_to_gel_Y[cb] = gel
-        else:
-            CB_to_gel_X[cb] = gel
-
-    # get the gel numbers of the requested CB
-    try:
-        gel = [CB_to_gel_X[CB], CB_to_gel_Y[CB]]
-    except KeyError:
+    dRA, dDEC = beam_layout.CB_to_offset(CBs, pol, layout)
+    valid = np.isfinite(dRA) & np.isfinite(dDEC)
+    for CB in CBs[~valid]:
         # CB is not in IAB selection
         log("Could not get gel of CB{:02d}, returning input coordinates".format(CB))
-        return coords
-
-    # get row and column of gel
-    # loop over X and Y element
-    tmpshift = []
-    for ele in gel:
-        # Negative offsets are up and left with respect to central element. 
-        # That corresponds to a negative offset in DEC and a positive offset in RA
-        # gels use fortran ordering: row = RA, col = DEC
-        # rows: negative offset = left = positive RA: multiply by -1
-        # cols: negative ofset = up = negative DEC: correct
-        row = -1 * (np.floor(ele/ncols) - nrows//2)
-        col = (ele % nrows - nrows//2)
-
-        dRA = row * offset_to_RADEC 
-        dDEC = col * offset_to_RADEC
-        # apply shifts (do not understand yet why these are needed to match Apertif layout)
-        # RA (only row 3 and -3 from center, maybe more?)
-        if row % 3 == 0:
-            dRA -= shift * np.sign(dRA)
-        # DEC (every odd row from center)
-        if col % 2 == 1:
-            # odd row, shift DEC
-            dDEC -= shift * np.sign(dDEC)
-        # save
-        tmpshift.append([dRA, dDEC])
-    # choose RA DEC shift to apply
-    if pol.upper() == 'X':
-        radec_shift = tmpshift[0]
-    elif pol.upper() == 'Y':
-        radec_shift = tmpshift[1]
-    else:
-        radec_shift = np.average(tmpshift, axis=0)
+    # CBs that are not in the layout keep the input coordinates
+    dRA[~valid] = 0
+    dDEC[~valid] = 0
 
     # apply offset
-    newdec = coords.dec.degree + radec_shift[1]
-    newra = coords.ra.degree + radec_shift[0] / np.cos(newdec * np.pi/180)
+    newdec = dec + dDEC
+    newra = ra + dRA / np.cos(newdec * np.pi/180)
+    if scalar:
+        newra = newra[0]
+        newdec = newdec[0]
+    return newra, newdec
+
+
+def pointing_to_CB_pos(CB, coords, pol='X', layout=beam_layout.DEFAULT_LAYOUT):
+    """
+    Convert dish pointing to RA and DEC of specified CB(s)
+    CB: number of CB to get position of, or list of CB numbers
+    coords: astropy.coordinates.SkyCoord object with dish pointing
+    pol: polarization to use: X, Y, or average. Default: X
+    layout: name of beam layout, see beam_layout.LAYOUTS
+    returns: SkyCoord object with shifted coordinates, array-valued if a list of CBs is given
+    """
+    from astropy import units as u
+    from astropy.coordinates import SkyCoord
+
+    newra, newdec = CB_radec(CB, coords.ra.degree, coords.dec.degree, pol, layout)
     newcoord = SkyCoord(newra, newdec, unit=[u.degree, u.degree])
     return newcoord
 
 
-def start_survey(args):
-    """Sets up a survey mode observation from the master node
+def beam_coordinates(beams, ra, dec, unixstart, layout=beam_layout.DEFAULT_LAYOUT, use_astropy=False):
+    """
+    Calculate the header coordinates of all CBs at once
+    beams: list of CBs
+    ra, dec: J2000 dish pointing as sexagesimal strings
+    unixstart: start time of observation (unix time)
+    layout: name of beam layout, see beam_layout.LAYOUTS
+    use_astropy: use astropy instead of fast_astro (slower import, more accurate alt/az)
+    returns: dict with lists of ra, dec, gl, gb strings and az, za arrays of the CBs,
+             LST at start in seconds and the galactic coordinates of the pointing as strings
+    """
+    result = {}
+    if use_astropy:
+        from astropy.time import Time
+        from astropy import units as u
+        from astropy.coordinates import SkyCoord, EarthLocation, AltAz
+
+        starttime = Time(unixstart, format='unix')
+        # delta=0 means slightly less accurate (~10arcsec), but no need for internet
+        starttime.delta_ut1_utc = 0
+        # define pointing coordinates
+        coord = SkyCoord(ra, dec, unit=(u.hourangle, u.deg))
+        # wsrt location required for alt/az calculation
+        wsrt_lat = fast_astro.WSRT_LAT*u.deg
+        wsrt_lon = fast_astro.WSRT_LON*u.deg
+        wsrt_loc = EarthLocation(lat=wsrt_lat, lon=wsrt_lon, height=0*u.m)
+
+        cb_coords = pointing_to_CB_pos(beams, coord, layout=layout)
+        result['gl'], result['gb'] = zip(*[val.split(' ') for val in cb_coords.galactic.to_string(precision=8)])
+        altaz = cb_coords.transform_to(AltAz(obstime=starttime, location=wsrt_loc))
+        result['az'] = altaz.az.deg
+        result['za'] = 90 - altaz.alt.deg
+        result['ra'] = cb_coords.ra.to_string(unit=u.hourangle, sep=':', pad=True, precision=1)
+        result['dec'] = cb_coords.dec.to_string(unit=u.degree, sep=':', pad=True, precision=1)
+        # get LST start in seconds, same for all beams
+        result['lst_start'] = starttime.sidereal_time('mean', wsrt_lon).to(u.arcsecond).value / 15
+        result['pointing_galactic'] = coord.galactic.to_string(precision=8).split(' ')
+    else:
+        ra = fast_astro.sexagesimal_to_deg(ra, hours=True)
+        dec = fast_astro.sexagesimal_to_deg(dec)
+        cb_ra, cb_dec = CB_radec(beams, ra, dec, layout=layout)
+        gl, gb = fast_astro.radec_to_galactic(cb_ra, cb_dec)
+        result['gl'] = ["{:.8f}".format(val) for val in gl]
+        result['gb'] = ["{:.8f}".format(val) for val in gb]
+        alt, az = fast_astro.radec_to_altaz(cb_ra, cb_dec, unixstart)
+        result['az'] = az
+        result['za'] = 90 - alt
+        result['ra'] = fast_astro.deg_to_sexagesimal(cb_ra, hours=True)
+        result['dec'] = fast_astro.deg_to_sexagesimal(cb_dec)
+        # get LST start in seconds, same for all beams
+        result['lst_start'] = fast_astro.lst(unixstart) * 3600 / 15
+        result['pointing_galactic'] = ["{:.8f}".format(val) for val in fast_astro.radec_to_galactic(ra, dec)]
+    return result
+
+
+def prepare_survey(args, node_dir=NODEDIR, launch_time=None):
+    """Prepares a survey mode observation from the master node:
+    creates the node configs, headers, coordinate overview and obs info
+    args: settings through argument parser
+    node_dir: directory for node configs and headers, relative to this script.
+              May contain keys of the observation parameters, e.g. {datetimesource}
+    launch_time: time the nodes will be started (unix time), e.g. the end of the previous observation
+                 in a queue. The drain time is then added to the lead time (Default: now)
+    returns: dict with observation parameters
     """
 
     # initialize parameters
@@ -216,6 +176,7 @@ def start_survey(args):
     pars['home'] = os.path.expanduser('~')
     # science case specific
     pars['affinity'] = config['affinity']
+    pars['placement'] = config['placement']
     pars['usemac'] = args.mac
     pars['parset'] = args.parset
     pars['science_case'] = args.science_case
@@ -236,6 +197,12 @@ def start_survey(args):
     pars['bw'] = config[conf_sc]['bw']
     pars['nbeams'] = config[conf_sc]['nbeams']
     pars['missing_beams'] = config[conf_sc]['missing_beams']
+    pars['beam_layout'] = config[conf_sc]['beam_layout']
+    # always use the fast coordinate conversions in debug mode
+    if args.debug:
+        pars['astrometry'] = 'fast'
+    else:
+        pars['astrometry'] = config[conf_sc]['astrometry']
     pars['nbuffer'] = config[conf_sc]['nbuffer']
     pars['hdr_size'] = config[conf_sc]['hdr_size']
     pars['valid_modes'] = config[conf_sc]['valid_modes']
@@ -272,42 +239,63 @@ def start_survey(args):
     pars['nbatch'] = int(np.ceil(args.duration / 1.024))
     pars['tobs'] = pars['nbatch'] * 1.024
     # start time
+    # in fast start mode the nodes keep their ringbuffer, so less setup time is needed
+    pars['fast_start'] = args.fast
+    if args.fast:
+        lead_time = config['fast_start']['lead_time']
+    else:
+        lead_time = 30
+    pars['drain_time'] = config['queue']['drain_time']
+    if launch_time is None:
+        launch_time = time()
+    else:
+        # the nodes first let the readers of the previous observation finish
+        lead_time += pars['drain_time']
+    pars['lead_time'] = lead_time
     if args.tstart == 'default':
-        # start in 30 s
-        starttime = Time.now() + TimeDelta(30, format='sec')
+        # start after minimum lead time
+        starttime = launch_time + lead_time
     else:
-        starttime = Time(args.tstart, scale='utc')
-        if ((starttime - Time.now()).sec < 30) and not pars['debug']:
-            log("ERROR: start time should be at least 30 seconds in the future, got {}".format(starttime))
-            exit()  
+        try:
+            starttime = fast_astro.parse_utc(args.tstart)
+        except ValueError as e:
+            log("ERROR: {}".format(e))
+            exit()
+        if ((starttime - launch_time) < lead_time) and not pars['debug']:
+            log("ERROR: start time should be at least {} seconds after the nodes are started, "
+                "got {}".format(lead_time, args.tstart))
+            exit()
 
-    # Time(pars['utc_start'], format='iso', scale='utc')
     # round to multiple of 1.024 s since sync time (=init bsn)
     # note: init bsn is multiple of 781250
     # then increases by 80000 every 1.024s
     # simply use user-provided value in debug mode
     if not pars['debug']:
-        cmd = os.path.join(os.path.dirname(os.path.realpath(__file__)), CHECKBSN)
+        bsn = InitBSN(config['init_bsn']['command'], config['init_bsn']['cache_file'].format(**pars),
+                      config['init_bsn']['validity'], pars['time_unit'], logger=log)
         try:
-            init_bsn = float(subprocess.check_output(cmd).strip())
-        except Exception:
-            log("ERROR: Could not get init bsn from ccu-corr")
-            exit()
+            init_bsn = bsn.get(refresh=args.refresh_bsn)
+        except ValueError as e:
+            # without a valid init BSN, the timestamps of the observation would be wrong
+            log("ERROR: {}".format(e))
+            sys.exit(1)
         init_unix = init_bsn / pars['time_unit']
-        unixstart = round((starttime.unix-init_unix) / 1.024) * 1.024 + init_unix
+        if args.tstart == 'default':
+            # round up, so the lead time is kept
+            unixstart = np.ceil((starttime-init_unix) / 1.024) * 1.024 + init_unix
+        else:
+            unixstart = round((starttime-init_unix) / 1.024) * 1.024 + init_unix
         delta_bsn = (unixstart - init_unix) * pars['time_unit']
         pars['startpacket'] = "{:.0f}".format(init_bsn + delta_bsn)
     else:
-        unixstart = starttime.unix
+        unixstart = starttime
         pars['startpacket'] = "{:.0f}".format(unixstart * pars['time_unit'])
-    starttime = Time(unixstart, format='unix')
-    # delta=0 means slightly less accurate (~10arcsec), but no need for internet
-    starttime.delta_ut1_utc = 0
+    start_datetime = fast_astro.unix_to_datetime(unixstart)
 
-    pars['utc_start'] = starttime.datetime.strftime('%Y-%m-%d-%H:%M:%S')
-    pars['date'] = starttime.datetime.strftime("%Y%m%d")
+    pars['utc_start'] = start_datetime.strftime('%Y-%m-%d-%H:%M:%S')
+    pars['date'] = start_datetime.strftime("%Y%m%d")
     pars['datetimesource'] = "{}.{}".format(pars['utc_start'], pars['source'])
-    pars['mjd_start'] = starttime.mjd
+    pars['mjd_start'] = float(fast_astro.unix_to_mjd(unixstart))
     pars['debug_dir'] = config[conf_sc]['debug_dir']
     # change output directories in debug mode
     if args.debug:
@@ -320,6 +308,13 @@ def start_survey(args):
     pars['output_dir'] = config[conf_sc]['output_dir'].format(**pars)
     pars['log_dir'] = config[conf_sc]['log_dir'].format(**pars)
     pars['amber_dir'] = config[conf_sc]['amber_dir'].format(**pars)
+    pars['unixstart'] = unixstart
+    pars['launcher'] = config['launcher']
+    pars['telemetry'] = config['telemetry']
+    pars['stream_triggers'] = config['stream_triggers']
+    pars['amber_triggers'] = config['amber_triggers']
+    pars['result_collector'] = config['result_collector']
+    pars['node_dir'] = node_dir.format(**pars)
     
     # observing mode
     if args.obs_mode not in pars['valid_modes']:
@@ -327,6 +322,20 @@ def start_survey(args):
         exit()
     else:
         pars['obs_mode'] = args.obs_mode
+
+    # ringbuffer size
+    if config['ringbuffer']['auto']:
+        try:
+            sizing = ringbuffer_sizing.plan(ringbuffer_sizing.MODE_READERS[pars['obs_mode']], pars['ntabs'],
+                                            pars['nchan'], pars['tsamp'], pars['tobs'], pars['hdr_size'],
+                                            config['ringbuffer'])
+        except ValueError as e:
+            log("ERROR: {}".format(e))
+            exit()
+        for line in sizing['justification']:
+            log(line)
+        pars['nbuffer'] = sizing['nbuffer']
+        pars['page_size'] = sizing['page_size']
     # beams
     if args.beams is not None:
         pars['beams'] = [int(beam) for beam in args.beams.split(',')]
@@ -364,6 +373,10 @@ def start_survey(args):
     cmd = "mkdir -p {master_dir}/".format(**pars)
     os.system(cmd)
     log(cmd)
+    # create dir for node configs and headers
+    node_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), pars['node_dir'])
+    if not os.path.isdir(node_dir):
+        os.makedirs(node_dir)
 
     # create psrdada header and config file for each beam
     # config file
@@ -391,55 +404,69 @@ def start_survey(args):
     cfg['max_freq'] = pars['min_freq'] + pars['bw'] - pars['chan_width']
     cfg['usemac'] = pars['usemac']
     cfg['affinity'] = pars['affinity']
+    cfg['placement'] = pars['placement']
     cfg['page_size'] = pars['page_size']
     cfg['hdr_size'] = pars['hdr_size']
     cfg['debug'] = pars['debug']
+    cfg['fast_start'] = pars['fast_start']
+    cfg['drain_time'] = pars['drain_time']
+    cfg['unixstart'] = pars['unixstart']
+    cfg['telemetry'] = pars['telemetry']
+    cfg['result_collector'] = pars['result_collector']
+    cfg['stream_triggers'] = pars['stream_triggers']
+    cfg['amber_triggers'] = pars['amber_triggers']
 
     # load PSRDADA header template
     with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), TEMPLATE), 'r') as f:
         header_template = f.read()
 
-    # define pointing coordinates
-    coord = SkyCoord(pars['ra'], pars['dec'], unit=(u.hourangle, u.deg))
-    # wsrt location required for alt/az calculation
-    wsrt_lat = 52.915184*u.deg
-    wsrt_lon = 6.60387*u.deg
-    wsrt_loc = EarthLocation(lat=wsrt_lat, lon=wsrt_lon, height=0*u.m)
-    # load the parset
+    # load the parset and encode it once for all headers
+    pars['parset_codec'] = config['parset']['codec']
     if not pars['parset'] == '':
         with open(pars['parset']) as f:
-            parset = f.read().encode('bz2').encode('hex')
-            if len(parset) > 24575:
-                log("Error: compressed parset is longer than maximum for header (24575 characters)")
-                exit()
+            parset = f.read()
+        try:
+            parset = parset_codec.encode(parset, pars['parset_codec'],
+                                         store_dir=config['parset']['store_dir'].format(**pars))
+        except (ValueError, IOError, OSError) as e:
+            log("Error: could not encode parset: {}".format(e))
+            exit()
+        if len(parset) > parset_codec.MAX_LENGTH:
+            log("Error: compressed parset is longer than maximum for header ({} characters)".format(
+                parset_codec.MAX_LENGTH))
+            exit()
     else:
         parset = 'no parset'
 
-    for beam in pars['beams']:
+    # compute the coordinates of all beams at once
+    beam_coords = beam_coordinates(pars['beams'], pars['ra'], pars['dec'], pars['unixstart'],
+                                   layout=pars['beam_layout'], use_astropy=pars['astrometry'] == 'astropy')
+    ras = beam_coords['ra']
+    decs = beam_coords['dec']
+    gls = beam_coords['gl']
+    gbs = beam_coords['gb']
+    azs = beam_coords['az']
+    zas = beam_coords['za']
+    lststart = beam_coords['lst_start']
+
+    for i, beam in enumerate(pars['beams']):
         # add CB-dependent parameters
         cfg['beam'] = beam
         cfg['dadakey'] = pars['network_port_start'] + beam
         cfg['network_port'] = pars['network_port_start'] + beam
-        cfg['header'] = os.path.join(os.path.dirname(os.path.realpath(__file__)), NODEHEADER.format(beam))
+        cfg['header'] = os.path.join(node_dir, NODEHEADER.format(beam))
         if cfg['debug']:
             cfg['dada_dir'] = pars['dada_dir'].replace('{cb}', '{:02d}'.format(beam))
 
         # save to file
-        filename = os.path.join(os.path.dirname(os.path.realpath(__file__)), NODECONFIG.format(beam))
+        filename = os.path.join(node_dir, NODECONFIG.format(beam))
         with open(filename, 'w') as f:
             yaml.dump(cfg, f, default_flow_style=False)
 
-        # save the coordinates of the beams
-        this_cb_coord = pointing_to_CB_pos(beam, coord)
-        gl, gb = this_cb_coord.galactic.to_string(precision=8).split(' ')
-        altaz = this_cb_coord.transform_to(AltAz(obstime=starttime, location=wsrt_loc))
-        az = altaz.az.deg
-        za = 90 - altaz.alt.deg
-        ra = this_cb_coord.ra.to_string(unit=u.hourangle, sep=':', pad=True, precision=1)
-        dec = this_cb_coord.dec.to_string(unit=u.degree, sep=':', pad=True, precision=1)
-        coordinates.append(["{:02d}".format(beam), ra, dec, gl, gb])
-        # get LST start in seconds
-        lststart = starttime.sidereal_time('mean', wsrt_lon).to(u.arcsecond).value / 15
+        # get the coordinates of this beam
+        ra = ras[i]
+        dec = decs[i]
+        coordinates.append(["{:02d}".format(beam), ra, dec, gls[i], gbs[i]])
 
         # fill in the psrdada header keys 
         temppars = pars.copy()
@@ -448,11 +475,11 @@ def start_survey(args):
         temppars['dec'] = dec.replace(':', '')
         temppars['dec_hms'] = dec
         temppars['lst_start'] = lststart
-        temppars['az_start'] = az
-        temppars['za_start'] = za
+        temppars['az_start'] = azs[i]
+        temppars['za_start'] = zas[i]
         temppars['resolution'] = pars['page_size'] * pars['nchan'] * pars['ntabs']
         temppars['file_size'] = pars['page_size'] * pars['nchan'] * pars['ntabs'] * 10  # 10 pages per file
-        temppars['bps'] = int(pars['page_size'] * pars['nchan'] * pars['ntabs'] / 1.024)
+        temppars['bps'] = int(round(pars['nchan'] * pars['ntabs'] / pars['tsamp']))
         temppars['beam'] = beam
         temppars['parset'] = parset
         temppars['scanlen'] = pars['tobs']
@@ -460,7 +487,7 @@ def start_survey(args):
 
         header = header_template.format(**temppars)
 
-        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), NODEHEADER.format(beam)), 'w') as f:
+        with open(os.path.join(node_dir, NODEHEADER.format(beam)), 'w') as f:
             f.write(header)
 
     # save coordinate overview to disk
@@ -469,44 +496,235 @@ def start_survey(args):
         for line in coordinates:
             f.write(' '.join(line)+'\n')
 
-    # save obs info to disk
+    # get MW DMs of the pointing and all CBs in the background,
+    # the obs info is written once the nodes are started
+    galactic_dm = GalacticDM(config['galactic_dm']['cache_file'].format(**pars), config['galactic_dm']['models'],
+                             resolution=config['galactic_dm']['resolution'], logger=log)
+    positions = [beam_coords['pointing_galactic']] + zip(gls, gbs)
+    pars['dm_lookup'] = galactic_dm.lookup_async(positions)
+    pars['dm_timeout'] = config['galactic_dm']['timeout']
+
+    return pars
+
+
+def write_obs_info(pars):
+    """Saves the observation info, including the MW DMs, to disk
+    pars: observation parameters, as returned by prepare_survey
+    """
     info = {}
     for key in ['utc_start', 'source', 'tobs']:
         info[key] = pars[key]
-    # get MW DMs
-    # YMW16
-    # mode, Gl, Gb, dist(pc), dist->DM. 1E6 pc should cover entire MW
-    cmd = "ymw16 Gal {} {} 1E6 2 | awk '{{print $8}}'".format(*coord.galactic.to_string(precision=8).split(' '))
-    log(cmd)
-    ymw16_dm = subprocess.check_output(cmd, shell=True)
-    try:
-        ymw16_dm = str(float(ymw16_dm))
-    except ValueError:
-        ymw16_dm = "-"
-    info['ymw16'] = ymw16_dm
+    # wait for the MW DMs, a model command that hangs must not block the master.
+    # The DMs are - until the lookup is done
+    thread, result = pars['dm_lookup']
+    thread.join(pars['dm_timeout'])
+    if thread.is_alive():
+        log("WARNING: Milky Way DM lookup not done after {} s, writing obs info without DMs".format(
+            pars['dm_timeout']))
+    dms = result['dms']
+    # first position is the central pointing
+    info.update(dms[0])
+    info['dm_beams'] = dict(zip(pars['beams'], dms[1:]))
     filename = os.path.join(pars['master_dir'], INFO)
     with open(filename, 'w') as f:
         yaml.dump(info, f, default_flow_style=False)
 
-    # Start the node scripts
+
+def launch_nodes(pars):
+    """Starts the node scripts of a prepared observation
+    pars: observation parameters, as returned by prepare_survey
+    returns: True if all nodes started, else False
+    """
     script_path = os.path.realpath(os.path.dirname(__file__))
+    node_script = os.path.join(script_path, "start_survey_node.py")
+    tasks = []
     for beam in pars['beams']:
         node = beam + 1
-        node_script = os.path.join(script_path, "start_survey_node.py")
-        cmd = "{} nodes/CB{:02d}.yaml".format(node_script, beam)
-        run_on_node(node, cmd, background=True)
-
-    sleep(1)
+        cmd = "{} {}".format(node_script, os.path.join(pars['node_dir'], NODECONFIG.format(beam)))
+        tasks.append((beam, node, cmd))
+    launcher = NodeLauncher(pars['log_dir'], logger=log, **pars['launcher'])
+    results = launcher.start(tasks)
     # done
-    log("All nodes started for observation")
+    if launcher.report(results):
+        log("All nodes started for observation")
+        return True
+    else:
+        log("WARNING: Not all nodes started for observation")
+        return False
+
+
+def start_emailer(pars):
+    """Starts the emailer of an observation in the background. It sends progressive alerts during the observation
+    and the full overview once all beams are in
+    pars: observation parameters, as returned by prepare_survey
+    returns: subprocess.Popen object of the emailer
+    """
+    email_script = os.path.join(os.path.realpath(os.path.dirname(__file__)), "emailer.py")
+    cmd = ['python', email_script, pars['master_dir'], str(pars['beams']), repr(pars['unixstart'] + pars['tobs'])]
+    log(' '.join(cmd))
+    return subprocess.Popen(cmd)
+
+
+def start_collector(pars):
+    """Starts the result collector in the background, it keeps running until the master script exits
+    pars: observation parameters, as returned by prepare_survey
+    returns: True if the collector was started
+    """
+    conf = pars['result_collector']
+    try:
+        result_collector.ResultCollector(conf['host'], conf['port'], result_collector.results_dirs(conf),
+                                         logger=log).start()
+    except socket.error as e:
+        log("WARNING: Could not start result collector on {}:{} ({})".format(conf['host'], conf['port'], e))
+        return False
+    return True
+
+
+def start_survey(args):
+    """Sets up a survey mode observation from the master node
+    """
+    pars = prepare_survey(args)
+    if pars['proctrigger']:
+        start_collector(pars)
+    launch_nodes(pars)
+    write_obs_info(pars)
 
     # start the trigger listener + emailer NOTE: this is the only command
     # that keeps running in the foreground during the obs
     if pars['proctrigger']:
-        email_script = os.path.join(script_path, "emailer.py")
-        cmd = "sleep {tobs}; python {email_script} {master_dir} '{beams}'".format(email_script=email_script, **pars)
-        log(cmd)
-        os.system(cmd)
+        start_emailer(pars).wait()
+
+
+def wait_until(unixtime):
+    """
+    Sleep until given unix time
+    """
+    delay = unixtime - time()
+    if delay > 0:
+        sleep(delay)
+
+
+def remove_node_dir(pars):
+    """
+    Remove the node configs and headers of an observation, once the nodes no longer need them
+    pars: observation parameters, as returned by prepare_survey
+    """
+    node_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), pars['node_dir'])
+    shutil.rmtree(node_dir, ignore_errors=True)
+
+
+def prepare_in_background(args, launch_time=None):
+    """
+    Prepare an observation in a separate thread
+    args: settings through argument parser
+    launch_time: time the nodes will be started (unix time), None for now
+    returns: thread and dict that holds the observation parameters under 'pars' once the thread is done.
+             pars is None if the observation could not be prepared
+    """
+    result = {'pars': None}
+
+    def target():
+        try:
+            result['pars'] = prepare_survey(args, node_dir=QUEUEDIR, launch_time=launch_time)
+        except SystemExit:
+            # prepare_survey exits on invalid settings
+            log("ERROR: Could not prepare observation of {}, skipping it".format(args.source))
+
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    return thread, result
+
+
+def run_queue(args):
+    """Runs a queue of back-to-back observations
+    The next observation is prepared while the current one is recording,
+    and its nodes are started as soon as the current recording ends. They wait for the readers
+    of the current observation to finish, so its start is delayed by the drain time.
+    Start times are relative to the end of the previous observation.
+    Emails of previous observations are sent while the next one is recording
+    args: settings through argument parser, used as default for each observation
+    """
+    with open(args.queue, 'r') as f:
+        queue = yaml.load(f)
+
+    # create the settings of each observation
+    observations = []
+    for entry in queue:
+        obs_args = argparse.Namespace(**vars(args))
+        for key, value in entry.items():
+            if not hasattr(obs_args, key):
+                log("ERROR: Unknown setting in queue: {}".format(key))
+                exit()
+            setattr(obs_args, key, value)
+        # YAML converts unquoted hh:mm:ss values to numbers
+        for key in ['ra', 'dec', 'tstart']:
+            if not isinstance(getattr(obs_args, key), str):
+                log("ERROR: {} should be a quoted string in queue, got {}".format(key, getattr(obs_args, key)))
+                exit()
+        if obs_args.proctrigger and not obs_args.obs_mode == 'survey':
+            log("ERROR: proctrigger can only be used in survey mode, got {}".format(obs_args.obs_mode))
+            exit()
+        observations.append(obs_args)
+    if len(observations) == 0:
+        log("ERROR: Queue is empty")
+        exit()
+    log("Loaded {} observations".format(len(observations)))
+
+    emailers = []
+    collector = False
+    prev_end = None
+    prev_pars = None
+    thread, result = prepare_in_background(observations[0])
+    for ind in range(len(observations)):
+        thread.join()
+        pars = result['pars']
+        # prepare the next observation while this one records, its nodes are started when this one ends
+        if ind + 1 < len(observations):
+            if pars is not None:
+                launch_time = pars['unixstart'] + pars['tobs']
+            else:
+                launch_time = prev_end
+            thread, result = prepare_in_background(observations[ind+1], launch_time)
+        if pars is None:
+            continue
+
+        # the nodes can only be started once the previous recording is done
+        if prev_end is not None:
+            wait_until(prev_end)
+            if prev_pars is not None:
+                remove_node_dir(prev_pars)
+                prev_pars = None
+            # the nodes need the lead time to set up, check again now that they are started.
+            # The drain time is a margin for the readers of the previous observation, not needed for the setup
+            setup_time = pars['lead_time'] - pars['drain_time']
+            if (pars['unixstart'] - time() < setup_time) and not pars['debug']:
+                log("ERROR: Observation of {} starts in less than {} seconds, "
+                    "skipping it".format(pars['source'], setup_time))
+                remove_node_dir(pars)
+                continue
+        log("Starting observation of {source} at {utc_start}".format(**pars))
+        # one collector serves all observations in the queue
+        if pars['proctrigger'] and not collector:
+            collector = start_collector(pars)
+        launch_nodes(pars)
+        write_obs_info(pars)
+        prev_end = pars['unixstart'] + pars['tobs']
+        prev_pars = pars
+
+        # the emailer alerts on the results of the nodes as they come in and waits for all of them,
+        # so it runs alongside this and the next observation
+        if pars['proctrigger']:
+            emailers.append(start_emailer(pars))
+
+    # wait for last recording and remaining emailers
+    if prev_end is not None:
+        wait_until(prev_end)
+    if prev_pars is not None:
+        remove_node_dir(prev_pars)
+    log("All observations in queue done")
+    for emailer in emailers:
+        emailer.wait()
 
 
 if __name__ == '__main__':
@@ -529,7 +747,7 @@ if __name__ == '__main__':
     parser.add_argument("--duration", type=float, help="Observation duration in seconds "
                         "(Default: 10.24)", default=10.24)
     parser.add_argument("--tstart", type=str, help="Start time (UTC), e.g. 2017-01-01 00:00:00 "
-                        "(Default: now + 30 seconds)", default="default")
+                        "(Default: now + 30 seconds, or fast start lead time with --fast)", default="default")
     # either start and end beam or list of beams: make beams and sbeam mutually exclusive
     beamgroup = parser.add_mutually_exclusive_group()
     beamgroup.add_argument("--sbeam", type=int, help="No of first CB to record "
@@ -557,6 +775,17 @@ if __name__ == '__main__':
     # Parset
     parser.add_argument("--parset", type=str, help="Path to parset of this observation "
                             "(Default: no parset)", default='')
+    # queue of observations
+    parser.add_argument("--queue", type=str, help="YAML file with a list of observations to run back-to-back. "
+                        "Each observation can set any of the other arguments, e.g. source, ra, dec, tstart, "
+                        "duration, obs_mode. Arguments given on the command line are used as defaults "
+                        "(Default: no queue)", default='')
+    # fast start for target-of-opportunity observations
+    parser.add_argument("--fast", help="Fast start: keep the ringbuffers of the previous observation on the "
+                        "nodes and allow a short start time lead (Default: False)", action="store_true")
+    # init bsn
+    parser.add_argument("--refresh_bsn", help="Get the init BSN from the correlator instead of the cache "
+                        "(Default: False)", action="store_true")
     # debug mode; read from disk instead of network
     parser.add_argument("--debug", help="Debug mode: read from disk intead of network "
                             "(Default: False)", action="store_true")
@@ -589,4 +818,7 @@ if __name__ == '__main__':
     if args.debug and not args.dada_dir:
         print "ERROR: dada_dir is required in debug mode"
 
-    start_survey(args)
+    if args.queue:
+        run_queue(args)
+    else:
+        start_survey(args)
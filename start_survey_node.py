@@ -7,11 +7,32 @@
 import os
 import sys
 import socket
-from time import sleep
+from distutils.spawn import find_executable
+from time import sleep, time
 
 import yaml
 
+import placement
+import ringbuffer_monitor
+import trigger_windows
+from supervisor import Supervisor, shm_nattach, key_users, stop_processes
+
+# nr of dadafilterbank threads when using the fixed affinity
 NUMTHREADS = 40
+# maximum time to wait for the ringbuffer to be created and the readers to attach (s)
+READY_TIMEOUT = 10
+# time to watch the processes for failures after the writer is started (s)
+WRITER_GRACE = 1
+# maximum time to wait for the readers to finish after the writer is done (s)
+FINISH_TIMEOUT = 60
+# readers whose output is used by the trigger processing: AMBER and the filterbank
+TRIGGER_READERS = ('amber', 'dadafilterbank')
+# ringbuffer layout of the last observation, used in fast start mode
+RINGBUFFER_STATE = "/tmp/arts_ringbuffer_{dadakey}.yaml"
+# settings that have to be equal to reuse a ringbuffer
+RINGBUFFER_KEYS = ['dadakey', 'hdr_size', 'buffersize', 'nbuffer', 'nreader']
+# processes that only sample the ringbuffer state
+SAMPLERS = ('python', 'dada_dbmetric')
 
 
 class Survey(object):
@@ -26,8 +47,8 @@ class Survey(object):
         self.hostname = socket.gethostname()
         self.config = config
         
-        # how long to sleep between commands
-        waittime = 0.5
+        # processes of this observation
+        self.supervisor = Supervisor(logger=self.log)
 
         # check CB
         expected_CB = int(self.hostname[5:7]) - 1
@@ -37,13 +58,29 @@ class Survey(object):
         # create directory for log files
         os.system("mkdir -p {}".format(self.config['log_dir']))
 
+        # assign cpus and memory to the components
+        self.placer, self.placement = self.plan_placement()
+
+        # in fast start mode, keep the existing ringbuffer if it matches this observation
+        fast_start = self.config.get('fast_start', False)
+        # the output of a previous observation is only complete once its readers are done
+        self.drain_previous()
+
+        # readiness checks that timed out
+        problems = []
         # start the programmes
-        # remove running ringbuffers, AMBER, etc.
-        self.clean()
-        sleep(waittime)
-        # create ringbuffer
-        self.ringbuffer()
-        sleep(waittime)
+        if fast_start and self.reuse_ringbuffer():
+            self.log("Reusing existing ringbuffer")
+        else:
+            # remove running ringbuffers, AMBER, etc.
+            self.clean()
+            # create ringbuffer
+            self.ringbuffer()
+            if not self.supervisor.wait_for(self.ringbuffer_exists, READY_TIMEOUT, "Ringbuffer created"):
+                problems.append('ringbuffer')
+        # readers still attached from a previous observation
+        nattach = shm_nattach(self.config['dadakey']) or 0
+        nproc = len(self.supervisor.names)
         # start readers depending on observing mode
         if self.config['obs_mode'] == 'scrub':
             self.scrub()
@@ -57,37 +94,109 @@ class Survey(object):
             self.amber()
         elif self.config['obs_mode'] == 'survey':
             self.survey()
-        sleep(waittime)
+        # wait for the readers to attach to the ringbuffer
+        nreader = len(self.supervisor.names) - nproc
+        if not self.supervisor.wait_for(lambda: (shm_nattach(self.config['dadakey']) or 0) >= nattach + nreader or
+                                        self.supervisor.failed(), READY_TIMEOUT,
+                                        "{} readers attached".format(nreader)):
+            problems.append('readers attaching')
         # start fill ringbuffer (operations) or read from disk (debug)
         if self.config['debug']:
+            writer = 'dada_diskdb'
             self.diskdb()
         elif self.config['usemac']:
+            writer = 'fill_ringbuffer'
             self.fill_ringbuffer(reorder=True)
         else:
+            writer = 'fill_ringbuffer'
             self.fill_ringbuffer()
-        sleep(waittime)
-        # Everything has been started
-        self.log("Everything started")
+        # record the ringbuffer fill level during the observation
+        self.ringbuffer_monitor()
+        # Everything has been started, a process that fails right after starting is caught as well
+        failed = self.supervisor.watch(WRITER_GRACE) + problems
+        if failed:
+            self.log("Failed to start: {}".format(', '.join(failed)))
+        else:
+            self.log("Everything started")
+        self.supervisor.report()
         # flush stdout
         sys.stdout.flush()
         # proc trigger command
         if self.config['proctrigger']:
             cmd = "mkdir -p {output_dir}/triggers".format(**self.config)
             os.system(cmd)
-            self.log("Waiting for finish, then processing triggers")
-            if self.config['debug']:
-                prog = 'dada_diskdb'
+            if self.config['stream_triggers']['window'] > 0:
+                self.stream_triggers(writer)
             else:
-                prog = 'fill_ringbuffer'
-            cmd = "sleep 1; pid=$(pgrep {prog}); tail --pid=$pid -f /dev/null; sleep 5; " \
-                  "{script_dir}/process_triggers.sh {output_dir}/triggers {output_dir}/filterbank/CB{beam:02d}.fil " \
-                  "{amber_dir}/CB{beam:02d} {master_dir} " \
-                  "{snrmin} {beam:02d} {duration}".format(prog=prog, 
-                                                          script_dir=os.path.dirname(os.path.realpath(__file__)),
-                                                          **self.config)
-            self.log(cmd)
-            sys.stdout.flush()
-            os.system(cmd)
+                self.log("Waiting for finish, then processing triggers")
+                sys.stdout.flush()
+                self.supervisor.wait(writer)
+                self.wait_for_readers()
+                self.process_triggers()
+
+    def wait_for_readers(self):
+        """
+        Give the readers whose output the trigger processing uses time to process the last data
+        after the writer is done
+        """
+        for name in self.supervisor.names:
+            if name.startswith(TRIGGER_READERS):
+                if self.supervisor.wait(name, timeout=FINISH_TIMEOUT) is None:
+                    self.log("WARNING: {} still running {} s after end of observation".format(name,
+                                                                                            FINISH_TIMEOUT))
+        self.supervisor.report()
+
+    def process_triggers(self, window=None, time_limit=None):
+        """
+        Group and classify the AMBER triggers and send the results to the master node
+        window: only process the trigger file of this time window (Default: all triggers)
+        time_limit: maximum arrival time of triggers (Default: duration of observation)
+        """
+        if time_limit is None:
+            time_limit = self.config['duration']
+        cmd = "{script_dir}/process_triggers.sh {output_dir}/triggers {output_dir}/filterbank/CB{beam:02d}.fil " \
+              "{amber_dir}/CB{beam:02d} {master_dir} " \
+              "{snrmin} {beam:02d} {time_limit}".format(script_dir=os.path.dirname(os.path.realpath(__file__)),
+                                                        time_limit=time_limit, **self.config)
+        if window is not None:
+            cmd += " {}".format(window)
+        self.log(cmd)
+        sys.stdout.flush()
+        os.system(cmd)
+
+    def stream_triggers(self, writer):
+        """
+        Process the triggers in time windows while the observation is running,
+        then process the remaining triggers and merge the results of all windows
+        writer: name of the ringbuffer writer
+        """
+        length = self.config['stream_triggers']['window'] * 1.024
+        delay = self.config['stream_triggers']['delay']
+        splitter = trigger_windows.WindowSplitter(os.path.join(self.config['amber_dir'],
+                                                               'CB{:02d}'.format(self.config['beam'])),
+                                                  **self.config['amber_triggers'])
+        # data starts at the start of the observation, or at the start of the writer when reading from disk
+        tstart = max(self.config['unixstart'], self.supervisor.procs[writer]['start'])
+        self.log("Processing triggers every {:.0f} s during the observation".format(length))
+        sys.stdout.flush()
+        window = 0
+        while self.supervisor.running(writer):
+            tend = (window + 1) * length
+            # wait until the data of the window has been processed by AMBER and written to disk
+            if tend < self.config['duration'] and time() > tstart + tend + delay:
+                fname, ntrigger = splitter.write_window(window, tend)
+                self.log("Window {}: {} triggers up to {:.0f} s".format(window, ntrigger, tend))
+                self.process_triggers(window, time_limit=tend)
+                window += 1
+            else:
+                sleep(1)
+        self.wait_for_readers()
+        # final pass over the remaining triggers
+        fname, ntrigger = splitter.write_window(window, None)
+        self.log("Window {}: {} remaining triggers".format(window, ntrigger))
+        self.process_triggers(window)
+        trigger_windows.merge_results(os.path.join(self.config['output_dir'], 'triggers'), self.config['master_dir'],
+                                      self.config['beam'], window + 1, self.config['result_collector'])
 
     def log(self, message):
         """
@@ -95,81 +204,230 @@ class Survey(object):
         """
         print "{}: {}".format(self.hostname, message)
 
+    def previous_users(self):
+        """
+        Get the programmes of a previous observation that still use the ringbuffer,
+        apart from the ringbuffer monitor
+        returns: dict of pid: name
+        """
+        return dict([(pid, name) for pid, name in key_users(self.config['dadakey']).items()
+                     if not name.startswith(SAMPLERS)])
+
+    def drain_previous(self):
+        """
+        Wait for the writer and readers of a previous observation to finish. Programmes still running
+        after the drain time are stopped when the ringbuffer is recreated
+        """
+        users = self.previous_users()
+        if not users:
+            return
+        self.log("Waiting up to {} s for {} of previous observation to finish".format(
+            self.config['drain_time'], ', '.join(sorted(set(users.values())))))
+        sys.stdout.flush()
+        deadline = time() + self.config['drain_time']
+        while users and time() < deadline:
+            sleep(.5)
+            users = self.previous_users()
+        if users:
+            self.log("WARNING: {} of previous observation still running after {} s".format(
+                ', '.join(sorted(set(users.values()))), self.config['drain_time']))
+
     def clean(self):
+        """
+        Stop programmes of a previous observation that did not finish in time and remove its ringbuffer
+        """
+        # readers would otherwise keep running on the removed ringbuffer
+        users = key_users(self.config['dadakey'])
+        if users:
+            self.log("Stopping {}".format(', '.join(sorted(set(users.values())))))
+            stop_processes(users.keys(), READY_TIMEOUT)
         self.log("Removing old ringbuffers")
         cmd = "dada_db -d -k {dadakey} 2>/dev/null; pkill fill_ringbuffer".format(**self.config)
+        # the ringbuffer layout is no longer known
+        try:
+            os.remove(RINGBUFFER_STATE.format(**self.config))
+        except OSError:
+            pass
         self.log(cmd)
         os.system(cmd)
 
+    def plan_placement(self):
+        """
+        Assign cpus to the components of this observation and log placement problems
+        returns: Placement object, dict of component: cpu list
+        """
+        conf = self.config['placement']
+        opencl_devices = []
+        if self.config['obs_mode'] in ('amber', 'survey'):
+            with open(self.config['amber_config'], 'r') as f:
+                opencl_devices = yaml.load(f)[self.config['amber_mode']]['opencl_device']
+        placer = placement.Placement(placement.Topology(conf['sysfs'], conf['gpu_vendor']),
+                                     placement.obs_components(self.config['obs_mode'], opencl_devices), conf)
+        if conf['mode'] == 'plan':
+            assignment = placer.plan()
+            threads = {}
+        else:
+            assignment = placer.from_affinity(self.config['affinity'])
+            threads = {'dadafilterbank': NUMTHREADS}
+        warnings = placer.check(assignment, threads) + \
+            placer.check_ringbuffer(self.config['nbuffer'] * self.config['buffersize'])
+        for warning in warnings:
+            self.log("WARNING: {}".format(warning))
+        return placer, dict([(component, placement.format_cpulist(cpus))
+                             for component, cpus in assignment.items()])
+
+    def pin(self, component):
+        """
+        Get the command prefix that runs a component on its cpus
+        component: name of the component
+        """
+        cpus = self.placement.get(component)
+        if cpus is None:
+            return ""
+        return "taskset -c {} ".format(cpus)
+
     def ringbuffer(self):
         self.log("Starting ringbuffers")
-        cpu = self.config['affinity']['dada_db_i']
-        cmd = "taskset -c {cpu} dada_db -a {hdr_size} -k {dadakey} -b {buffersize} -n {nbuffer} -p " \
-              "-r {nreader} &".format(cpu=cpu, **self.config)
-        self.log(cmd)
-        os.system(cmd)
+        pin = self.pin('dada_db')
+        # allocate the ringbuffer on the NUMA node of the writer
+        node = self.placer.node('dada_db')
+        if node is not None:
+            if find_executable('numactl'):
+                pin = "numactl --membind={} {}".format(node, pin)
+            else:
+                self.log("WARNING: numactl not found, ringbuffer memory is not bound to NUMA node {}".format(node))
+        cmd = "{pin}dada_db -a {hdr_size} -k {dadakey} -b {buffersize} -n {nbuffer} -p " \
+              "-r {nreader}".format(pin=pin, **self.config)
+        self.supervisor.start('dada_db', cmd)
+        # store layout so a next observation in fast start mode can reuse the ringbuffer
+        state = dict([(key, self.config[key]) for key in RINGBUFFER_KEYS])
+        with open(RINGBUFFER_STATE.format(**self.config), 'w') as f:
+            yaml.dump(state, f, default_flow_style=False)
+
+    def ringbuffer_exists(self):
+        """
+        Check whether the shared memory of the ringbuffer exists
+        """
+        return shm_nattach(self.config['dadakey']) is not None
+
+    def reuse_ringbuffer(self):
+        """
+        Check whether the ringbuffer of a previous observation can be used for this observation.
+        The layout has to be the same, no programme may still use the ringbuffer and all data has to be read.
+        A writer or reader that is stopped halfway can leave a lock or unread data behind,
+        so then the ringbuffer is recreated
+        """
+        try:
+            with open(RINGBUFFER_STATE.format(**self.config), 'r') as f:
+                state = yaml.load(f)
+        except IOError:
+            return False
+        if not isinstance(state, dict):
+            return False
+        for key in RINGBUFFER_KEYS:
+            if not state.get(key) == self.config[key]:
+                self.log("Ringbuffer setting {} changed, recreating ringbuffer".format(key))
+                return False
+        if not self.ringbuffer_exists():
+            return False
+        users = key_users(self.config['dadakey'])
+        # the monitor of the previous observation does not hold any lock
+        samplers = [pid for pid, name in users.items() if name.startswith(SAMPLERS)]
+        stop_processes(samplers)
+        users = dict([(pid, name) for pid, name in users.items() if pid not in samplers])
+        if users:
+            self.log("{} of previous observation still running, recreating ringbuffer".format(
+                ', '.join(sorted(set(users.values())))))
+            return False
+        nattach = shm_nattach(self.config['dadakey'])
+        if nattach:
+            self.log("{} processes still attached, recreating ringbuffer".format(nattach))
+            return False
+        state = ringbuffer_monitor.dbmetric(self.config['dadakey'])
+        if state is None:
+            self.log("Could not read ringbuffer state, recreating ringbuffer")
+            return False
+        total, full, clear, written, read = state
+        if full or not clear == total or not written == read:
+            self.log("Ringbuffer holds unread data ({} of {} buffers full, {} clear), "
+                     "recreating ringbuffer".format(full, total, clear))
+            return False
+        return True
+
+    def ringbuffer_monitor(self):
+        """
+        Start sampling the ringbuffer state
+        """
+        self.log("Starting ringbuffer monitor")
+        # stop at the latest some time after the end of the observation
+        end = max(self.config['unixstart'], time()) + self.config['duration'] + FINISH_TIMEOUT
+        cmd = ("python {script_dir}/ringbuffer_monitor.py --key {dadakey} --end {end:.0f}"
+               " --interval {interval} --idle {idle} --output {log_dir}/ringbuffer.{beam:02d}.bin"
+               " --summary {master_dir}/CB{beam:02d}_ringbuffer.yaml").format(
+                   script_dir=os.path.dirname(os.path.realpath(__file__)), end=end,
+                   **dict(self.config, **self.config['telemetry']))
+        self.supervisor.start('ringbuffer_monitor', cmd,
+                              log_file="{log_dir}/ringbuffer_monitor.{beam:02d}".format(**self.config))
 
     def fill_ringbuffer(self, reorder=False):
         self.log("Starting fill_ringbuffer")
-        cpu = self.config['affinity']['fill_ringbuffer_i']
+        pin = self.pin('fill_ringbuffer')
         if reorder:
-            cmd = ("taskset -c {cpu} fill_ringbuffer -f -k {dadakey} -s {startpacket} -d {duration}"
-                   " -p {network_port} -h {header} -l {log_dir}/fill_ringbuffer.{beam:02d} &").format(cpu=cpu,
-                                                                                                      **self.config)
+            cmd = ("{pin}fill_ringbuffer -f -k {dadakey} -s {startpacket} -d {duration}"
+                   " -p {network_port} -h {header} -l {log_dir}/fill_ringbuffer.{beam:02d}").format(pin=pin,
+                                                                                                    **self.config)
         else:
-            cmd = ("taskset -c {cpu} fill_ringbuffer -k {dadakey} -s {startpacket} -d {duration}"
-                   " -p {network_port} -h {header} -l {log_dir}/fill_ringbuffer.{beam:02d} &").format(cpu=cpu,
-                                                                                                      **self.config)
-        self.log(cmd)
-        os.system(cmd)
+            cmd = ("{pin}fill_ringbuffer -k {dadakey} -s {startpacket} -d {duration}"
+                   " -p {network_port} -h {header} -l {log_dir}/fill_ringbuffer.{beam:02d}").format(pin=pin,
+                                                                                                    **self.config)
+        self.supervisor.start('fill_ringbuffer', cmd)
 
     def diskdb(self):
         self.log("Starting dada_diskdb")
-        cpu = self.config['affinity']['fill_ringbuffer_i']
+        # the disk reader takes the place of fill_ringbuffer
+        pin = self.pin('fill_ringbuffer')
         files = os.listdir(self.config['dada_dir'])
         files.sort()
         arg = " -f {dada_dir}/".format(**self.config) + " -f {dada_dir}/".format(**self.config).join(files)
-        cmd = "taskset -c {cpu} dada_diskdb -k {dadakey} {arg} &".format(cpu=cpu, arg=arg, **self.config)
-        self.log(cmd)
-        os.system(cmd)
+        cmd = "{pin}dada_diskdb -k {dadakey} {arg}".format(pin=pin, arg=arg, **self.config)
+        self.supervisor.start('dada_diskdb', cmd)
 
     def scrub(self):
         self.log("Starting dada_dbscrubber")
-        cmd = "dada_dbscrubber -k {dadakey} > {log_dir}/dada_dbscrubber.{beam:02d} &".format(**self.config)
-        self.log(cmd)
-        os.system(cmd)
+        cmd = "{pin}dada_dbscrubber -k {dadakey}".format(pin=self.pin('dada_dbscrubber'), **self.config)
+        self.supervisor.start('dada_dbscrubber', cmd,
+                              log_file="{log_dir}/dada_dbscrubber.{beam:02d}".format(**self.config))
 
     def dump(self):
         self.log("Starting dada_dbdisk")
-        cpu = self.config['affinity']['dada_dbdisk_i']
         output_dir = os.path.join(self.config['output_dir'], 'dada')
         os.system("mkdir -p {}".format(output_dir))
-        cmd = "taskset -c {cpu} dada_dbdisk -k {dadakey} -D {output_prefix} " \
-              "> {log_dir}/dada_dbdisk.{beam:02d} &".format(cpu=cpu, output_prefix=output_dir, **self.config)
-        self.log(cmd)
-        os.system(cmd)
+        cmd = "{pin}dada_dbdisk -k {dadakey} -D {output_prefix}".format(pin=self.pin('dada_dbdisk'),
+                                                                        output_prefix=output_dir, **self.config)
+        self.supervisor.start('dada_dbdisk', cmd, log_file="{log_dir}/dada_dbdisk.{beam:02d}".format(**self.config))
 
     def dadafilterbank(self):
         self.log("Starting dadafilterbank")
-        cpu = self.config['affinity']['dadafilterbank']
         output_dir = os.path.join(self.config['output_dir'], 'filterbank')
         os.system("mkdir -p {}".format(output_dir))
         output_prefix = os.path.join(output_dir, 'CB{:02d}'.format(self.config['beam']))
-        cmd = "export OMP_NUM_THREADS={threads}; taskset -c {cpu} dadafilterbank -k {dadakey} -n {output_prefix} " \
-              "-l {log_dir}/dadafilterbank.{beam:02d} &".format(cpu=cpu, output_prefix=output_prefix,
-                                                                threads=NUMTHREADS, **self.config)
-        self.log(cmd)
-        os.system(cmd)
+        cmd = "{pin}dadafilterbank -k {dadakey} -n {output_prefix} " \
+              "-l {log_dir}/dadafilterbank.{beam:02d}".format(pin=self.pin('dadafilterbank'),
+                                                              output_prefix=output_prefix, **self.config)
+        # one thread per assigned cpu
+        if self.config['placement']['mode'] == 'plan':
+            nthread = len(placement.parse_cpulist(self.placement['dadafilterbank']))
+        else:
+            nthread = NUMTHREADS
+        self.supervisor.start('dadafilterbank', cmd, env={'OMP_NUM_THREADS': nthread})
 
     def dadafits(self):
         self.log("Starting dadafits")
-        cpu = self.config['affinity']['dadafits']
         output_dir = os.path.join(self.config['output_dir'], 'fits', 'CB{:02d}'.format(self.config['beam']))
         os.system("mkdir -p {}".format(output_dir))
-        cmd = "taskset -c {cpu} dadafits -k {dadakey} -l {log_dir}/dadafits.{beam:02d} -t {fits_templates} -d " \
-              "{output_fits} &".format(cpu=cpu, output_fits=output_dir, **self.config)
-        self.log(cmd)
-        os.system(cmd)
+        cmd = "{pin}dadafits -k {dadakey} -l {log_dir}/dadafits.{beam:02d} -t {fits_templates} -d " \
+              "{output_fits}".format(pin=self.pin('dadafits'), output_fits=output_dir, **self.config)
+        self.supervisor.start('dadafits', cmd)
 
     def amber(self):
         self.log("Starting AMBER")
@@ -189,7 +447,7 @@ class Survey(object):
             self.log("Starting amber in subband mode")
             # loop over the amber configs for the GPUs
             for ind in range(len(ambercfg['opencl_device'])):
-                cpu = self.config['affinity']['amber'][ind]
+                pin = self.pin('amber_{}'.format(ind+1))
                 # make dict with fullconfig, because AMBER settings are spread over the general
                 # and node-specific config files
                 fullconfig = ambercfg.copy()
@@ -206,7 +464,7 @@ class Survey(object):
                 else:
                     fullconfig['downsampling_cmd'] = ''
 
-                cmd = (" taskset -c {cpu} amber -sync -print -opencl_platform {opencl_platform}"
+                cmd = ("{pin}amber -sync -print -opencl_platform {opencl_platform}"
                        " -opencl_device {opencl_device} -device_name {device_name}"
                        " -padding_file {amber_conf_dir}/padding.conf"
                        " -zapped_channels {amber_conf_dir}/zapped_channels.conf"
@@ -223,10 +481,10 @@ class Survey(object):
                        " -mom_steptwo_file {amber_conf_dir}/mom_steptwo.conf -momad_file {amber_conf_dir}/momad.conf"
                        " {downsampling_cmd} -downsampling_configuration {amber_conf_dir}/downsampling.conf -downsampling_factor {downsamp}"
                        " -threshold {snrmin} -output {output_prefix}_step{ind} -beams {ntabs} -synthesized_beams {nsynbeams}"
-                       " -dada -dada_key {dadakey} -batches {nbatch} -compact_results"
-                       " 2>&1 > {log_dir}/amber_{ind}.{beam:02d} &").format(cpu=cpu, ind=ind+1, **fullconfig)
-                self.log(cmd)
-                os.system(cmd)
+                       " -dada -dada_key {dadakey} -batches {nbatch} -compact_results").format(pin=pin, ind=ind+1,
+                                                                                               **fullconfig)
+                self.supervisor.start('amber_{}'.format(ind+1), cmd,
+                                      log_file="{log_dir}/amber_{ind}.{beam:02d}".format(ind=ind+1, **self.config))
 
     def survey(self):
         self.amber()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+#
+# Start and track the processes of an observation on a node
+# Author: L.C. Oostrum
+
+import os
+import shlex
+import signal
+import subprocess
+from time import sleep, time
+
+# command line options that select the ringbuffer of a PSRDADA programme
+KEY_OPTIONS = ('-k', '-dada_key', '--key')
+
+
+def dada_key(key):
+    """
+    Convert PSRDADA key to the shared memory key as shown by ipcs
+    key: PSRDADA key, hexadecimal (string or int, e.g. 5021 = 0x5021)
+    """
+    return "0x{:08x}".format(int(str(key), 16))
+
+
+def shm_nattach(key):
+    """
+    Get number of processes attached to a shared memory segment
+    key: PSRDADA key
+    returns: number of attached processes, None if the segment does not exist
+    """
+    try:
+        output = subprocess.check_output(['ipcs', '-m'])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    # columns: key shmid owner perms bytes nattch status
+    shmkey = dada_key(key)
+    for line in output.split('\n'):
+        cols = line.split()
+        if len(cols) >= 6 and cols[0] == shmkey:
+            return int(cols[5])
+    return None
+
+
+def key_users(key):
+    """
+    Get the processes that use a ringbuffer, recognised by the key on their command line
+    key: PSRDADA key
+    returns: dict of PID: process name
+    """
+    users = {}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            with open('/proc/{}/cmdline'.format(pid), 'r') as f:
+                args = f.read().split('\0')
+            with open('/proc/{}/comm'.format(pid), 'r') as f:
+                name = f.read().strip()
+        except IOError:
+            # process exited
+            continue
+        for option, value in zip(args[:-1], args[1:]):
+            if option in KEY_OPTIONS and value == str(key):
+                users[int(pid)] = name
+                break
+    return users
+
+
+def stop_processes(pids, timeout=10):
+    """
+    Stop processes, killing those that do not exit in time
+    pids: list of PIDs
+    timeout: time to wait after asking the processes to stop (s)
+    returns: PIDs that had to be killed
+    """
+    def alive(pid):
+        # exited processes that were not reaped yet are zombies (state Z)
+        try:
+            with open('/proc/{}/stat'.format(pid), 'r') as f:
+                return not f.read().rsplit(')', 1)[1].split()[0] == 'Z'
+        except (IOError, IndexError):
+            return False
+
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    tstart = time()
+    remaining = [pid for pid in pids if alive(pid)]
+    while remaining and time() - tstart < timeout:
+        sleep(.1)
+        remaining = [pid for pid in remaining if alive(pid)]
+    for pid in remaining:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+    return remaining
+
+
+class Supervisor(object):
+    """
+    Start processes and keep track of their PIDs, exit codes and run times
+    """
+
+    def __init__(self, poll=0.05, logger=None):
+        """
+        poll: interval for checking conditions (s)
+        logger: function to log messages with (Default: print)
+        """
+        self.poll = poll
+        self.procs = {}
+        # order in which processes were started
+        self.names = []
+        if logger is None:
+            self.log = self._log
+        else:
+            self.log = logger
+
+    def _log(self, message):
+        """
+        Log a message. Prints the message
+        """
+        print message
+
+    def start(self, name, cmd, log_file=None, env=None):
+        """
+        Start a process
+        name: name of the component, must be unique
+        cmd: command to run (no shell features)
+        log_file: file for stdout and stderr (Default: inherit)
+        env: extra environment variables
+        returns: subprocess.Popen object, None if the process could not be started
+        """
+        self.log(cmd)
+        full_env = None
+        if env is not None:
+            full_env = os.environ.copy()
+            full_env.update(dict([(key, str(value)) for key, value in env.items()]))
+        out = None
+        if log_file is not None:
+            out = open(log_file, 'w')
+        try:
+            proc = subprocess.Popen(shlex.split(cmd), stdout=out, stderr=subprocess.STDOUT, env=full_env)
+        except OSError as e:
+            self.log("ERROR: Could not start {}: {}".format(name, e))
+            proc = None
+        finally:
+            if out is not None:
+                # the child has its own copy of the file descriptor
+                out.close()
+        tstart = time()
+        if proc is None:
+            self.procs[name] = {'proc': None, 'cmd': cmd, 'start': tstart, 'end': tstart, 'returncode': -1}
+        else:
+            self.procs[name] = {'proc': proc, 'cmd': cmd, 'start': tstart, 'end': None, 'returncode': None}
+        self.names.append(name)
+        return proc
+
+    def poll_all(self):
+        """
+        Update the status of all processes, logging those that exited
+        """
+        for name in self.names:
+            info = self.procs[name]
+            if info['proc'] is None or info['end'] is not None:
+                continue
+            returncode = info['proc'].poll()
+            if returncode is not None:
+                info['end'] = time()
+                info['returncode'] = returncode
+                self.log("{} exited with code {} after {:.1f} s".format(name, returncode,
+                                                                       info['end'] - info['start']))
+
+    def running(self, name):
+        """
+        Check whether a process is running
+        """
+        self.poll_all()
+        info = self.procs[name]
+        return info['proc'] is not None and info['end'] is None
+
+    def failed(self):
+        """
+        Get names of processes that could not start or exited with non-zero exit code
+        """
+        self.poll_all()
+        return [name for name in self.names if self.procs[name]['returncode'] not in (None, 0)]
+
+    def watch(self, duration):
+        """
+        Watch for processes that fail within a period
+        duration: time to watch (s)
+        returns: names of failed processes, as soon as there are any
+        """
+        tstart = time()
+        while time() - tstart < duration:
+            failed = self.failed()
+            if failed:
+                return failed
+            sleep(self.poll)
+        return self.failed()
+
+    def wait_for(self, condition, timeout, description):
+        """
+        Wait until a condition is true
+        condition: function without arguments that returns True when ready
+        timeout: maximum time to wait (s)
+        description: description of condition for log
+        returns: True if the condition was met, False on timeout
+        """
+        tstart = time()
+        while time() - tstart < timeout:
+            if condition():
+                self.log("{} after {:.2f} s".format(description, time() - tstart))
+                return True
+            sleep(self.poll)
+        self.log("WARNING: Timeout waiting for: {}".format(description))
+        return False
+
+    def wait(self, name, timeout=None):
+        """
+        Wait until a process exits
+        name: name of the component
+        timeout: maximum time to wait (s), None for no limit
+        returns: exit code, None if still running
+        """
+        tstart = time()
+        while self.running(name):
+            if timeout is not None and time() - tstart > timeout:
+                return None
+            sleep(self.poll)
+        return self.procs[name]['returncode']
+
+    def report(self):
+        """
+        Log status, PID, exit code and run time of all processes
+        """
+        self.poll_all()
+        now = time()
+        self.log("{:<20s} {:>7s} {:>8s} {:>10s}".format("Component", "PID", "Exit", "Runtime (s)"))
+        for name in self.names:
+            info = self.procs[name]
+            pid = '-' if info['proc'] is None else str(info['proc'].pid)
+            returncode = 'running' if info['returncode'] is None else str(info['returncode'])
+            runtime = (info['end'] or now) - info['start']
+            self.log("{:<20s} {:>7s} {:>8s} {:>10.1f}".format(name, pid, returncode, runtime))
@@ -1,114 +1,266 @@
 #!/usr/bin/env python
+import os
 import sys
+import signal
 import socket
-from time import sleep
+from time import time
 import argparse
 
 import numpy as np
-from astropy.time import Time, TimeDelta
+
+import file_watch
+from amber_triggers import COLUMNS, StepTail
+from trigger_latency import LatencyLog, format_summary
+from ml_gate import MLGate
+from trigger_sender import TriggerSender, merge_events
+
+
+class DumpScheduler(object):
+    """
+    Decide which dump windows to send, given how long data stays in the ringbuffer and
+    how much data the disks can absorb
+    """
+
+    def __init__(self, horizon, budget, period, on_drop=None):
+        """
+        horizon: time data survives in the ringbuffer (s)
+        budget: maximum amount of data to dump per period (s of data)
+        period: period over which the budget applies (s)
+        on_drop: function called with each event that is not dumped and the reason (covered or dropped)
+        """
+        self.horizon = horizon
+        self.budget = budget
+        self.rate = float(budget) / period
+        # dump budget is a token bucket, starting full
+        self.tokens = budget
+        self.last = None
+        self.pending = []
+        self.dumped = []
+        self.nlost = 0
+        self.on_drop = on_drop
+
+    def add(self, event):
+        """
+        Add an event. Parts of its window that were already dumped are removed
+        event: dict with t_event, t_start, t_end (unix time), DM, SNR, width, beam
+        """
+        for t_start, t_end in self.dumped:
+            if t_start <= event['t_event'] <= t_end:
+                # already captured
+                if self.on_drop is not None:
+                    self.on_drop(event, 'covered')
+                return
+            if t_start <= event['t_start'] < t_end:
+                event['t_start'] = t_end
+            if t_start < event['t_end'] <= t_end:
+                event['t_end'] = t_start
+        self.pending = merge_events(self.pending + [event])
+
+    def schedule(self, now=None):
+        """
+        Get the events to dump now, best first. The window of an event is clipped to the data that is still in
+        the ringbuffer. An event that does not fit in the budget is kept until it does, unless the event itself
+        would be overwritten in the ringbuffer by then
+        now: current time (Default: time())
+        returns: list of events
+        """
+        if now is None:
+            now = time()
+        if self.last is not None:
+            self.tokens = min(self.budget, self.tokens + max(now - self.last, 0) * self.rate)
+        self.last = now
+        # forget dumped windows that have left the ringbuffer
+        self.dumped = [window for window in self.dumped if window[1] > now - self.horizon]
+
+        selected = []
+        remaining = []
+        blocked = False
+        # highest S/N first, higher DM first among equally bright events
+        for event in sorted(self.pending, key=lambda event: (event['SNR'], event['DM']), reverse=True):
+            # oldest data that is still in the ringbuffer
+            oldest = now - self.horizon
+            if event['t_event'] <= oldest:
+                self.drop(event, "data left the ringbuffer {:.2f} s after the event".format(self.horizon))
+                continue
+            # only dump the part of the window that is still available
+            event['t_start'] = max(event['t_start'], oldest)
+            size = event['t_end'] - event['t_start']
+            if now + max(size - self.tokens, 0) / self.rate >= event['t_event'] + self.horizon:
+                self.drop(event, "dump budget is exhausted until the data leaves the ringbuffer")
+            elif not blocked and size <= self.tokens:
+                self.tokens -= size
+                self.dumped.append((event['t_start'], event['t_end']))
+                selected.append(event)
+            else:
+                # wait for budget, do not let fainter events use it first
+                blocked = True
+                remaining.append(event)
+        self.pending = remaining
+        return selected
+
+    def drop(self, event, reason):
+        """
+        Drop an event that cannot be dumped
+        event: event dict
+        reason: reason for the log
+        """
+        print "Dropping event at DM={:.2f} SNR={:.2f}: {}".format(event['DM'], event['SNR'], reason)
+        self.nlost += 1
+        if self.on_drop is not None:
+            self.on_drop(event, 'dropped')
 
 
 class Trigger(object):
 
 
-    def __init__(self, args)
+    def __init__(self, args):
         """
         args: settings through argument parser
         """
 
         config = vars(args)
-        # Convert start time to an Astropy time object
-        config['tstart'] = Time(config['tstart'], format='unix')
+        # start time is kept as unix timestamp, all timing is done in seconds
 
         for key, value in config.items():
             setattr(self, key, value)
 
         self.ntrig = 0
+        # dump window around each event
+        self.dt = self.dumpsize
+        # reads the complete lines appended to the trigger file since the previous check
+        self.tail = StepTail(self.fname, 0)
+        # the page being written cannot be dumped, the others survive for one pass through the ringbuffer
+        horizon = (self.nbuffer - 1) * self.page_size * self.tsamp
+        self.scheduler = DumpScheduler(horizon, self.budget, self.budget_period, on_drop=self.dropped)
+        # timeline of every candidate, from arrival in the data to delivery of the dump command
+        if self.latency_log is None:
+            self.latency_log = "{}.latency".format(os.path.splitext(self.fname)[0])
+        self.latency = LatencyLog(self.latency_log)
+        # optional classifier, candidates it does not answer for within the budget only need to pass the thresholds
+        if self.ml_gate:
+            host, port = self.ml_gate.split(':')
+            self.gate = MLGate(host, int(port), self.ml_budget)
+        else:
+            self.gate = None
+        print "Ringbuffer retention: {:.2f} s".format(horizon)
+        if horizon < self.dumpsize:
+            print "WARNING: ringbuffer retention is shorter than the dump size, dumps are clipped to the " \
+                  "data that is still available"
+        # events are queued and sent from a separate thread, so a slow receiver does not block the watcher
+        if self.aggregator:
+            # forward all selected candidates to the cluster-wide aggregator, which decides what to dump.
+            # It reads candidates until the node disconnects, so the connection is kept open
+            host, port = self.aggregator.split(':')
+            if self.cb is None:
+                self.cb = int(socket.gethostname()[5:7]) - 1
+            self.sender = TriggerSender(host, int(port), self.tstart, maxqueue=self.maxqueue,
+                                        coalesce=self.coalesce, persistent=True, candidates=True,
+                                        on_sent=self.sent)
+        else:
+            self.sender = TriggerSender(self.host, self.port, self.tstart, maxqueue=self.maxqueue,
+                                        coalesce=self.coalesce, persistent=self.persistent,
+                                        on_sent=self.sent)
 
 
     def run(self):
-        prev_time = Time(0, format='unix')
-        while True:
-            new_time = Time.now()
-            delta = (new_time-prev_time)
-            if (new_time-prev_time).sec >= self.interval:
-                prev_time = new_time
+        # wake up as soon as the trigger file is written to, and check at least every interval
+        watch = file_watch.watcher(self.fname, self.watch)
+        print "Watching {} with {}".format(self.fname, watch.method)
+        try:
+            self.check_triggers()
+            while True:
+                watch.wait(self.interval)
                 self.check_triggers()
-            else:
-                sleep(.05)
+        finally:
+            watch.close()
+            # give the sender a moment to deliver what is queued, so its latency is known
+            self.sender.flush(timeout=5)
+            summary = self.latency.close()
+            print "Trigger latency ({})".format(self.latency_log)
+            print '\n'.join(format_summary(summary))
 
 
     def check_triggers(self):
         print "Checking triggers"
-        # load new triggers
-        try:
-            alltrigs = np.loadtxt(self.fname, dtype=float, ndmin=2)
-        except IOError:
-            print "Trigger file does not exist yet"
-            return
-        if len(alltrigs) == 0:
-            print alltrigs
-            print "No triggers yet"
-            return
-        if len(alltrigs) == self.ntrig:
+        self.select_triggers()
+        # send what fits in the dump budget, also when there are no new triggers
+        for event in self.scheduler.schedule():
+            print "Sending trigger"
+            self.send_trigger(event)
+
+
+    def select_triggers(self):
+        # load new complete lines only
+        triggers = self.tail.read()
+        seen = time()
+        if len(triggers) == 0:
             print "No new triggers"
             return
 
-        print "Found new triggers"
-        # skip already processed triggers
-        triggers = list(alltrigs[self.ntrig:])
-        # set number of processed triggesr
+        print "Found {} new triggers".format(len(triggers))
+        # set number of processed triggers
         self.ntrig += len(triggers)
-        # sort by last column = S/N
-        triggers.sort(key=lambda x: x[-1])
-        # pick brightest
-        trigger = triggers[0]
-        # check S/N and age
-        snr = trigger[-1]
-        dm = trigger[6]
-        age = (Time.now() - TimeDelta(trigger[5], format='sec') - self.tstart ).sec
-        print age, self.maxage
-        if snr >= self.snrmin and age <= self.maxage and dm >= self.dmmin and dm <= self.dmmax:
-            print "Trigger ok, creating command"
-            command = self.create_trigger(trigger)
-            print "Sending trigger"
-            self.send_trigger(command)
-        else:
+        # select the triggers worth a dump
+        age = seen - self.tstart - triggers['time']
+        mask = (triggers['SNR'] >= self.snrmin) & (age <= self.maxage) & \
+               (triggers['DM'] >= self.dmmin) & (triggers['DM'] <= self.dmmax)
+        ml_rejected = np.zeros(len(triggers), dtype=bool)
+        if self.gate is not None and mask.any():
+            probs = self.gate.classify(triggers['time'][mask], triggers['DM'][mask],
+                                       triggers['integration_step'][mask] * 4.096e-5)
+            nfallback = probs.count(None)
+            if nfallback:
+                print "No classification for {} candidates within {} s, using S/N threshold only".format(
+                    nfallback, self.ml_budget)
+            ml_rejected[mask] = [p is not None and p < self.pthresh for p in probs]
+            print "Classifier rejected {} of {} candidates".format(ml_rejected.sum(), mask.sum())
+            mask &= ~ml_rejected
+        # the file modification time is the time AMBER wrote the last of the new triggers
+        ids = self.latency.record(self.tstart + triggers['time'], triggers['DM'], triggers['SNR'],
+                                  self.tail.mtime, seen, mask, ml_rejected)
+        if not mask.any():
             print "Trigger not ok"
+            return
+        if self.aggregator:
+            print "Forwarding {} candidates".format(mask.sum())
+            for trigger, i in zip(triggers[mask], ids):
+                self.send_trigger({'cb': self.cb, 'time': self.tstart + trigger['time'], 'DM': trigger['DM'],
+                                   'SNR': trigger['SNR'], 'width': trigger['integration_step'] * 4.096e-5,
+                                   'beam': trigger['beam'], 'ids': [i]})
+            return
+        print "Trigger ok, creating events"
+        # overlapping windows are merged by the scheduler, keeping the brightest
+        for trigger, i in zip(triggers[mask], ids):
+            event = self.create_trigger([trigger[column] for column in COLUMNS])
+            event['ids'] = [i]
+            self.scheduler.add(event)
 
 
     def create_trigger(self, trig):
-        beam, batch, sample, integration_step, compacted_integration_steps, time, DM, compacted_DMs, SNR = trig
+        beam, batch, sample, integration_step, compacted_integration_steps, t_arrival, DM, compacted_DMs, SNR = trig
         width = integration_step * 4.096e-5
 
-        t_event = self.tstart + TimeDelta(time, format='sec')
-        utc_start = self.tstart.datetime.strftime('%Y-%m-%d-%H:%M:%S')
+        t_event = self.tstart + t_arrival
+        print "Trigger: t={0:.2f}    DM={1:.2f}    SNR={2:.2f}".format(t_arrival, DM, SNR)
 
-        t_start = t_event - TimeDelta(.5*self.dt, format='sec')
-        t_start_frac = 0 #t_start.unix - int(t_start.unix)
-        t_end = t_event + TimeDelta(.5*self.dt, format='sec')
-        t_end_frac = 0 #t_end.unix - int(t_end.unix)
-        t_start = t_start.datetime.strftime('%Y-%m-%d-%H:%M:%S')
-        t_end = t_end.datetime.strftime('%Y-%m-%d-%H:%M:%S')
-        print "Trigger: t={0:.2f}    DM={1:.2f}    SNR={2:.2f}".format(time, DM, SNR)
+        return {'t_event': t_event, 't_start': t_event - .5*self.dt, 't_end': t_event + .5*self.dt, 'DM': DM,
+                'SNR': SNR, 'width': width, 'beam': beam}
 
-        command="""N_EVENTS 1
-{utc_start}
-{t_start} {t_start_frac} {t_end} {t_end_frac}  {DM} {SNR} {width} {beam}
-""".format(utc_start=utc_start, t_start=t_start, t_start_frac=t_start_frac, t_end=t_end, t_end_frac=t_end_frac, DM=DM, SNR=SNR, width=width, beam=int(beam))
 
-        with open('trigger.txt', 'w') as f:
-            f.writelines(command)
+    def send_trigger(self, event):
+        # only queues the event, the sender thread delivers it
+        if not self.sender.send(event):
+            self.dropped(event, 'dropped')
 
-        return command
 
+    def sent(self, events, t_sent):
+        # called by the sender thread once events are delivered
+        for event in events:
+            self.latency.done(event['ids'], 'forwarded' if self.aggregator else 'dumped', t_sent)
 
-    def send_trigger(self, trigger):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((self.host, self.port))
-        s.sendall(trigger.encode())
-        s.shutdown(socket.SHUT_WR)
-        s.close()
+
+    def dropped(self, event, reason):
+        self.latency.done(event['ids'], reason)
 
 
 if __name__ == '__main__':
@@ -117,22 +269,58 @@ if __name__ == '__main__':
     parser.add_argument("--tstart", type=float, help="Observation start time (unix timestamp)", required=True)
     parser.add_argument("--fname", type=str, help="Filename to watch", required=True)
 
-    parser.add_argument("--interval", type=float, help="Interval for checking triggers (s) " \
+    parser.add_argument("--interval", type=float, help="Maximum interval for checking triggers (s) " \
                             "(Default: 2)", default="2")
+    parser.add_argument("--watch", type=str, choices=['inotify', 'poll'], help="Method to detect new triggers, " \
+                            "inotify falls back to poll if not available (Default: inotify)", default="inotify")
     parser.add_argument("--snrmin", type=float, help="Minium S/N" \
                             "(Default: 20)", default=20)
     parser.add_argument("--dmmin", type=float, help="Minimum DM" \
                             "(Default: 100)", default=100)
     parser.add_argument("--dmmax", type=float, help="Maximum DM" \
                             "(Default: 5000)", default=5000)
+    parser.add_argument("--maxage", type=float, help="Maximum age of a trigger to still dump the data (s)" \
+                            "(Default: 10)", default=10)
     parser.add_argument("--dumpsize", type=float, help="Size of data dump (s)" \
                             "(Default: 6.0)", default=6.0)
+    parser.add_argument("--nbuffer", type=int, help="Nr of pages in the ringbuffer the dumps are taken from, " \
+                            "the default keeps a 6 s dump and a few s of trigger latency (Default: 10)", default=10)
+    parser.add_argument("--page_size", type=int, help="Nr of samples per ringbuffer page " \
+                            "(Default: 12500)", default=12500)
+    parser.add_argument("--tsamp", type=float, help="Sampling time (s) " \
+                            "(Default: 8.192e-5)", default=8.192e-5)
+    parser.add_argument("--budget", type=float, help="Maximum amount of data to dump per budget period (s) " \
+                            "(Default: 60)", default=60)
+    parser.add_argument("--budget_period", type=float, help="Period of the dump budget (s) " \
+                            "(Default: 600)", default=600)
     parser.add_argument("--host", type=str, help="Host name to send events to" \
                             "(Default: localhost)", default="localhost")
     parser.add_argument("--port", type=int, help="Port to send events to" \
                             "(Default: 30000)", default=30000)
+    parser.add_argument("--coalesce", type=float, help="Time to wait for more events before sending " \
+                            "them in one message (s) (Default: 0.1)", default=0.1)
+    parser.add_argument("--maxqueue", type=int, help="Maximum nr of events waiting to be sent " \
+                            "(Default: 100)", default=100)
+    parser.add_argument("--persistent", action="store_true", help="Keep the connection to the receiver open " \
+                            "instead of connecting for every message, the receiver must read several messages " \
+                            "per connection")
+    parser.add_argument("--latency_log", type=str, help="File to record the latency of each candidate in " \
+                            "(Default: trigger file with .latency extension)")
+    parser.add_argument("--ml_gate", type=str, help="Only dump candidates the resident classifier " \
+                            "(ml_gate.py) at host:port accepts")
+    parser.add_argument("--pthresh", type=float, help="Minimum probability of the classifier " \
+                            "(Default: 0.5)", default=0.5)
+    parser.add_argument("--ml_budget", type=float, help="Maximum time to wait for the classifier (s), " \
+                            "after which the S/N threshold is used (Default: 0.5)", default=0.5)
+    parser.add_argument("--aggregator", type=str, help="Forward candidates to the trigger aggregator at " \
+                            "host:port instead of sending dump events. The aggregator decides what to dump, " \
+                            "the dump budget and ringbuffer retention are not applied to forwarded candidates")
+    parser.add_argument("--cb", type=int, help="CB index of this node, for the aggregator " \
+                            "(Default: from host name)")
 
 
     args = parser.parse_args()
+    # stop cleanly on kill, so the latency summary is written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     t = Trigger(args)
     t.run()
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+#
+# Cluster-wide aggregation of IQUV dump triggers
+# Candidates of all compound beams are grouped by arrival time and DM. A group seen by many CBs at once
+# is RFI, every other group results in one dump, sent to each CB that saw it
+# Author: L.C. Oostrum
+
+import os
+import re
+import sys
+import glob
+import socket
+import argparse
+import threading
+from Queue import Queue, Empty
+from time import time
+from datetime import datetime
+
+import yaml
+
+from amber_triggers import StepTail
+from launcher import node_to_hostname
+from trigger_sender import TriggerSender, parse_candidate
+
+CONFIG = "config.yaml"
+# CB index in trigger file names
+CB_FILE = re.compile(r"CB(\d\d)[^/]*\.trigger$")
+
+
+def log(message):
+    """
+    Log a message. Prepends the message with a fixed string
+    """
+    print "Aggregator: {}".format(message)
+    sys.stdout.flush()
+
+
+class CandidateGroup(object):
+    """
+    Candidates of one event, seen by one or more CBs
+    """
+
+    def __init__(self, candidate, arrival):
+        """
+        candidate: first candidate of the group
+        arrival: time the first candidate was received (unix time)
+        """
+        self.candidates = [candidate]
+        self.arrival = arrival
+
+    @property
+    def brightest(self):
+        return max(self.candidates, key=lambda candidate: candidate['SNR'])
+
+    @property
+    def cbs(self):
+        return sorted(set([candidate['cb'] for candidate in self.candidates]))
+
+    def matches(self, candidate, time_tolerance, dm_tolerance):
+        """
+        Check whether a candidate belongs to this group
+        candidate: candidate dict
+        time_tolerance: maximum arrival time difference (s)
+        dm_tolerance: maximum DM difference (pc/cc)
+        returns: True if the candidate is close to any candidate in the group
+        """
+        for member in self.candidates:
+            if abs(candidate['time'] - member['time']) <= time_tolerance and \
+               abs(candidate['DM'] - member['DM']) <= dm_tolerance:
+                return True
+        return False
+
+
+class Aggregator(object):
+    """
+    Group candidates of all CBs and decide which groups to dump
+    """
+
+    def __init__(self, time_tolerance=0.1, dm_tolerance=10., hold=2., max_cbs=4, dumpsize=6., logger=log):
+        """
+        time_tolerance: maximum arrival time difference of candidates of the same event (s)
+        dm_tolerance: maximum DM difference of candidates of the same event (pc/cc)
+        hold: time to wait for other CBs after the first candidate of an event (s)
+        max_cbs: events seen by more CBs than this are RFI
+        dumpsize: size of the data dump around each event (s)
+        logger: function to log messages with (Default: log)
+        """
+        self.time_tolerance = time_tolerance
+        self.dm_tolerance = dm_tolerance
+        self.hold = hold
+        self.max_cbs = max_cbs
+        self.dumpsize = dumpsize
+        self.groups = []
+        self.log = logger
+
+    def add(self, candidate, now=None):
+        """
+        Add a candidate to the group it belongs to, or start a new group
+        candidate: dict with cb, time (unix time), DM, SNR, width, beam
+        now: current time (Default: time())
+        """
+        if now is None:
+            now = time()
+        for group in self.groups:
+            if group.matches(candidate, self.time_tolerance, self.dm_tolerance):
+                group.candidates.append(candidate)
+                return
+        self.groups.append(CandidateGroup(candidate, now))
+
+    def decide(self, now=None, flush=False):
+        """
+        Close the groups that were held long enough
+        now: current time (Default: time())
+        flush: close all groups
+        returns: list of (dump event, False) for events to dump and (dump event, True) for RFI
+        """
+        if now is None:
+            now = time()
+        done = [group for group in self.groups if flush or now - group.arrival >= self.hold]
+        self.groups = [group for group in self.groups if group not in done]
+        return [(self.event(group), len(group.cbs) > self.max_cbs) for group in done]
+
+    def event(self, group):
+        """
+        Create the dump event of a group
+        group: CandidateGroup
+        returns: dump event dict, with the list of CBs that saw it
+        """
+        brightest = group.brightest
+        times = [candidate['time'] for candidate in group.candidates]
+        return {'t_start': min(times) - .5*self.dumpsize, 't_end': max(times) + .5*self.dumpsize,
+                'DM': brightest['DM'], 'SNR': brightest['SNR'], 'width': brightest['width'],
+                'beam': brightest['beam'], 'cb': brightest['cb'], 'cbs': group.cbs,
+                'ncand': len(group.candidates)}
+
+
+class Dispatcher(object):
+    """
+    Send dump events to the IQUV dump receiver of each CB
+    """
+
+    def __init__(self, utc_start, port, logger=log):
+        """
+        utc_start: start time of the observation (unix time)
+        port: port of the dump receiver on each node
+        logger: function to log messages with (Default: log)
+        """
+        self.utc_start = utc_start
+        self.port = port
+        self.logger = logger
+        self.senders = {}
+
+    def send(self, event):
+        """
+        Send an event to all CBs that saw it
+        event: dump event dict with cbs
+        """
+        for cb in event['cbs']:
+            if cb not in self.senders:
+                self.senders[cb] = TriggerSender(node_to_hostname(cb + 1), self.port, self.utc_start,
+                                                 logger=self.logger)
+            self.senders[cb].send(event)
+
+    def flush(self, timeout=None):
+        for sender in self.senders.values():
+            sender.flush(timeout)
+
+
+class CandidateServer(object):
+    """
+    Receive candidates forwarded by trigger_IQUV.py on the nodes
+    """
+
+    def __init__(self, port, queue):
+        """
+        port: port to listen on
+        queue: queue to put received candidates on
+        """
+        self.queue = queue
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('', port))
+        self.server.listen(64)
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+
+    def accept(self):
+        """
+        Accept connections of the nodes, each is handled by its own thread
+        """
+        while True:
+            conn, addr = self.server.accept()
+            thread = threading.Thread(target=self.handle, args=(conn, ))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        """
+        Read candidates from one node until it disconnects
+        """
+        f = conn.makefile('r')
+        for line in f:
+            candidate = parse_candidate(line)
+            if candidate is not None:
+                self.queue.put(candidate)
+        conn.close()
+
+
+class CandidateFiles(object):
+    """
+    Read candidates from the trigger files of all CBs, e.g. on shared storage
+    """
+
+    def __init__(self, pattern, tstart, snrmin, dmmin, dmmax):
+        """
+        pattern: glob pattern of the trigger files, the file names must contain CBxx
+        tstart: start time of the observation (unix time)
+        snrmin: minimum S/N
+        dmmin: minimum DM
+        dmmax: maximum DM
+        """
+        self.pattern = pattern
+        self.tstart = tstart
+        self.snrmin = snrmin
+        self.dmmin = dmmin
+        self.dmmax = dmmax
+        self.tails = {}
+
+    def read(self):
+        """
+        Read the new candidates of all files
+        returns: list of candidate dicts
+        """
+        for fname in glob.glob(self.pattern):
+            match = CB_FILE.search(fname)
+            if match and fname not in self.tails:
+                self.tails[fname] = (int(match.group(1)), StepTail(fname, 0))
+        candidates = []
+        for cb, tail in self.tails.values():
+            triggers = tail.read()
+            mask = (triggers['SNR'] >= self.snrmin) & (triggers['DM'] >= self.dmmin) & \
+                   (triggers['DM'] <= self.dmmax)
+            for trigger in triggers[mask]:
+                candidates.append({'cb': cb, 'time': self.tstart + trigger['time'], 'DM': trigger['DM'],
+                                   'SNR': trigger['SNR'], 'width': trigger['integration_step'] * 4.096e-5,
+                                   'beam': trigger['beam']})
+        return candidates
+
+
+def format_cbs(cbs):
+    """
+    Format a list of CBs, e.g. CB03,CB04
+    """
+    return ','.join(['CB{:02d}'.format(cb) for cb in cbs])
+
+
+def log_event(fname, event, rfi):
+    """
+    Append an event to the event log
+    fname: event log file
+    event: dump event dict
+    rfi: whether the event was rejected as RFI
+    """
+    with open(fname, 'a') as f:
+        f.write("{utc} {status} {DM:.2f} {SNR:.2f} {ncand} {cbs}\n".format(
+                utc=datetime.utcfromtimestamp(.5*(event['t_start'] + event['t_end'])).strftime('%Y-%m-%d-%H:%M:%S.%f'),
+                status='RFI' if rfi else 'DUMP', DM=event['DM'], SNR=event['SNR'], ncand=event['ncand'],
+                cbs=format_cbs(event['cbs'])))
+
+
+def run(aggregator, dispatcher, queue, files=None, output=None, end_time=None, interval=.1):
+    """
+    Aggregate candidates until the end time
+    aggregator: Aggregator
+    dispatcher: Dispatcher
+    queue: queue with received candidates
+    files: CandidateFiles to read as well (optional)
+    output: event log file (optional)
+    end_time: time to stop (unix time), None to run forever
+    interval: time between checks of the groups and files (s)
+    """
+    ndump = 0
+    nrfi = 0
+    done = False
+    while not done:
+        # groups that are still open at the end are decided on what was received
+        done = end_time is not None and time() >= end_time
+        try:
+            candidates = [queue.get(timeout=interval)]
+        except Empty:
+            candidates = []
+        while True:
+            try:
+                candidates.append(queue.get_nowait())
+            except Empty:
+                break
+        if files is not None:
+            candidates.extend(files.read())
+        for candidate in candidates:
+            aggregator.add(candidate)
+        for event, rfi in aggregator.decide(flush=done):
+            if rfi:
+                nrfi += 1
+                aggregator.log("Rejected event at DM={:.2f} seen by {} CBs as RFI".format(event['DM'],
+                                                                                          len(event['cbs'])))
+            else:
+                ndump += 1
+                aggregator.log("Dumping event at DM={:.2f} S/N={:.2f} in {}".format(event['DM'], event['SNR'],
+                                                                                    format_cbs(event['cbs'])))
+                dispatcher.send(event)
+            if output is not None:
+                log_event(output, event, rfi)
+    dispatcher.flush(timeout=10)
+    aggregator.log("Sent {} dumps, rejected {} events as RFI".format(ndump, nrfi))
+
+
+if __name__ == '__main__':
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), CONFIG), 'r') as f:
+        conf = yaml.load(f)['trigger_aggregator']
+
+    parser = argparse.ArgumentParser(description="Group IQUV triggers of all CBs and dump each event once")
+    parser.add_argument("--tstart", type=float, help="Observation start time (unix timestamp)", required=True)
+    parser.add_argument("--duration", type=float, help="Observation duration (s), runs forever if not given")
+    parser.add_argument("--port", type=int, help="Port to receive candidates on "
+                        "(Default: {})".format(conf['port']), default=conf['port'])
+    parser.add_argument("--files", type=str, help="Also read the trigger files matching this pattern, "
+                        "e.g. '/data/*/CB*.trigger'")
+    parser.add_argument("--output", type=str, help="Event log file")
+
+    args = parser.parse_args()
+
+    queue = Queue()
+    CandidateServer(args.port, queue)
+    if args.files:
+        files = CandidateFiles(args.files, args.tstart, conf['snrmin'], conf['dmmin'], conf['dmmax'])
+    else:
+        files = None
+    aggregator = Aggregator(conf['time_tolerance'], conf['dm_tolerance'], conf['hold'], conf['max_cbs'],
+                            conf['dumpsize'])
+    dispatcher = Dispatcher(args.tstart, conf['receiver_port'])
+    if args.duration:
+        end_time = args.tstart + args.duration
+    else:
+        end_time = None
+    run(aggregator, dispatcher, queue, files, args.output, end_time)
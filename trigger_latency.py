@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+#
+# Timeline of each candidate in the IQUV trigger path
+# Records when a candidate arrived in the data, when AMBER wrote it, when the trigger watcher saw it
+# and when its dump command was delivered, and summarises the latency of each stage
+# Author: L.C. Oostrum
+
+import argparse
+import threading
+
+import numpy as np
+import yaml
+
+# file format: MAGIC, then one record per candidate
+MAGIC = "ARTSTL1\n"
+# arrival time in the data, time the trigger file was last written when the candidate was read,
+# time the watcher read it, time the dump command was delivered (all unix time, NaN if not applicable)
+RECORD_DTYPE = np.dtype([('time', '<f8'), ('written', '<f8'), ('seen', '<f8'), ('sent', '<f8'),
+                         ('DM', '<f4'), ('SNR', '<f4'), ('status', 'u1')])
+# what happened to a candidate
+STATUS = ['rejected', 'dumped', 'covered', 'dropped', 'forwarded', 'pending', 'ml_rejected']
+# latency stages: name, end, start
+STAGES = [('amber', 'written', 'time'), ('watcher', 'seen', 'written'), ('dump', 'sent', 'seen'),
+          ('total', 'sent', 'time')]
+# bin edges of the latency histograms (s). The amber stage can be slightly negative
+# because of the resolution of file modification times
+HISTOGRAM_BINS = [-np.inf, .001, .01, .1, 1, 10, np.inf]
+
+
+def read_log(filename):
+    """
+    Read a latency log
+    filename: path to file
+    returns: numpy structured array of RECORD_DTYPE
+    """
+    with open(filename, 'rb') as f:
+        if not f.read(len(MAGIC)) == MAGIC:
+            raise ValueError("{} is not a trigger latency log".format(filename))
+        return np.fromfile(f, dtype=RECORD_DTYPE)
+
+
+def summarise(data):
+    """
+    Summarise the latency of each stage
+    data: array of RECORD_DTYPE
+    returns: dict with the nr of candidates per status and the latency percentiles and histogram per stage.
+             The histogram is keyed by the upper edge of each bin
+    """
+    summary = {'ncand': len(data),
+               'status': dict([(status, int((data['status'] == ind).sum())) for ind, status in enumerate(STATUS)])}
+    for stage, end, start in STAGES:
+        latency = data[end] - data[start]
+        latency = latency[np.isfinite(latency)]
+        if not len(latency):
+            continue
+        counts = np.histogram(latency, bins=HISTOGRAM_BINS)[0]
+        summary[stage] = {'n': len(latency),
+                          'p50': float(np.percentile(latency, 50)),
+                          'p95': float(np.percentile(latency, 95)),
+                          'p99': float(np.percentile(latency, 99)),
+                          'max': float(latency.max()),
+                          'histogram': dict([(float(edge), int(count)) for edge, count in
+                                             zip(HISTOGRAM_BINS[1:], counts)])}
+    return summary
+
+
+def format_summary(summary):
+    """
+    Format a latency summary as a table
+    summary: output of summarise
+    returns: list of lines
+    """
+    lines = ["Candidates: {} ({})".format(summary['ncand'], ', '.join(["{} {}".format(summary['status'][status],
+                                                                                     status)
+                                                                      for status in STATUS
+                                                                      if summary['status'][status]])),
+             "{:<8s} {:>6s} {:>10s} {:>10s} {:>10s} {:>10s}".format("Stage", "N", "p50 (ms)", "p95 (ms)",
+                                                                    "p99 (ms)", "Max (ms)")]
+    for stage, end, start in STAGES:
+        if stage not in summary:
+            continue
+        s = summary[stage]
+        lines.append("{:<8s} {:>6d} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}".format(stage, s['n'], s['p50']*1e3,
+                                                                                  s['p95']*1e3, s['p99']*1e3,
+                                                                                  s['max']*1e3))
+    return lines
+
+
+class LatencyLog(object):
+    """
+    Record the timeline of candidates. Candidates that may still be dumped are kept until their
+    fate is known, all others are written immediately
+    """
+
+    def __init__(self, filename=None):
+        """
+        filename: output file, None to only keep the records in memory
+        """
+        self.filename = filename
+        self.records = []
+        self.pending = {}
+        self.nextid = 0
+        self.lock = threading.Lock()
+        if filename is not None:
+            with open(filename, 'wb') as f:
+                f.write(MAGIC)
+
+    def write(self, records):
+        """
+        Store finished records
+        records: array of RECORD_DTYPE
+        """
+        self.records.append(records)
+        if self.filename is not None:
+            with open(self.filename, 'ab') as f:
+                records.tofile(f)
+
+    def record(self, times, DMs, SNRs, written, seen, selected, ml_rejected=None):
+        """
+        Record newly read candidates
+        times: arrival times in the data (unix time)
+        DMs: DMs
+        SNRs: S/N
+        written: time the trigger file was last written (unix time)
+        seen: time the candidates were read (unix time)
+        selected: mask of candidates that may be dumped
+        ml_rejected: mask of candidates rejected by the classifier (optional)
+        returns: ids of the selected candidates
+        """
+        records = np.zeros(len(times), dtype=RECORD_DTYPE)
+        records['time'] = times
+        records['written'] = written
+        records['seen'] = seen
+        records['sent'] = np.nan
+        records['DM'] = DMs
+        records['SNR'] = SNRs
+        records['status'] = STATUS.index('pending')
+        records['status'][~selected] = STATUS.index('rejected')
+        if ml_rejected is not None:
+            records['status'][ml_rejected] = STATUS.index('ml_rejected')
+        with self.lock:
+            ids = range(self.nextid, self.nextid + selected.sum())
+            self.nextid += len(ids)
+            self.pending.update(zip(ids, records[selected]))
+            self.write(records[~selected])
+        return ids
+
+    def done(self, ids, status, sent=np.nan):
+        """
+        Record the fate of selected candidates
+        ids: candidate ids
+        status: one of STATUS
+        sent: time the dump command was delivered (unix time)
+        """
+        with self.lock:
+            records = np.array([self.pending.pop(i) for i in ids if i in self.pending], dtype=RECORD_DTYPE)
+            records['status'] = STATUS.index(status)
+            records['sent'] = sent
+            self.write(records)
+
+    def close(self):
+        """
+        Write the candidates that are still pending
+        returns: summary of all candidates
+        """
+        with self.lock:
+            records = np.array(self.pending.values(), dtype=RECORD_DTYPE)
+            self.pending = {}
+            self.write(records)
+            return summarise(np.concatenate(self.records))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Summarise a trigger latency log")
+    parser.add_argument("filename", type=str, help="Latency log written by trigger_IQUV.py")
+    parser.add_argument("--yaml", action="store_true", help="Print the full summary as yaml")
+
+    args = parser.parse_args()
+
+    summary = summarise(read_log(args.filename))
+    if args.yaml:
+        print yaml.dump(summary, default_flow_style=False)
+    else:
+        print '\n'.join(format_summary(summary))
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+#
+# Send IQUV dump events to the receiver, connecting for every message unless asked to keep the connection open
+# Events are queued and sent by a separate thread, so a slow or absent receiver does not block
+# the trigger watcher. Events that arrive close together are sent as one message
+# Author: L.C. Oostrum
+
+import sys
+import socket
+import argparse
+import threading
+from Queue import Queue, Empty, Full
+from time import sleep, time
+from datetime import datetime
+
+# format of UTC times in messages
+TIME_FORMAT = '%Y-%m-%d-%H:%M:%S'
+
+
+def utc(unix):
+    """
+    Convert unix time to UTC string as used in messages
+    """
+    return datetime.utcfromtimestamp(unix).strftime(TIME_FORMAT)
+
+
+def merge_events(events):
+    """
+    Merge events with overlapping dump windows. The merged event covers the combined window
+    and has the parameters of the brightest event. Candidate ids of the events are combined
+    events: list of dicts with t_start, t_end (unix time), DM, SNR, width, beam
+    returns: list of merged events, sorted by start time
+    """
+    merged = []
+    for event in sorted(events, key=lambda event: event['t_start']):
+        if merged and event['t_start'] <= merged[-1]['t_end']:
+            last = merged[-1]
+            combined = dict(event if event['SNR'] > last['SNR'] else last)
+            combined['t_start'] = min(last['t_start'], event['t_start'])
+            combined['t_end'] = max(last['t_end'], event['t_end'])
+            if 'ids' in last or 'ids' in event:
+                combined['ids'] = last.get('ids', []) + event.get('ids', [])
+            merged[-1] = combined
+        else:
+            merged.append(dict(event))
+    return merged
+
+
+def format_message(events, utc_start):
+    """
+    Create the message for one or more events
+    events: list of event dicts
+    utc_start: start time of the observation (unix time)
+    returns: message
+    """
+    message = "N_EVENTS {}\n{}\n".format(len(events), utc(utc_start))
+    for event in events:
+        message += "{t_start} {t_start_frac} {t_end} {t_end_frac}  {DM} {SNR} {width} {beam}\n".format(
+            t_start=utc(event['t_start']), t_start_frac=0, t_end=utc(event['t_end']), t_end_frac=0,
+            DM=event['DM'], SNR=event['SNR'], width=event['width'], beam=int(event['beam']))
+    return message
+
+
+def format_candidates(events, utc_start):
+    """
+    Create the message forwarding candidates to the trigger aggregator, one line per candidate
+    events: list of dicts with cb, time (unix time), DM, SNR, width, beam
+    utc_start: start time of the observation (unix time), not used
+    returns: message
+    """
+    return ''.join(["CANDIDATE {cb} {time!r} {DM!r} {SNR!r} {width!r} {beam}\n".format(
+                    cb=int(event['cb']), time=float(event['time']), DM=float(event['DM']), SNR=float(event['SNR']),
+                    width=float(event['width']), beam=int(event['beam'])) for event in events])
+
+
+def parse_candidate(line):
+    """
+    Parse a candidate line created by format_candidates
+    line: message line
+    returns: candidate dict, None if the line is not a candidate
+    """
+    cols = line.split()
+    if not len(cols) == 7 or not cols[0] == 'CANDIDATE':
+        return None
+    try:
+        return {'cb': int(cols[1]), 'time': float(cols[2]), 'DM': float(cols[3]), 'SNR': float(cols[4]),
+                'width': float(cols[5]), 'beam': int(cols[6])}
+    except ValueError:
+        return None
+
+
+def log(message):
+    """
+    Log a message. Prepends the message with a fixed string
+    """
+    print "Trigger sender: {}".format(message)
+    sys.stdout.flush()
+
+
+class TriggerSender(object):
+    """
+    Queue events and send them from a separate thread
+    """
+
+    def __init__(self, host, port, utc_start, maxqueue=100, coalesce=0.1, reconnect=1.0, persistent=False,
+                 candidates=False, on_sent=None, logger=log):
+        """
+        host: receiver host name
+        port: receiver port
+        utc_start: start time of the observation (unix time)
+        maxqueue: maximum nr of queued events, new events are dropped when full
+        coalesce: time to wait for more events before sending (s)
+        reconnect: time between connection attempts (s)
+        persistent: keep the connection open between messages, only for receivers that read several
+                    messages per connection (Default: connect for every message)
+        candidates: forward candidates to the trigger aggregator instead of sending dump events
+        on_sent: function called with the list of events and the time after each message is delivered
+        logger: function to log messages with (Default: log)
+        """
+        self.host = host
+        self.port = port
+        self.utc_start = utc_start
+        self.coalesce = coalesce
+        self.reconnect = reconnect
+        self.persistent = persistent
+        self.candidates = candidates
+        self.on_sent = on_sent
+        self.queue = Queue(maxqueue)
+        self.sock = None
+        self.nsent = 0
+        self.nmessage = 0
+        self.ndropped = 0
+        self.log = logger
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, event):
+        """
+        Queue an event, never blocks
+        event: dict with t_start, t_end (unix time), DM, SNR, width, beam
+        returns: True if the event was queued, False if the queue is full
+        """
+        try:
+            self.queue.put_nowait(event)
+        except Full:
+            self.ndropped += 1
+            self.log("WARNING: trigger queue full, dropping event")
+            return False
+        return True
+
+    def connect(self):
+        """
+        Connect to the receiver, retrying until it succeeds
+        """
+        while self.sock is None:
+            try:
+                self.sock = socket.create_connection((self.host, self.port), timeout=self.reconnect)
+                self.sock.settimeout(None)
+            except socket.error as e:
+                self.log("WARNING: could not connect to {}:{} ({}), retrying".format(self.host, self.port, e))
+                sleep(self.reconnect)
+
+    def disconnect(self):
+        """
+        Close the connection to the receiver
+        """
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+            self.sock.close()
+            self.sock = None
+
+    def deliver(self, message):
+        """
+        Send a message, reconnecting if the connection was lost
+        """
+        while True:
+            self.connect()
+            try:
+                self.sock.sendall(message)
+                break
+            except socket.error as e:
+                self.log("WARNING: connection to {}:{} lost ({}), reconnecting".format(self.host, self.port, e))
+                self.disconnect()
+        if not self.persistent:
+            self.disconnect()
+
+    def run(self):
+        """
+        Send queued events. Events that arrive within the coalesce time of the first are sent together
+        """
+        while True:
+            events = [self.queue.get()]
+            deadline = time() + self.coalesce
+            while True:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                try:
+                    events.append(self.queue.get(timeout=remaining))
+                except Empty:
+                    break
+            nqueued = len(events)
+            if self.candidates:
+                # the aggregator groups the candidates itself
+                self.deliver(format_candidates(events, self.utc_start))
+            else:
+                events = merge_events(events)
+                self.deliver(format_message(events, self.utc_start))
+            self.nsent += len(events)
+            self.nmessage += 1
+            if self.on_sent is not None:
+                self.on_sent(events, time())
+            # merged events count as done as well
+            for i in range(nqueued):
+                self.queue.task_done()
+
+    def flush(self, timeout=None):
+        """
+        Wait until all queued events have been sent
+        timeout: maximum time to wait (s), None for no limit
+        returns: True if the queue is empty
+        """
+        tstart = time()
+        while self.queue.unfinished_tasks > 0:
+            if timeout is not None and time() - tstart > timeout:
+                return False
+            sleep(.01)
+        return True
+
+
+def stand_in(port):
+    """
+    Local stand-in for the receiver: accept connections and print every message
+    port: port to listen on
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('localhost', port))
+    server.listen(5)
+    print "Listening on port {}".format(port)
+    while True:
+        conn, addr = server.accept()
+        print "Connection from {}:{}".format(*addr)
+        f = conn.makefile('r')
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            # N_EVENTS k, UTC start, k events
+            nevent = int(line.split()[1])
+            lines = [line, f.readline()] + [f.readline() for i in range(nevent)]
+            print "{:.3f}: received {} event(s)\n{}".format(time(), nevent, ''.join(lines))
+            sys.stdout.flush()
+        conn.close()
+        print "Connection closed"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Send test events, or run a local stand-in receiver")
+    parser.add_argument("--listen", help="Run the stand-in receiver", action="store_true")
+    parser.add_argument("--host", type=str, help="Receiver host (Default: localhost)", default="localhost")
+    parser.add_argument("--port", type=int, help="Receiver port (Default: 30000)", default=30000)
+    parser.add_argument("--nevent", type=int, help="Nr of test events to send (Default: 5)", default=5)
+    parser.add_argument("--spacing", type=float, help="Time between test events (s) (Default: 0.05)",
+                        default=0.05)
+
+    args = parser.parse_args()
+
+    if args.listen:
+        stand_in(args.port)
+    else:
+        now = time()
+        sender = TriggerSender(args.host, args.port, now)
+        for i in range(args.nevent):
+            t = time()
+            sender.send({'t_start': t - 1, 't_end': t + 1, 'DM': 500., 'SNR': 20. + i, 'width': 1e-3, 'beam': 0})
+            sleep(args.spacing)
+        sender.flush()
+        sender.disconnect()
+        print "Queued {} event(s), sent {} event(s) in {} message(s)".format(args.nevent, sender.nsent,
+                                                                          sender.nmessage)
@@ -4,15 +4,22 @@
 
 import os
 import sys
+import shutil
 import socket
 
 import numpy as np
 import h5py
 import yaml
 
+import result_collector
+import trigger_windows
+
+CONFIG = "config.yaml"
 
 if __name__ == '__main__':
     success = True
+    # result files to send to the master node
+    files = []
     # input hdf5 file = output of clasifier
     fname = sys.argv[1]
     # number of candidates before grouping
@@ -23,6 +30,16 @@ if __name__ == '__main__':
     master_dir = sys.argv[4]
     # beam of this node
     beam = int(socket.gethostname()[5:7]) - 1
+    # optional: time window index
+    if len(sys.argv) > 5:
+        # results of a window are sent right away, so alerts do not wait for the end of the observation.
+        # The node script merges them into the results of the full observation afterwards
+        prefix = trigger_windows.WINDOW_PREFIX.format(beam=beam, window=int(sys.argv[5]))
+        master_dir = os.path.join(master_dir, trigger_windows.WINDOW_RESULTS)
+        full_observation = False
+    else:
+        prefix = "CB{:02d}".format(beam)
+        full_observation = True
     try:
         # read dataset 
         with h5py.File(fname, 'r') as f:
@@ -44,17 +61,18 @@ if __name__ == '__main__':
         data = data[data[:, -1].argsort()[::-1]]
         # save to file
         header = "SNR DM Width T0 p"
-        fname = "CB{:02d}_triggers.txt".format(beam)
+        fname = "{}_triggers.txt".format(prefix)
         np.savetxt(fname, data, header=header, fmt="%.2f %.2f %.4f %.3f %.2f")
-        # copy to master node
-        cmd = "cp {fname} {master_dir}/ &".format(fname=fname, master_dir=master_dir, beam=beam)
-        os.system(cmd)
+        files.append(fname)
 
     # copy candidates file if it exists
     fname = "candidates_summary.pdf"
     if os.path.isfile(fname):
-        cmd = "cp {fname} {master_dir}/CB{beam:02d}_candidates_summary.pdf &".format(beam=beam, master_dir=master_dir, fname=fname)
-        os.system(cmd)
+        if full_observation:
+            # named after the beam on the master node
+            beam_fname = "CB{:02d}_candidates_summary.pdf".format(beam)
+            shutil.copy(fname, beam_fname)
+            files.append(beam_fname)
     else:
         success = False
 
@@ -64,10 +82,12 @@ if __name__ == '__main__':
     summary['ncand_raw'] = ncand_raw
     summary['ncand_trigger'] = ncand_trigger
     summary['ncand_classifier'] = ncand_classifier
-    fname = "CB{:02d}_summary.yaml".format(beam)
+    fname = "{}_summary.yaml".format(prefix)
     with open(fname, 'w') as f:
         yaml.dump(summary, f, default_flow_style=False)
-    # copy to master node
-    cmd = "cp {fname} {master_dir}/ &".format(fname=fname, master_dir=master_dir, beam=beam)
-    os.system(cmd)
-    
+    files.append(fname)
+    # send all files to master node in one go, the summary last
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), CONFIG), 'r') as f:
+        conf = yaml.load(f)['result_collector']
+    result_collector.deliver(conf, master_dir, beam, files)
+
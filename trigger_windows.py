@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#
+# Split AMBER triggers into time windows, so they can be processed during the observation
+# and merge the results of the windows into the result files of the full observation
+# Author: L.C. Oostrum
+
+import os
+import subprocess
+
+import numpy as np
+import yaml
+
+from amber_triggers import TriggerStream, write_triggers
+import result_collector
+
+# trigger file of one window
+WINDOW_FILE = "{prefix}_window{window:03d}.trigger"
+# result directory of one window, relative to the trigger output dir
+WINDOW_DIR = "window{window:03d}"
+# prefix of the result files of one window, as created by trigger_to_master.py
+WINDOW_PREFIX = "CB{beam:02d}_window{window:03d}"
+# dir the results of each window are sent to as soon as the window is done, relative to the results dir
+# on the master node. Separate from the results of the full observation, so a window does not mark its beam as done
+WINDOW_RESULTS = "windows"
+
+
+class WindowSplitter(object):
+    """
+    Split the AMBER triggers of all steps into consecutive time windows.
+    Each window holds the merged and deduplicated triggers that were not in a previous window,
+    so triggers that AMBER writes late end up in the next window instead of being lost
+    """
+
+    def __init__(self, prefix, time_tolerance=0.05, dm_tolerance=10.):
+        """
+        prefix: AMBER output prefix
+        time_tolerance: maximum arrival time difference of duplicates (s)
+        dm_tolerance: maximum DM difference of duplicates (pc/cc)
+        """
+        self.prefix = prefix
+        self.stream = TriggerStream(prefix, time_tolerance, dm_tolerance)
+
+    def write_window(self, window, tend):
+        """
+        Write the new triggers of all AMBER steps that arrived before the end of a window to one file
+        window: window index
+        tend: end of window (s since start of observation), None for no limit
+        returns: path to window file, nr of triggers in window
+        """
+        self.stream.poll()
+        triggers = self.stream.pop(tend)
+        output = WINDOW_FILE.format(prefix=self.prefix, window=window)
+        write_triggers(output, triggers)
+        return output, len(triggers)
+
+
+def merge_results(trigger_dir, master_dir, beam, nwindow, collector):
+    """
+    Merge the results of all windows and send them to the master node, for the email of the full observation
+    trigger_dir: directory with the window result dirs
+    master_dir: results dir on master node
+    beam: CB index
+    nwindow: nr of windows
+    collector: result_collector settings
+    """
+    summary = {'success': False, 'ncand_raw': 0, 'ncand_trigger': 0, 'ncand_classifier': 0, 'nwindow': nwindow}
+    triggers = []
+    pdfs = []
+    header = "SNR DM Width T0 p"
+    for window in range(nwindow):
+        window_dir = os.path.join(trigger_dir, WINDOW_DIR.format(window=window))
+        prefix = os.path.join(window_dir, WINDOW_PREFIX.format(beam=beam, window=window))
+        try:
+            with open("{}_summary.yaml".format(prefix), 'r') as f:
+                window_summary = yaml.load(f)
+        except IOError:
+            continue
+        for key in ['ncand_raw', 'ncand_trigger', 'ncand_classifier']:
+            summary[key] += window_summary[key]
+        summary['success'] |= window_summary['success']
+        if os.path.isfile("{}_triggers.txt".format(prefix)):
+            triggers.append(np.loadtxt("{}_triggers.txt".format(prefix), ndmin=2))
+        if os.path.isfile(os.path.join(window_dir, "candidates_summary.pdf")):
+            pdfs.append(os.path.join(window_dir, "candidates_summary.pdf"))
+
+    files = []
+    if triggers:
+        data = np.concatenate(triggers)
+        # sort by probability
+        data = data[data[:, -1].argsort()[::-1]]
+        fname = os.path.join(trigger_dir, "CB{:02d}_triggers.txt".format(beam))
+        np.savetxt(fname, data, header=header, fmt="%.2f %.2f %.4f %.3f %.2f")
+        files.append(fname)
+    else:
+        summary['success'] = False
+    if pdfs:
+        fname = os.path.join(trigger_dir, "CB{:02d}_candidates_summary.pdf".format(beam))
+        cmd = ["gs", "-dBATCH", "-dNOPAUSE", "-q", "-sDEVICE=pdfwrite", "-sOutputFile={}".format(fname)] + pdfs
+        if subprocess.call(cmd) == 0:
+            files.append(fname)
+        else:
+            summary['success'] = False
+    else:
+        summary['success'] = False
+    # the emailer waits for the summary, so it is copied last if the collector cannot be reached
+    fname = os.path.join(trigger_dir, "CB{:02d}_summary.yaml".format(beam))
+    with open(fname, 'w') as f:
+        yaml.dump(summary, f, default_flow_style=False)
+    files.append(fname)
+    result_collector.deliver(collector, master_dir, beam, files)
@@ -3,21 +3,36 @@
 # Convert input Alt Az to RA+DEC for WSRT
 # Author: L.C. Oostrum
 
+import os
 import sys
-
-from astropy import units as u
-from astropy.coordinates import SkyCoord, EarthLocation, AltAz
-from astropy.time import Time, TimeDelta
+from time import time
 from datetime import datetime
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import fast_astro  # noqa: E402
+
 if __name__ == '__main__':
+    # fast mode does not need astropy, which takes seconds to import
+    fast = '--fast' in sys.argv
+    if fast:
+        sys.argv.remove('--fast')
     try:
         alt = float(sys.argv[1])
         az = float(sys.argv[2])
     except IndexError:
-        print "Usage: altaz_to_radec.py alt az"
+        print "Usage: altaz_to_radec.py alt az [--fast]"
+        print "--fast skips astropy (accurate to ~1 arcmin)"
         sys.exit(1)
 
+    if fast:
+        ra, dec = fast_astro.altaz_to_radec(alt, az, time())
+        print fast_astro.deg_to_sexagesimal(ra, hours=True), fast_astro.deg_to_sexagesimal(dec)
+        sys.exit(0)
+
+    from astropy import units as u
+    from astropy.coordinates import SkyCoord, EarthLocation, AltAz
+    from astropy.time import Time
+
     wsrt = EarthLocation(lat=52.915184*u.deg, lon=6.60387*u.deg, height=0*u.m)
     now = Time(datetime.utcnow(), scale='utc')
     altaz = AltAz(alt=alt*u.deg,az=az*u.deg,obstime=now,location=wsrt)
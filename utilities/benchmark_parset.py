@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+#
+# Compare size and encoding time of the parset codecs for the PSRDADA header
+# Author: L.C. Oostrum
+
+import os
+import sys
+import argparse
+import tempfile
+import shutil
+from time import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import parset_codec  # noqa: E402
+
+
+def time_call(func, repeat):
+    """
+    Run a function several times
+    returns: output of the function, median run time (s)
+    """
+    times = []
+    for i in range(repeat):
+        tstart = time()
+        output = func()
+        times.append(time() - tstart)
+    return output, np.median(times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare parset codecs for the PSRDADA header")
+    parser.add_argument("parsets", type=str, nargs='+', help="Parset files")
+    parser.add_argument("--repeat", type=int, help="Number of runs per codec "
+                        "(Default: 20)", default=20)
+
+    args = parser.parse_args()
+
+    store_dir = tempfile.mkdtemp()
+    codecs = sorted(parset_codec.CODECS.keys()) + [parset_codec.REF_CODEC]
+    try:
+        for fname in args.parsets:
+            with open(fname, 'r') as f:
+                parset = f.read()
+            print "{} ({} bytes)".format(fname, len(parset))
+            print "{:<8s} {:>8s} {:>6s} {:>12s} {:>12s}".format("Codec", "Size", "Fits", "Encode (ms)", "Decode (ms)")
+            for codec in codecs:
+                try:
+                    encoded, t_enc = time_call(lambda: parset_codec.encode(parset, codec, store_dir), args.repeat)
+                    decoded, t_dec = time_call(lambda: parset_codec.decode(encoded, codec), args.repeat)
+                except ValueError as e:
+                    print "{:<8s} {}".format(codec, e)
+                    continue
+                assert decoded == parset
+                fits = 'yes' if len(encoded) <= parset_codec.MAX_LENGTH else 'no'
+                print "{:<8s} {:>8d} {:>6s} {:>12.3f} {:>12.3f}".format(codec, len(encoded), fits, t_enc * 1E3,
+                                                                        t_dec * 1E3)
+            print
+    finally:
+        shutil.rmtree(store_dir)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+#
+# Measure the startup time of the observing scripts
+# Each command is run in a fresh interpreter, so module imports are included
+# Author: L.C. Oostrum
+
+import os
+import sys
+import argparse
+import subprocess
+from time import time
+
+import numpy as np
+
+# root of the repository
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+
+# name, arguments to python
+BENCHMARKS = [("astropy import (reference)", ['-c', 'import astropy.time, astropy.coordinates']),
+              ("numpy import (reference)", ['-c', 'import numpy']),
+              ("start_survey_master import", ['-c', 'import start_survey_master']),
+              ("trigger_IQUV import", ['-c', 'import trigger_IQUV']),
+              ("get_ha.py --fast", ['utilities/get_ha.py', '--fast', '12:00:00', '30:00:00']),
+              ("get_ha.py (astropy)", ['utilities/get_ha.py', '12:00:00', '30:00:00']),
+              ("altaz_to_radec.py --fast", ['utilities/altaz_to_radec.py', '45', '90', '--fast']),
+              ("altaz_to_radec.py (astropy)", ['utilities/altaz_to_radec.py', '45', '90'])]
+
+
+def run_benchmark(python, args, repeat):
+    """
+    Run a command several times
+    python: python executable
+    args: arguments to python
+    repeat: number of runs
+    returns: array of run times (s), or None if the command failed
+    """
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(repeat):
+            tstart = time()
+            returncode = subprocess.call([python] + args, cwd=ROOT, stdout=devnull, stderr=devnull)
+            times.append(time() - tstart)
+            if returncode != 0:
+                return None
+    return np.array(times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure startup time of the observing scripts")
+    parser.add_argument("--repeat", type=int, help="Number of runs per command "
+                        "(Default: 5)", default=5)
+    parser.add_argument("--python", type=str, help="Python executable "
+                        "(Default: current interpreter)", default=sys.executable)
+
+    args = parser.parse_args()
+
+    print "{:<30s} {:>10s} {:>10s}".format("Command", "Median (s)", "Min (s)")
+    for name, cmd in BENCHMARKS:
+        times = run_benchmark(args.python, cmd, args.repeat)
+        if times is None:
+            print "{:<30s} {:>10s}".format(name, "failed")
+        else:
+            print "{:<30s} {:>10.3f} {:>10.3f}".format(name, np.median(times), times.min())
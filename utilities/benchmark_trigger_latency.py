@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#
+# Measure the time between appending a trigger to the AMBER output and the IQUV dump command
+# arriving at the receiver, for each way of watching the trigger file
+# Author: L.C. Oostrum
+
+import os
+import sys
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+from time import sleep, time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from trigger_IQUV import Trigger
+
+
+def receiver(server, arrivals):
+    """
+    Accept connections and store the arrival time of each message
+    server: listening socket
+    arrivals: list to append arrival times to
+    """
+    while True:
+        conn, addr = server.accept()
+        f = conn.makefile('r')
+        # the connection may stay open, messages are N_EVENTS k, UTC start, k events
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            nevent = int(line.split()[1])
+            for i in range(nevent + 1):
+                f.readline()
+            # one arrival per event in the message
+            arrivals.extend([time()] * nevent)
+        conn.close()
+
+
+def benchmark(method, ntrigger, spacing, interval):
+    """
+    Write synthetic triggers and measure when the dump commands arrive
+    method: inotify or poll
+    ntrigger: nr of triggers to write
+    spacing: time between triggers (s)
+    interval: maximum interval for checking triggers (s)
+    returns: array of latencies (s)
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('localhost', 0))
+    server.listen(5)
+    arrivals = []
+    thread = threading.Thread(target=receiver, args=(server, arrivals))
+    thread.daemon = True
+    thread.start()
+
+    workdir = tempfile.mkdtemp()
+    fname = os.path.join(workdir, 'CB00.trigger')
+    args = argparse.Namespace(tstart=time(), fname=fname, interval=interval, watch=method, snrmin=10,
+                              dmmin=0, dmmax=5000, maxage=10, dumpsize=0.1, host='localhost',
+                              port=server.getsockname()[1], coalesce=0, maxqueue=100, persistent=False,
+                              aggregator=None, cb=None, nbuffer=5, page_size=12500, tsamp=8.192e-5,
+                              budget=1000, budget_period=1, latency_log=None, ml_gate=None, pthresh=0.5,
+                              ml_budget=0.5)
+    try:
+        trigger = Trigger(args)
+        thread = threading.Thread(target=trigger.run)
+        thread.daemon = True
+        thread.start()
+        sleep(.5)
+
+        appended = []
+        with open(fname, 'a') as f:
+            for i in range(ntrigger):
+                t = time() - args.tstart
+                f.write("0 {} 0 1 1 {:.3f} 500.0 1 20.0\n".format(i, t))
+                f.flush()
+                appended.append(time())
+                sleep(spacing)
+        # wait for the last dump command
+        tstart = time()
+        while len(arrivals) < ntrigger and time() - tstart < interval + 1:
+            sleep(.01)
+    finally:
+        server.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    n = min(len(arrivals), len(appended))
+    return np.array(arrivals[:n]) - np.array(appended[:n])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure the append-to-send latency of trigger_IQUV")
+    parser.add_argument("--ntrigger", type=int, help="Nr of triggers per method "
+                        "(Default: 20)", default=20)
+    parser.add_argument("--spacing", type=float, help="Time between triggers (s) "
+                        "(Default: 0.5)", default=0.5)
+    parser.add_argument("--interval", type=float, help="Maximum interval for checking triggers (s) "
+                        "(Default: 2)", default=2.)
+
+    args = parser.parse_args()
+
+    print "{:<10s} {:>6s} {:>10s} {:>10s} {:>10s}".format("Method", "Sent", "p50 (ms)", "p95 (ms)", "Max (ms)")
+    for method in ['inotify', 'poll']:
+        latency = benchmark(method, args.ntrigger, args.spacing, args.interval) * 1000
+        if not len(latency):
+            print "{:<10s} {:>6d}".format(method, 0)
+            continue
+        print "{:<10s} {:>6d} {:>10.1f} {:>10.1f} {:>10.1f}".format(method, len(latency),
+                                                                    np.percentile(latency, 50),
+                                                                    np.percentile(latency, 95), latency.max())
@@ -1,22 +1,118 @@
 #!/usr/bin/env python
 
+import os
 import sys
 import warnings
+from time import time
 
 import numpy as np
-try:
-    from astropy.time import Time, TimeDelta
-    import astropy.coordinates as c
-    import astropy.units as u
-except ImportError:
-    print "Cannot import astropy"
-    exit()
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import fast_astro  # noqa: E402
+
+
+def rise_set(HA, DEC, lat):
+    """
+    Get the hour angles of rise and set and the current altitude of a source
+    HA: current hour angle, between -180 and 180 (deg)
+    DEC: declination (deg)
+    lat: latitude of the observatory (deg)
+    returns: HA at rise, HA at set, HA until rise, HA until set, altitude (all deg)
+    """
+    lat = np.radians(lat)
+    # HA where altitude = 0. Doesn't work if DEC > lat, so limited by DEC
+    if DEC > 0:
+        ha_max = 90.
+    else:
+        ha_max = np.degrees(np.arccos(-1*np.tan(lat)*np.tan(np.radians(DEC))))
+    ha_min = -ha_max
+
+    # Get rise and set time
+    if ha_min < HA < ha_max:
+        dt_rise = ha_min - HA
+    else:
+        dt_rise = (360 + ha_min - HA) % 360
+    dt_set = dt_rise + ha_max - ha_min
+
+    # Current altitude (Note: reordering gives the formula to calculate HA at altitude=0)
+    h_now = np.degrees(np.arcsin(np.sin(lat)*np.sin(np.radians(DEC)) +
+                                 np.cos(lat)*np.cos(np.radians(DEC))*np.cos(np.radians(HA))))
+    return ha_min, ha_max, dt_rise, dt_set, h_now
+
+
+def get_ha_fast(ra, dec):
+    """
+    Print the current hour angle, altitude, rise and set time without astropy.
+    See fast_astro.py for the accuracy
+    ra: RA in hh:mm:ss format
+    dec: DEC in dd:mm:ss format
+    """
+    RA = fast_astro.sexagesimal_to_deg(ra, hours=True)
+    DEC = fast_astro.sexagesimal_to_deg(dec)
+    if not 0 <= RA < 360:
+        print 'Error: RA should be between 0 and 24 hours'
+        exit()
+    if DEC > 90 or DEC < -90:
+        print 'Error: DEC should be between -90 and 90 degrees'
+        exit()
+    elif DEC < -35:
+        print "DEC < -35 degrees, not observable with WSRT"
+        exit()
+
+    UT = time()
+    LST = fast_astro.lst(UT)
+    # HA between -180 and 180
+    HA = (LST - RA + 180) % 360 - 180
+
+    ha_min, ha_max, dt_rise, dt_set, h_now = rise_set(HA, DEC, fast_astro.WSRT_LAT)
+    # convert degrees of HA to seconds
+    to_sec = 3600 / 15.
+    t_rise = UT + dt_rise * to_sec
+    t_transit = UT + .5 * (dt_set + dt_rise) * to_sec
+    t_set = UT + dt_set * to_sec
+    time_to_set = t_set - UT
+
+    fmt = '%Y-%m-%d %H:%M:%S'
+    print 'UT:', fast_astro.unix_to_datetime(UT).strftime("%X")
+    print 'LST:', fast_astro.deg_to_sexagesimal(LST, hours=True)
+    print 'RA:', RA
+    print 'DEC:', DEC
+    print 'HA:', HA
+    print 'Altitude:', h_now, 'deg'
+    print 'T rise:', fast_astro.unix_to_datetime(t_rise).strftime(fmt)
+    print 'T transit:', fast_astro.unix_to_datetime(t_transit).strftime(fmt)
+    print 'T set:', fast_astro.unix_to_datetime(t_set).strftime(fmt)
+    print 'Time to set:', time_to_set / 3600., 'h =', time_to_set, 's'
+    print 'HA at rise:', ha_min, 'deg'
+    print 'HA at set:', ha_max, 'deg'
 
 
 if __name__ == '__main__':
+    # fast mode does not need astropy, which takes seconds to import
+    fast = '--fast' in sys.argv
+    if fast:
+        sys.argv.remove('--fast')
+
     if not len(sys.argv) in [2, 3]:
         print 'Please provide the RA of the object in hh:mm:ss format'
         print 'Also provide DEC (dd:mm:ss.s) if you want the correct rise and set time for DEC<0'
+        print 'Add --fast to skip astropy (accurate to ~1 arcmin)'
+        exit()
+
+    if fast:
+        try:
+            dec = sys.argv[2]
+        except IndexError:
+            dec = '00:00:00'
+        get_ha_fast(sys.argv[1], dec)
+        exit()
+
+    try:
+        from astropy.time import Time, TimeDelta
+        import astropy.coordinates as c
+        import astropy.units as u
+    except ImportError:
+        print "Cannot import astropy"
         exit()
 
     # don't complain about Unicode conversion warning
@@ -44,57 +140,22 @@ if __name__ == '__main__':
         exit()
 
     # WSRT coordinates
-    lat = 52.915184*u.degree
-    lon = 6.60387*u.degree
+    lon = fast_astro.WSRT_LON*u.degree
     UT = Time.now()
     UT.delta_ut1_utc = 0
     LST = UT.sidereal_time('mean', lon)
-    HA = LST - RA
-
-    # make sure HA is between -180 and 180
-    if HA < -180*u.degree:
-        HA += 360*u.degree
-    elif HA > 180*u.degree:
-        HA -= 360*u.degree
-
-
-    # HA where altitude = 0. Doesn't work if DEC > lat, so limited by DEC
-    if DEC > 0:
-        # limited by HA
-        ha_min = -90*u.degree
-        ha_max = 90*u.degree
-    else:
-        ha_tmp = np.arccos(-1*np.tan(lat)*np.tan(DEC))
-        if ha_tmp > 0:
-            ha_max = ha_tmp
-            ha_min = -1*ha_tmp
-        else:
-            ha_max = -1 * ha_tmp
-            ha_min = ha_tmp
-            print ha_min, ha_max
-
-    # Get rise and set time
-    if ha_min < HA < ha_max:
-        visible = True
-        dt_rise = ha_min - HA
-        dt_set = dt_rise + ha_max - ha_min
-    else:
-        visible=False
-        dt_rise = 360*u.degree + ha_min - HA
-        dt_rise = dt_rise % (360*u.degree)
-        dt_set = dt_rise + ha_max - ha_min
-
-    # unit trick to combine hours and degrees.
-    # Probably astropy has a way to do this but I can't find it
-    dt_rise = dt_rise.to(u.hourangle) * u.hour/u.hourangle
-    dt_set = dt_set.to(u.hourangle) * u.hour/u.hourangle
-    t_rise = UT + dt_rise
-    t_transit = UT + .5 * (dt_set + dt_rise)
-    t_set = UT + dt_set
-    time_to_set = t_set - UT
-
-    # Current altitude (Note: reordering gives the formula to calculate HA at altitude=0)
-    h_now = np.arcsin(np.sin(lat)*np.sin(DEC) + np.cos(lat)*np.cos(DEC)*np.cos(HA))
+    # HA between -180 and 180
+    HA = c.Angle(LST - RA).wrap_at(180*u.degree)
+
+    ha_min, ha_max, dt_rise, dt_set, h_now = rise_set(HA.degree, DEC.degree, fast_astro.WSRT_LAT)
+    ha_min *= u.degree
+    ha_max *= u.degree
+    h_now *= u.degree
+    # convert degrees of HA to time
+    t_rise = UT + TimeDelta(dt_rise * 3600 / 15., format='sec')
+    t_transit = UT + TimeDelta(.5 * (dt_set + dt_rise) * 3600 / 15., format='sec')
+    t_set = UT + TimeDelta(dt_set * 3600 / 15., format='sec')
+    time_to_set = (t_set - UT).to(u.second)
 
     # Convert LST to a time
     LST = LST.to(u.hourangle) * u.hour/u.hourangle
@@ -17,6 +17,44 @@ from matplotlib.colorbar import ColorbarBase
 from matplotlib.patches import Rectangle
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
+# layout of the CBs is defined in beam_layout.py in the root of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import beam_layout  # noqa: E402
+
+# rectangle sizes
+WIDTH = 2
+HEIGHT = 1
+# lower left corners of the CBs in the default layout, as plotted before the layouts were shared.
+# None for CBs that are not present
+REFERENCE_CORNERS = ((-4.5, 2.5), (-2.5, 2.5), (-0.5, 2.5), (-3.5, 3.5), (None, None), (1.5, 2.5), (-3.5, 1.5),
+                     (-1.5, 1.5), (-1.5, 3.5), (None, None), (0.5, 1.5), (2.5, 1.5), (-4.5, 0.5), (0.5, 3.5),
+                     (None, None), (-2.5, 0.5), (-0.5, 0.5), (1.5, 0.5), (2.5, 3.5), (None, None), (-3.5, -0.5),
+                     (-1.5, -0.5), (0.5, -0.5), (-4.5, -3.5), (None, None), (2.5, -0.5), (-4.5, -1.5), (-2.5, -1.5),
+                     (-2.5, -3.5), (None, None), (-0.5, -1.5), (1.5, -1.5), (-3.5, -2.5), (-0.5, -3.5), (None, None),
+                     (-1.5, -2.5), (0.5, -2.5), (2.5, -2.5), (1.5, -3.5), (None, None))
+
+
+def cb_corners(layout):
+    """
+    Get the lower left corner of the rectangle of each CB
+    in units of element spacing, x = -RA, y = -DEC
+    layout: name of beam layout
+    returns: list of (x, y), (None, None) for CBs that are not in the layout
+    """
+    dRA, dDEC = beam_layout.CB_to_offset(range(beam_layout.NCB), pol='avg', layout=layout, unit='gel')
+    # the CBs are on a grid of half an element spacing, rounding removes the conversion error
+    return [(None, None) if np.isnan(x) else
+            (round(2 * (-x - WIDTH / 2.)) / 2., round(2 * (-y - HEIGHT / 2.)) / 2.) for x, y in zip(dRA, dDEC)]
+
+
+def check_corners():
+    """
+    Check that the default layout gives the same plot as before the layouts were shared
+    returns: list of CBs whose position differs
+    """
+    return [cb for cb, (corner, reference) in enumerate(zip(cb_corners(beam_layout.DEFAULT_LAYOUT),
+                                                            REFERENCE_CORNERS)) if not corner == reference]
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Plot heat map of triggers in each compound beam")
@@ -25,6 +63,9 @@ if __name__ == '__main__':
     # which triggers to plot
     parser.add_argument("--field", type=str, help="Which field to plot, can be raw, trigger, classifier (Default: raw)", 
                         default="raw")
+    parser.add_argument("--layout", type=str, help="Beam layout, can be {} (Default: {})".format(
+                        ', '.join(sorted(beam_layout.LAYOUTS)), beam_layout.DEFAULT_LAYOUT),
+                        default=beam_layout.DEFAULT_LAYOUT)
 
     args = parser.parse_args()
 
@@ -37,12 +78,18 @@ if __name__ == '__main__':
 
 
     # rectangle sizes
-    width = 2
-    height = 1
+    width = WIDTH
+    height = HEIGHT
+
+    mismatch = check_corners()
+    if mismatch:
+        print "Default layout does not match reference positions of CB {}".format(
+            ', '.join(["{:02d}".format(cb) for cb in mismatch]))
+        sys.exit(1)
 
     # map of CB to x,y coordinate of lower left corner
-    beams = range(40)
-    coords = ((-4.5,2.5), (-2.5,2.5), (-0.5,2.5), (-3.5,3.5), (None, None), (1.5,2.5), (-3.5,1.5), (-1.5,1.5), (-1.5,3.5), (None, None), (0.5,1.5), (2.5,1.5), (-4.5,0.5), (0.5,3.5), (None,None), (-2.5,0.5), (-0.5,0.5), (1.5,0.5), (2.5,3.5), (None, None), (-3.5,-0.5), (-1.5,-0.5), (0.5,-0.5), (-4.5,-3.5), (None,None), (2.5,-0.5), (-4.5,-1.5), (-2.5,-1.5), (-2.5,-3.5), (None,None), (-0.5,-1.5), (1.5,-1.5), (-3.5,-2.5), (-0.5,-3.5), (None, None), (-1.5,-2.5), (0.5,-2.5), (2.5,-2.5), (1.5,-3.5), (None,None))
+    beams = range(beam_layout.NCB)
+    coords = cb_corners(args.layout)
     coordmap = dict(zip(beams, coords))
 
     # load triggers
@@ -77,8 +124,11 @@ if __name__ == '__main__':
             y = y0 + height / 2.
             ax.text(x, y, "{:02d}".format(cb), ha='center', va='center')
 
-    ax.set_xlim(-4.5, 4.5)
-    ax.set_ylim(-3.5, 4.5)
+    # limits from the CBs in the layout
+    xs = [x0 for x0, y0 in coords if x0 is not None]
+    ys = [y0 for x0, y0 in coords if y0 is not None]
+    ax.set_xlim(min(xs), max(xs) + width)
+    ax.set_ylim(min(ys), max(ys) + height)
     ax.set_aspect('equal')
     ax.set_xlabel('<- RA')
     ax.set_ylabel('<- DEC')